@@ -0,0 +1 @@
+"""Offline benchmarks of the GEDI L4A python scripts."""
@@ -0,0 +1,360 @@
+"""Local mock of the NASA CMR, data and Hyrax endpoints used by the scripts.
+
+One threaded HTTP server serves the h5 files of a directory as
+
+    /search/collections.json            CMR collection search
+    /search/granules.json               CMR granule search, paged with the CMR-Hits header;
+                                        entries have polygons along the ground tracks
+    /data/<granule>                     granule download, with Range support
+    /data/<granule>.sha256              published sha256 of the granule
+    /opendap/<granule>.dap.nc4?dap4.ce  Hyrax DAP4 subset as a netCDF-4 file
+
+and counts requests and response bytes per endpoint. The counts are served 
+at /_stats and cleared by /_reset. ``MockServerProcess`` runs the server in a
+separate process, so it neither competes with the benchmarked scripts for
+the GIL nor shares the thread-unsafe netCDF-C library with them.
+"""
+import email.parser
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import threading
+import urllib.request
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+
+import h5py
+import numpy as np
+
+COLLECTION_ID = 'C2237824918-ORNL_CLOUD'
+TRACK_PIECES = 36 # polygons along the ground track of a granule
+TRACK_PADDING = 0.25 # degrees around the outer beams
+# netCDF-C is not thread-safe
+NC_LOCK = threading.Lock()
+
+
+def track_polygons(filename: str, pieces: int = TRACK_PIECES, padding: float = TRACK_PADDING):
+    """CMR polygons of the ground track of a granule: one ring of ``lat lon``
+    pairs around the outer beams for each piece of the track.
+
+    Args:
+        filename (str): path of the h5 file
+        pieces (int): number of polygons along the track
+        padding (float): margin in degrees around the outer beams
+
+    Returns:
+        list: CMR ``polygons``, lists of one ring string each
+    """
+    with h5py.File(filename, 'r') as f:
+        beams = sorted(b for b in f if b.startswith('BEAM'))
+        tracks = [(f[b]['lat_lowestmode'][()], f[b]['lon_lowestmode'][()]) for b in (beams[0], beams[-1])]
+    nshots = len(tracks[0][0])
+    polygons = []
+    for start, stop in zip(*[np.linspace(0, nshots - 1, pieces + 1).astype(int)[k:] for k in (0, 1)]):
+        idx = np.linspace(start, stop, 11).astype(int)
+        (lat0, lon0), (lat1, lon1) = [(lat[idx], lon[idx]) for lat, lon in tracks]
+        lat0, lat1 = (lat0 - padding, lat1 + padding) if lat0.mean() < lat1.mean() else (lat0 + padding, lat1 - padding)
+        lat = np.r_[lat0, lat1[::-1], lat0[:1]]
+        lon = np.r_[lon0, lon1[::-1], lon0[:1]]
+        polygons.append([' '.join(f'{y:.5f} {x:.5f}' for y, x in zip(lat, lon))])
+    return polygons
+
+
+def dap4_subset(filename: str, ce: str):
+    """Builds the netCDF-4 response of a DAP4 constraint expression.
+
+    Args:
+        filename (str): path of the h5 file
+        ce (str): constraint expression, e.g. /BEAM0000/agbd[0:9];/BEAM0000/xvar[0:9][0:3]
+
+    Returns:
+        bytes: netCDF-4 file
+    """
+    import netCDF4
+
+    with NC_LOCK, h5py.File(filename, 'r') as f:
+        ds = netCDF4.Dataset('subset.nc4', 'w', memory=1024, format='NETCDF4')
+        try:
+            for k, item in enumerate(ce.split(';')):
+                m = re.match(r'(/[^\[]+)((?:\[[^\]]*\])*)$', item)
+                var_path, slices = m.group(1), m.group(2)
+                index = []
+                for s in re.findall(r'\[([^\]]*)\]', slices):
+                    if s == '':
+                        index.append(slice(None))
+                    else:
+                        bounds = s.split(':')
+                        index.append(slice(int(bounds[0]), int(bounds[-1]) + 1))
+                data = f[var_path][tuple(index)] if index else f[var_path][()]
+                names = var_path.strip('/').split('/')
+                group = ds
+                for name in names[:-1]:
+                    group = group.groups[name] if name in group.groups else group.createGroup(name)
+                dims = []
+                for d, n in enumerate(data.shape):
+                    dims.append(f'{names[-1]}_{k}_{d}')
+                    group.createDimension(dims[-1], n)
+                fill_value = f[var_path].attrs.get('_FillValue')
+                var = group.createVariable(names[-1], data.dtype, dims, fill_value=fill_value)
+                var[...] = data
+        except Exception:
+            ds.close()
+            raise
+        return bytes(ds.close())
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Request handler of the mock endpoints."""
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written apart, which small responses would wait
+    # for the delayed ACK of the client for
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _count(self, endpoint: str, nbytes: int):
+        with self.server.lock:
+            self.server.requests[endpoint] += 1
+            self.server.bytes[endpoint] += nbytes
+
+    def _send(self, endpoint: str, body: bytes, code: int = 200, headers: dict = None):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        self._count(endpoint, len(body))
+
+    def _send_json(self, endpoint: str, obj, headers: dict = None):
+        self._send(endpoint, json.dumps(obj).encode(), headers=dict(headers or {}, **{'Content-Type': 'application/json'}))
+
+    def _granule(self, name: str):
+        filename = path.join(self.server.root, path.basename(name))
+        return filename if name.endswith('.h5') and path.isfile(filename) else None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/_stats':
+            with self.server.lock:
+                stats = {'requests': dict(self.server.requests), 'bytes': dict(self.server.bytes)}
+            body = json.dumps(stats).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif url.path == '/_reset':
+            self.server.reset()
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif url.path == '/search/collections.json':
+            self._send_json('collections', {'feed': {'entry': [{'id': COLLECTION_ID, 'data_center': 'ORNL_CLOUD'}]}})
+        elif url.path.startswith('/data/') and url.path.endswith('.sha256'):
+            filename = self._granule(url.path[:-len('.sha256')])
+            if filename is None:
+                return self._send('data', b'', 404)
+            self._send('sha256', self.server.sha256(filename).encode())
+        elif url.path.startswith('/data/'):
+            self._send_file(url.path)
+        elif url.path.startswith('/opendap/') and url.path.endswith('.dap.nc4'):
+            filename = self._granule(url.path[:-len('.dap.nc4')])
+            ce = urllib.parse.parse_qs(url.query).get('dap4.ce')
+            try:
+                body = dap4_subset(filename, ce[0])
+            except Exception:
+                return self._send('opendap', b'', 400)
+            self._send('opendap', body)
+        else:
+            self._send('other', b'', 404)
+
+    def do_HEAD(self):
+        filename = self._granule(urllib.parse.urlsplit(self.path).path)
+        self.send_response(200 if filename else 404)
+        self.send_header('Content-Length', str(path.getsize(filename)) if filename else '0')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if url.path != '/search/granules.json':
+            return self._send('other', b'', 404)
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body
+        )
+        form = {
+            part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+            for part in message.get_payload()
+        }
+        page_num, page_size = int(form.get('page_num', 1)), int(form.get('page_size', 10))
+        entries = self.server.entries(self.headers['Host'])
+        page = entries[(page_num - 1) * page_size:page_num * page_size]
+        self._send_json('granules', {'feed': {'entry': page}}, headers={'CMR-Hits': str(len(entries))})
+
+    def _send_file(self, name: str):
+        filename = self._granule(name)
+        if filename is None:
+            return self._send('data', b'', 404)
+        size = path.getsize(filename)
+        start, end, code = 0, size - 1, 200
+        m = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            if start >= size:
+                return self._send('data', b'', 416, {'Content-Range': f'bytes */{size}'})
+            code = 206
+        self.send_response(code)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if code == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                block = f.read(min(1 << 20, left))
+                self.wfile.write(block)
+                left -= len(block)
+        self._count('data', end - start + 1)
+
+
+class MockServer(ThreadingHTTPServer):
+    """Mock CMR, data and Hyrax server of the h5 files of a directory.
+
+    Args:
+        root (str): directory with the h5 files
+        port (int): port to listen on, 0 picks a free port
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root: str, port: int = 0):
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.root = root
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes = Counter()
+        self._sha256 = {}
+        self._polygons = {}
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def cmr_url(self):
+        return f"{self.url}/search/"
+
+    def sha256(self, filename: str):
+        if filename not in self._sha256:
+            hasher = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    hasher.update(block)
+            self._sha256[filename] = hasher.hexdigest()
+        return self._sha256[filename]
+
+    def polygons(self, filename: str):
+        if filename not in self._polygons:
+            self._polygons[filename] = track_polygons(filename)
+        return self._polygons[filename]
+
+    def entries(self, host: str):
+        """CMR granule entries of all the h5 files, whatever the shapefile."""
+        entries = []
+        for name in sorted(os.listdir(self.root)):
+            if not name.endswith('.h5'):
+                continue
+            entries.append({
+                'id': f'G{len(entries):010d}-ORNL_CLOUD',
+                'title': name,
+                'granule_size': str(path.getsize(path.join(self.root, name)) / 1e6),
+                'polygons': self.polygons(path.join(self.root, name)),
+                'links': [
+                    {'href': f'http://{host}/data/{name}', 'title': f'Download {name}'},
+                    {'href': f'http://{host}/data/{name}.sha256', 'title': f'Download {name}.sha256'},
+                    {'href': f'http://{host}/opendap/{name}', 'title': 'OPeNDAP request URL'},
+                ],
+            })
+        return entries
+
+    def reset(self):
+        """Resets the request and byte counters."""
+        with self.lock:
+            self.requests.clear()
+            self.bytes.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _serve(root: str, conn):
+    server = MockServer(root)
+    conn.send(server.server_address[1])
+    conn.close()
+    server.serve_forever()
+
+
+class MockServerProcess:
+    """Runs a MockServer of the h5 files of a directory in a child process.
+
+    Args:
+        root (str): directory with the h5 files
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self._process = None
+        self.port = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def cmr_url(self):
+        return f"{self.url}/search/"
+
+    def _get(self, name: str):
+        with urllib.request.urlopen(f"{self.url}/{name}") as response:
+            return response.read()
+
+    @property
+    def requests(self):
+        return json.loads(self._get('_stats'))['requests']
+
+    @property
+    def bytes(self):
+        return json.loads(self._get('_stats'))['bytes']
+
+    def reset(self):
+        """Resets the request and byte counters."""
+        self._get('_reset')
+
+    def start(self):
+        # a fresh interpreter, not a fork of the benchmark process
+        context = multiprocessing.get_context('spawn')
+        parent, child = context.Pipe()
+        self._process = context.Process(target=_serve, args=(self.root, child), daemon=True)
+        self._process.start()
+        self.port = parent.recv()
+        return self
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
@@ -0,0 +1,356 @@
+"""Offline benchmarks of the GEDI L4A python scripts.
+
+Synthetic granules are subset with gedi_l4a_subsets.py, from disk and over
+HTTP range requests, exported with create_csv_json and aggregated over a
+grid with gedi_l4a_aggregate.py, and served by a local mock of CMR, the data server and
+Hyrax to time gedi_l4a_search_download.py and gedi_l4a_hyrax.py, for areas
+of interest of several sizes. Results are written as JSON.
+
+Usage:
+    python benchmarks/run.py [--granules <n>] [--shots <n>] [--output <results.json>]
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from glob import glob
+from os import path
+
+SCRIPTS_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, SCRIPTS_DIR)
+
+from benchmarks.synthetic import BEAMS, write_granules
+
+# aoi name and side of the square area of interest in degrees
+AOI_SIZES = {'small': 0.2, 'medium': 1.0, 'large': 5.0}
+SCENARIOS = ['subsets', 'csv', 'geojson', 'aggregate', 'remote', 'hyrax', 'download']
+VARIABLES = ['agbd', 'agbd_se', 'l4_quality_flag', 'sensitivity']
+
+
+def parse_args(args):
+    """Parses command line agruments."""
+
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks of the GEDI L4A python scripts",
+        usage="run.py [--granules <n>] [--shots <n>] [--aois <small,medium,large>] [--scenarios <names>] [--repeat <n>] [--workdir <path>] [--output <results.json>]\n"
+    )
+    parser.add_argument(
+        "--granules",
+        default=4,
+        type=int,
+        help="number of synthetic granules (default: 4)"
+    )
+    parser.add_argument(
+        "--shots",
+        default=100000,
+        type=int,
+        help="number of shots per beam of the synthetic granules (default: 100000)"
+    )
+    parser.add_argument(
+        "--aois",
+        default=list(AOI_SIZES),
+        type=lambda arg: arg.split(','),
+        help=f"areas of interest in a comma-separated format (default: {','.join(AOI_SIZES)})"
+    )
+    parser.add_argument(
+        "--scenarios",
+        default=SCENARIOS,
+        type=lambda arg: arg.split(','),
+        help=f"scenarios in a comma-separated format (default: {','.join(SCENARIOS)})"
+    )
+    parser.add_argument(
+        "--workers",
+        default=4,
+        type=int,
+        help="value of the --workers argument of the scripts (default: 4)"
+    )
+    parser.add_argument(
+        "--repeat",
+        default=1,
+        type=int,
+        help="runs of each scenario, the fastest is reported (default: 1)"
+    )
+    parser.add_argument(
+        "--workdir",
+        type=pathlib.Path,
+        help="directory of the synthetic granules, reused by later runs with the same --granules and --shots (default: temporary directory)"
+    )
+    parser.add_argument(
+        "--output",
+        default="benchmark_results.json",
+        type=pathlib.Path,
+        help="output JSON file name (default: benchmark_results.json)"
+    )
+    parser.add_argument(
+        "--verbose",
+        default=False,
+        action='store_true',
+        help="setting this shows the output of the scripts"
+    )
+
+    return parser.parse_args(args)
+
+
+def git_version():
+    """Git description of the checked out version of the scripts, if any."""
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=SCRIPTS_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_granules(granule_dir: str, count: int, nshots: int):
+    """Writes the synthetic granules, unless granule_dir already has them."""
+    stamp = path.join(granule_dir, 'synthetic.json')
+    params = {'granules': count, 'shots': nshots}
+    if path.isfile(stamp):
+        with open(stamp) as f:
+            if json.load(f) == params:
+                return sorted(glob(path.join(granule_dir, '*.h5')))
+    shutil.rmtree(granule_dir, ignore_errors=True)
+    os.makedirs(granule_dir)
+    print(f"Writing {count} synthetic granules of {nshots} shots per beam ...")
+    files = write_granules(granule_dir, count, nshots)
+    with open(stamp, 'w') as f:
+        json.dump(params, f)
+    return files
+
+
+def write_box(filename: str, minx: float, miny: float, maxx: float, maxy: float):
+    """Writes a GeoJSON file of a longitude/latitude box."""
+    ring = [[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]
+    with open(filename, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+        }]}, f)
+
+
+def write_aoi(filename: str, granule: str, size: float):
+    """Writes a square area of interest centered on a shot of a granule.
+
+    Args:
+        filename (str): path of the GeoJSON file
+        granule (str): path of the h5 file
+        size (float): side of the square in degrees
+    """
+    import h5py
+
+    with h5py.File(granule, 'r') as f:
+        lat = f['BEAM0000/lat_lowestmode']
+        # a mid-latitude shot of the ascending part of the orbit
+        k = len(lat) // 24
+        y, x = float(lat[k]), float(f['BEAM0000/lon_lowestmode'][k])
+    h = size / 2
+    write_box(filename, x - h, y - h, x + h, y + h)
+
+
+def run_main(module, args: list, verbose: bool):
+    """Runs the main function of a script in-process with the command line
+    arguments, starting from empty per-stage metrics."""
+    module.METRICS.reset()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        module.main([str(a) for a in args])
+
+
+def count_shots(outdir: str):
+    """Number of shots of the subset h5 files of a directory."""
+    import h5py
+
+    nshots = 0
+    for filename in glob(path.join(outdir, '*.h5')):
+        with h5py.File(filename, 'r') as f:
+            nshots += sum(len(f[b]['shot_number']) for b in f if b.startswith('BEAM'))
+    return nshots
+
+
+def count_rows(filename: str):
+    """Number of data rows of a CSV file."""
+    with open(filename, 'rb') as f:
+        return max(sum(1 for _ in f) - 1, 0)
+
+
+def stages(module):
+    """Per-stage metrics of the last run of a script."""
+    return module.METRICS.report()['stages']
+
+
+def timed(fn, repeat: int):
+    """Runs fn, which returns the number of shots, and times the fastest run."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        nshots = fn()
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best[0]:
+            best = (seconds, nshots)
+    return best
+
+
+def main():
+    parser = parse_args(sys.argv[1:])
+
+    workdir = parser.workdir or pathlib.Path(tempfile.mkdtemp(prefix='gedi_l4a_bench_'))
+    workdir = path.abspath(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    rundir = tempfile.mkdtemp(prefix='run_', dir=workdir) if parser.workdir else workdir
+    # CMR results and shot coordinates are cached in the run directory
+    os.environ['GEDI_CACHE_DIR'] = path.join(rundir, 'cache')
+
+    import gedi_l4a_aggregate
+    import gedi_l4a_hyrax
+    import gedi_l4a_search_download
+    import gedi_l4a_subsets
+    from benchmarks.mockservers import MockServerProcess
+    from gedi_l4a.cmr import CMR
+
+    granule_dir = path.join(workdir, 'granules')
+    granules = prepare_granules(granule_dir, parser.granules, parser.shots)
+    granule_bytes = sum(path.getsize(g) for g in granules)
+
+    server = MockServerProcess(granule_dir).start()
+    # the scripts search the mock CMR without caching the results
+    CMR.url = server.cmr_url
+    CMR.cache_dir = None
+    search_args = ['--doi', '10.3334/ORNLDAAC/2056', '--date1', '2020-01-01', '--date2', '2020-12-31']
+
+    results = []
+
+    def record(name, aoi, seconds, nshots, **extra):
+        requests, nbytes = server.requests, server.bytes
+        result = {
+            'scenario': name, 'aoi': aoi, 'seconds': round(seconds, 4), 'shots': nshots,
+            'shots_per_second': round(nshots / seconds, 1) if nshots and seconds > 0 else None,
+            'requests': sum(requests.values()), 'bytes': sum(nbytes.values()),
+        }
+        result.update(extra)
+        results.append(result)
+        print(f"{name:>10} {aoi or '':>8} {seconds:9.3f} s {nshots:>10} shots")
+
+    try:
+        for aoi in [a for a in parser.aois if a in AOI_SIZES]:
+            poly = path.join(rundir, f'aoi_{aoi}.json')
+            write_aoi(poly, granules[0], AOI_SIZES[aoi])
+            subdir = path.join(rundir, f'subsets_{aoi}')
+
+            if {'subsets', 'csv', 'geojson', 'aggregate'} & set(parser.scenarios):
+                def subsets():
+                    shutil.rmtree(subdir, ignore_errors=True)
+                    os.makedirs(subdir)
+                    run_main(gedi_l4a_subsets, [
+                        '--poly', poly, '--indir', granule_dir, '--subdir', subdir, '--workers', parser.workers
+                    ], parser.verbose)
+                    return count_shots(subdir)
+                server.reset()
+                seconds, nshots = timed(subsets, parser.repeat)
+                if 'subsets' in parser.scenarios:
+                    record('subsets', aoi, seconds, nshots, input_bytes=granule_bytes, stages=stages(gedi_l4a_subsets))
+
+            if 'csv' in parser.scenarios:
+                def csv():
+                    gedi_l4a_subsets.METRICS.reset()
+                    gedi_l4a_subsets.create_csv_json(subdir, False, True)
+                    return count_rows(path.join(subdir, 'subset.csv'))
+                server.reset()
+                record('csv', aoi, *timed(csv, parser.repeat), stages=stages(gedi_l4a_subsets))
+
+            if 'geojson' in parser.scenarios:
+                def geojson():
+                    gedi_l4a_subsets.METRICS.reset()
+                    gedi_l4a_subsets.create_csv_json(subdir, True, False)
+                    return count_shots(subdir)
+                server.reset()
+                record('geojson', aoi, *timed(geojson, parser.repeat), stages=stages(gedi_l4a_subsets))
+
+            if 'aggregate' in parser.scenarios:
+                gridfile = path.join(rundir, f'grid_{aoi}.npz')
+                def aggregate():
+                    import numpy as np
+
+                    run_main(gedi_l4a_aggregate, [
+                        '--inputs', subdir, '--output', gridfile, '--workers', parser.workers
+                    ], parser.verbose)
+                    return int(np.load(gridfile)['count'].sum())
+                server.reset()
+                record('aggregate', aoi, *timed(aggregate, parser.repeat), stages=stages(gedi_l4a_aggregate))
+
+            if 'remote' in parser.scenarios:
+                remotedir = path.join(rundir, f'remote_{aoi}')
+                def remote():
+                    shutil.rmtree(remotedir, ignore_errors=True)
+                    os.makedirs(remotedir)
+                    run_main(gedi_l4a_subsets, search_args + [
+                        '--poly', poly, '--subdir', remotedir, '--workers', parser.workers, '--cache-ttl', 0,
+                    ], parser.verbose)
+                    return count_shots(remotedir)
+                server.reset()
+                seconds, nshots = timed(remote, parser.repeat)
+                record('remote', aoi, seconds, nshots, input_bytes=granule_bytes, stages=stages(gedi_l4a_subsets))
+
+            if 'hyrax' in parser.scenarios:
+                outfile = path.join(rundir, f'hyrax_{aoi}.csv')
+                def hyrax():
+                    if path.isfile(outfile):
+                        os.remove(outfile)
+                    run_main(gedi_l4a_hyrax, search_args + [
+                        '--poly', poly, '--beams', ','.join(BEAMS), '--variables', ','.join(VARIABLES),
+                        '--outfile', outfile, '--workers', parser.workers, '--coord-cache-mb', 0, '--cache-ttl', 0,
+                    ], parser.verbose)
+                    return count_rows(outfile)
+                server.reset()
+                record('hyrax', aoi, *timed(hyrax, parser.repeat), stages=stages(gedi_l4a_hyrax))
+
+        if 'download' in parser.scenarios:
+            # all ground tracks cross the latitudes of the orbit
+            poly = path.join(rundir, 'aoi_download.json')
+            write_box(poly, -180, -60, 180, 60)
+            outdir = path.join(rundir, 'download')
+            def download():
+                shutil.rmtree(outdir, ignore_errors=True)
+                os.makedirs(outdir)
+                run_main(gedi_l4a_search_download, search_args + [
+                    '--poly', poly, '--outdir', outdir, '--workers', parser.workers, '--cache-ttl', 0,
+                ], parser.verbose)
+                return 0
+            server.reset()
+            seconds, _ = timed(download, parser.repeat)
+            record('download', None, seconds, 0, megabytes_per_second=round(granule_bytes / 1e6 / seconds, 1),
+                   stages=stages(gedi_l4a_search_download))
+    finally:
+        server.stop()
+        if parser.workdir:
+            shutil.rmtree(rundir, ignore_errors=True)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'version': git_version(),
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'granules': parser.granules,
+        'shots_per_beam': parser.shots,
+        'workers': parser.workers,
+        'repeat': parser.repeat,
+        'results': results,
+    }
+    with open(parser.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {parser.output}")
+
+
+if __name__ == "__main__":
+    main()
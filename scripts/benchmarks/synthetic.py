@@ -0,0 +1,140 @@
+"""Generator of synthetic GEDI L4A granules.
+
+The granules follow the layout of GEDI L4A V2.1 files: eight BEAM groups
+with per-shot datasets, the 2D ``xvar`` predictor variables, the 
+``agbd_prediction``, ``geolocation`` and ``land_cover_data`` subgroups, and
+the ``ANCILLARY`` and ``METADATA`` groups. Shots follow an orbit-like
+ground track so that areas of interest intersect realistic runs of shots.
+"""
+import h5py
+import numpy as np
+
+BEAMS = ['BEAM0000', 'BEAM0001', 'BEAM0010', 'BEAM0011', 'BEAM0101', 'BEAM0110', 'BEAM1000', 'BEAM1011']
+INCLINATION = 51.6 # degrees, ISS orbit
+CHUNK_SIZE = 10000 # shots per HDF5 chunk
+FILL_VALUE = -9999
+
+
+def ground_track(nshots: int, lon0: float = 0.0, offset: float = 0.0):
+    """Coordinates of the shots along one orbit of an orbit-like ground track.
+
+    Args:
+        nshots (int): number of shots
+        lon0 (float): longitude of the ascending node
+        offset (float): cross-track offset of the beam in degrees
+
+    Returns:
+        tuple: lat and lon arrays
+    """
+    phase = np.linspace(0, 2 * np.pi, nshots, endpoint=False)
+    lat = INCLINATION * np.sin(phase)
+    lon = lon0 + np.degrees(np.arctan2(np.cos(np.radians(INCLINATION)) * np.sin(phase), np.cos(phase)))
+    lon = (lon + offset + 180) % 360 - 180
+    return lat + offset, lon
+
+
+def write_granule(filename: str, nshots: int = 100000, lon0: float = 0.0, seed: int = 0):
+    """Writes a synthetic GEDI L4A granule.
+
+    Args:
+        filename (str): path of the h5 file
+        nshots (int): number of shots per beam
+        lon0 (float): longitude of the ascending node of the ground track
+        seed (int): random seed
+    """
+    rng = np.random.default_rng(seed)
+    kwargs = {'chunks': True, 'compression': 'gzip', 'compression_opts': 4}
+
+    def dataset(group, name, data, **attrs):
+        ds = group.create_dataset(name, data=data, **(kwargs if data.ndim and len(data) > 0 else {}))
+        for k, v in attrs.items():
+            ds.attrs[k] = v
+
+    with h5py.File(filename, 'w') as f:
+        for b, beam in enumerate(BEAMS):
+            g = f.create_group(beam)
+            lat, lon = ground_track(nshots, lon0, offset=(b - 3.5) * 0.01)
+            shot_number = np.uint64(10 ** 17 * (seed % 90 + 1) + 10 ** 12 * b) + np.arange(nshots, dtype=np.uint64)
+            quality = (rng.random(nshots) < 0.6).astype(np.uint8)
+            agbd = np.where(quality == 1, rng.gamma(2.0, 60.0, nshots), FILL_VALUE).astype(np.float32)
+
+            dataset(g, 'agbd', agbd, units='Mg / ha', _FillValue=np.float32(FILL_VALUE))
+            dataset(g, 'agbd_se', (agbd * 0.1).astype(np.float32), units='Mg / ha')
+            dataset(g, 'agbd_t', np.sqrt(np.abs(agbd)).astype(np.float32))
+            dataset(g, 'agbd_t_se', rng.random(nshots).astype(np.float32))
+            dataset(g, 'algorithm_run_flag', np.ones(nshots, dtype=np.uint8))
+            dataset(g, 'beam', np.full(nshots, b, dtype=np.uint16))
+            dataset(g, 'channel', np.full(nshots, b, dtype=np.uint8))
+            dataset(g, 'degrade_flag', np.zeros(nshots, dtype=np.uint8))
+            dataset(g, 'delta_time', np.linspace(0, 5400, nshots) + 6e7)
+            dataset(g, 'elev_lowestmode', rng.normal(200, 50, nshots).astype(np.float32), units='m')
+            dataset(g, 'l2_quality_flag', quality)
+            dataset(g, 'l4_quality_flag', quality)
+            dataset(g, 'lat_lowestmode', lat, units='degrees')
+            dataset(g, 'lon_lowestmode', lon, units='degrees')
+            dataset(g, 'master_frac', rng.random(nshots))
+            dataset(g, 'master_int', np.arange(nshots, dtype=np.uint32))
+            dataset(g, 'predict_stratum', np.full(nshots, b'DBT_NAm', dtype='S8'))
+            dataset(g, 'predictor_limit_flag', np.zeros(nshots, dtype=np.uint8))
+            dataset(g, 'response_limit_flag', np.zeros(nshots, dtype=np.uint8))
+            dataset(g, 'selected_algorithm', rng.integers(1, 7, nshots).astype(np.uint8))
+            dataset(g, 'selected_mode', rng.integers(1, 4, nshots).astype(np.uint8))
+            dataset(g, 'selected_mode_flag', rng.integers(0, 2, nshots).astype(np.uint8))
+            dataset(g, 'sensitivity', rng.uniform(0.9, 1.0, nshots).astype(np.float32))
+            dataset(g, 'shot_number', shot_number)
+            dataset(g, 'solar_elevation', rng.uniform(-90, 90, nshots).astype(np.float32))
+            dataset(g, 'surface_flag', np.ones(nshots, dtype=np.uint8))
+            dataset(g, 'xvar', rng.random((nshots, 4)).astype(np.float32))
+
+            prediction = g.create_group('agbd_prediction')
+            for a in range(1, 4):
+                dataset(prediction, f'agbd_a{a}', (agbd * rng.uniform(0.9, 1.1)).astype(np.float32))
+                dataset(prediction, f'l4_quality_flag_a{a}', quality)
+            dataset(prediction, 'shot_number', shot_number)
+
+            geolocation = g.create_group('geolocation')
+            for a in range(1, 4):
+                dataset(geolocation, f'lat_lowestmode_a{a}', lat + rng.normal(0, 1e-5, nshots))
+                dataset(geolocation, f'lon_lowestmode_a{a}', lon + rng.normal(0, 1e-5, nshots))
+            dataset(geolocation, 'shot_number', shot_number)
+
+            land_cover = g.create_group('land_cover_data')
+            dataset(land_cover, 'landsat_treecover', rng.uniform(0, 100, nshots))
+            dataset(land_cover, 'landsat_water_persistence', rng.integers(0, 100, nshots).astype(np.uint8))
+            dataset(land_cover, 'leaf_off_flag', np.zeros(nshots, dtype=np.uint8))
+            dataset(land_cover, 'pft_class', rng.integers(1, 8, nshots).astype(np.uint8))
+            dataset(land_cover, 'region_class', rng.integers(1, 7, nshots).astype(np.uint8))
+            dataset(land_cover, 'shot_number', shot_number)
+            dataset(land_cover, 'urban_proportion', rng.integers(0, 100, nshots).astype(np.uint8))
+
+        # the model table is the same for all granules of a product version
+        ancillary = f.create_group('ANCILLARY')
+        ancillary.create_dataset('model_data', data=np.random.default_rng(0).random((35, 10)))
+        ancillary.create_dataset('pft_lut', data=np.arange(8, dtype=np.uint8))
+        ancillary.create_dataset('region_lut', data=np.arange(7, dtype=np.uint8))
+
+        metadata = f.create_group('METADATA')
+        identification = metadata.create_group('DatasetIdentification')
+        identification.attrs['shortName'] = 'GEDI_L4A_AGB_Density_V2_1'
+        identification.attrs['VersionID'] = '2.1'
+        identification.attrs['fileName'] = filename.rsplit('/', 1)[-1]
+
+
+def write_granules(outdir: str, count: int, nshots: int = 100000):
+    """Writes synthetic granules with ground tracks spread in longitude.
+
+    Args:
+        outdir (str): directory for the h5 files
+        count (int): number of granules
+        nshots (int): number of shots per beam
+
+    Returns:
+        list: paths of the h5 files
+    """
+    files = []
+    for k in range(count):
+        filename = f"{outdir}/GEDI04_A_2020{k:03d}000000_O{k:05d}_02_T00000_02_002_02_V002.h5"
+        # successive orbits are shifted west, as with the Earth rotation
+        write_granule(filename, nshots, lon0=-24.0 * k, seed=k)
+        files.append(filename)
+    return files
@@ -0,0 +1 @@
+"""Shared helpers for the GEDI L4A python scripts."""
@@ -0,0 +1,135 @@
+"""Area of interest tests for GEDI shots."""
+import numpy as np
+import shapely
+from glob import glob
+from os import path
+from gedi_l4a.footprints import SEGMENT_SIZE
+from gedi_l4a.h5utils import range_indices
+
+
+class AOI:
+    """Area of interest built from every feature of a GeoJSON file.
+
+    Shots are first masked by the bounding box of the area, and only the 
+    remaining candidates are tested against the prepared geometry with a 
+    vectorized point-in-polygon test.
+
+    Args:
+        geometry: shapely (Multi)Polygon of the area of interest
+    """
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.bounds = geometry.bounds
+        shapely.prepare(self.geometry)
+
+    @classmethod
+    def from_geodataframe(cls, gdf):
+        """Creates an AOI from the union of the geometries of a GeoDataFrame."""
+        return cls(shapely.union_all(np.asarray(gdf.geometry)))
+
+    def __getstate__(self):
+        return {'wkb': shapely.to_wkb(self.geometry)}
+
+    def __setstate__(self, state):
+        self.__init__(shapely.from_wkb(state['wkb']))
+
+    def contains(self, lat, lon):
+        """Tests which shots fall within the area of interest.
+
+        Args:
+            lat (array): latitudes of the shots
+            lon (array): longitudes of the shots
+
+        Returns:
+            array: boolean mask of the shots within the area of interest
+        """
+        lat = np.asarray(lat)
+        lon = np.asarray(lon)
+        minx, miny, maxx, maxy = self.bounds
+        mask = (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+        candidates = np.flatnonzero(mask)
+        if len(candidates) > 0:
+            mask[candidates] = shapely.contains_xy(self.geometry, lon[candidates], lat[candidates])
+        return mask
+
+    def indices(self, lat, lon):
+        """Returns the indices of the shots within the area of interest."""
+        return np.flatnonzero(self.contains(lat, lon))
+
+    def split(self, lat, lon):
+        """Returns the indices of the shots within the area of interest, 
+        keyed by None to match ``AOISet.split``."""
+        return {None: self.indices(lat, lon)}
+
+
+class AOISet:
+    """Several named areas of interest tested together.
+
+    The bounding boxes of segments of a beam track are matched against an
+    STRtree of the areas, and only the shots of the matching segments are
+    tested against each area.
+
+    Args:
+        aois (dict): area name to AOI
+    """
+    def __init__(self, aois: dict):
+        self.aois = aois
+        self.names = list(aois)
+        geometries = [a.geometry for a in aois.values()]
+        self.tree = shapely.STRtree(geometries)
+        self.geometry = shapely.GeometryCollection(geometries)
+        self.bounds = self.geometry.bounds
+
+    @classmethod
+    def from_files(cls, paths: list):
+        """Creates an AOISet from GeoJSON files, or directories of GeoJSON
+        files, named after the files."""
+        import geopandas as gpd
+        files = []
+        for p in paths:
+            if path.isdir(p):
+                files.extend(sorted(glob(path.join(p, '*.json')) + glob(path.join(p, '*.geojson'))))
+            else:
+                files.append(str(p))
+        aois = {}
+        for f in files:
+            poly = gpd.read_file(f)
+            poly.crs = 'EPSG:4326'
+            aois[path.splitext(path.basename(f))[0]] = AOI.from_geodataframe(poly)
+        return cls(aois)
+
+    def __getstate__(self):
+        return {'aois': self.aois}
+
+    def __setstate__(self, state):
+        self.__init__(state['aois'])
+
+    def split(self, lat, lon, segment_size: int = SEGMENT_SIZE):
+        """Tests which shots fall within each area of interest.
+
+        Args:
+            lat (array): latitudes of the shots
+            lon (array): longitudes of the shots
+            segment_size (int): number of shots per track segment
+
+        Returns:
+            dict: area name to the indices of the shots within it, for the 
+            areas with candidate shots
+        """
+        lat = np.asarray(lat)
+        lon = np.asarray(lon)
+        if len(lat) == 0:
+            return {}
+        starts = np.arange(0, len(lat), segment_size)
+        stops = np.minimum(starts + segment_size, len(lat))
+        boxes = shapely.box(np.fmin.reduceat(lon, starts), np.fmin.reduceat(lat, starts),
+                            np.fmax.reduceat(lon, starts), np.fmax.reduceat(lat, starts))
+        # matching the envelopes, segment boxes can be degenerate
+        segments, matches = self.tree.query(boxes)
+        indices = {}
+        for k in np.unique(matches):
+            seg = np.sort(segments[matches == k])
+            candidates = range_indices(np.column_stack([starts[seg], stops[seg]]))
+            aoi = self.aois[self.names[k]]
+            indices[self.names[k]] = candidates[aoi.contains(lat[candidates], lon[candidates])]
+        return indices
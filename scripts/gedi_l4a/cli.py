@@ -0,0 +1,100 @@
+"""Argument checks and inputs shared by the GEDI L4A scripts.
+
+Heavy libraries are only imported by the functions that need them, so the
+scripts start, and answer ``--help``, without loading them.
+"""
+import argparse
+import datetime as dt
+from urllib.parse import urlsplit
+from gedi_l4a.cmr import CMR
+
+DT_FORMAT = "%Y-%m-%d"
+DT_CMR = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def check_datefmt(d: str):
+    """Checks if date parameters are in correct format.
+    
+    Args:
+        d (str): date string in YYYY-MM-DD
+    
+    Returns:
+        datetime object
+    """
+    try:
+        return dt.datetime.strptime(d, DT_FORMAT)
+    except ValueError:
+        msg = "not a valid date in YYYY-MM-DD format"
+        raise argparse.ArgumentTypeError(msg)
+
+
+def check_doi(d: str):
+    """Checks if DOI passed is valid and the dataset exists at NASA CMR.
+    The collection of the DOI is cached, so the check is usually answered
+    without any network call.
+    
+    Args:
+        d (str): DOI
+    
+    Returns:
+        string: DOI stripped off https://doi.org, if any
+    """
+    try:
+        dpath = urlsplit(d).path.strip("/")
+        CMR.collection(dpath)
+        return dpath
+    except (ValueError, IndexError):
+        msg = "not a valid DOI"
+        raise argparse.ArgumentTypeError(msg)
+
+
+def check_where(expr: str):
+    """Checks if a --where argument is a filter expression.
+
+    Args:
+        expr (str): filter expression, e.g. l4_quality_flag==1
+
+    Returns:
+        Filter
+    """
+    from gedi_l4a.filters import Filter
+
+    try:
+        return Filter.parse(expr)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def cmr_temporal(start_date, end_date):
+    """Formats start and end datetimes as a NASA CMR temporal range."""
+    return start_date.strftime(DT_CMR) + ',' + end_date.strftime(DT_CMR)
+
+
+def read_poly(poly):
+    """Reads the polygons of a GeoJSON file.
+
+    Args:
+        poly: path or file object of the GeoJSON file
+
+    Returns:
+        GeoDataFrame of the polygons in EPSG:4326
+    """
+    import geopandas as gpd
+
+    gdf = gpd.read_file(poly)
+    gdf.crs = 'EPSG:4326'
+    return gdf
+
+
+def read_aoi(poly):
+    """Reads the area of interest defined by all features of a GeoJSON file.
+
+    Args:
+        poly: path or file object of the GeoJSON file
+
+    Returns:
+        AOI
+    """
+    from gedi_l4a.aoi import AOI
+
+    return AOI.from_geodataframe(read_poly(poly))
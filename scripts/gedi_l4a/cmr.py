@@ -0,0 +1,347 @@
+"""NASA CMR search client shared by the GEDI L4A scripts."""
+import gzip
+import hashlib
+import json
+import math
+import os
+import time
+import numpy as np
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from requests.adapters import HTTPAdapter
+from gedi_l4a.metrics import METRICS, response_retries
+
+CMR_URL = "https://cmr.earthdata.nasa.gov/search/"
+CACHE_DIR = os.environ.get("GEDI_CACHE_DIR", path.join(path.expanduser("~"), ".cache", "gedi_l4a"))
+CACHE_TTL = 24 * 3600 # seconds
+COLLECTION_TTL = 30 * 24 * 3600 # seconds, a DOI resolves to the same collection for good
+PAGE_SIZE = 2000 # CMR page size limit
+SHAPEFILE_POINTS = 1000 # vertices of the area of interest sent to CMR, whose limit is 5000
+SEGMENT_DEGREES = 1.0 # longest edge of the polygons, so geodetic and planar edges barely differ
+GEODETIC_MARGIN = 0.01 # degrees, covers the difference of the geodetic and planar edges
+
+
+def superset_polygon(geometry, max_points: int = SHAPEFILE_POINTS):
+    """Simplifies the area of interest to a geometry of at most about 
+    max_points vertices that covers it. The geometry is simplified, buffered
+    by twice the tolerance and simplified again, doubling the tolerance 
+    until few enough vertices are left; the convex hull and the envelope 
+    are the last resorts. Edges are split into SEGMENT_DEGREES segments.
+
+    Args:
+        geometry: shapely (Multi)Polygon of the area of interest
+        max_points (int): maximum number of vertices before segmentizing
+
+    Returns:
+        shapely (Multi)Polygon covering the geometry
+    """
+    import shapely
+
+    simplified = geometry
+    if shapely.get_num_coordinates(geometry) > max_points:
+        minx, miny, maxx, maxy = geometry.bounds
+        size = max(maxx - minx, maxy - miny)
+        tolerance = max(size / 1000, GEODETIC_MARGIN / 2)
+        while tolerance < size:
+            # buffering the full geometry is much slower, and covers() checks the result
+            simplified = shapely.buffer(geometry.simplify(tolerance), 2 * tolerance, quad_segs=2).simplify(tolerance)
+            if shapely.get_num_coordinates(simplified) <= max_points and simplified.covers(geometry):
+                break
+            tolerance *= 2
+        else:
+            simplified = shapely.convex_hull(geometry)
+            if shapely.get_num_coordinates(simplified) > max_points:
+                simplified = shapely.envelope(geometry)
+    return shapely.segmentize(simplified, SEGMENT_DEGREES)
+
+
+def _geodetic_ring(lat, lon, step: float = SEGMENT_DEGREES):
+    """Adds points along the great circle arcs of a ring of CMR GPolygon
+    vertices, so the arcs are followed by planar edges. Longitudes are 
+    unwrapped across the antimeridian."""
+    xyz = np.column_stack([
+        np.cos(np.radians(lat)) * np.cos(np.radians(lon)),
+        np.cos(np.radians(lat)) * np.sin(np.radians(lon)),
+        np.sin(np.radians(lat)),
+    ])
+    points = [xyz[:1]]
+    for a, b in zip(xyz[:-1], xyz[1:]):
+        angle = np.arccos(np.clip(np.dot(a, b), -1, 1))
+        n = max(int(np.ceil(np.degrees(angle) / step)), 1)
+        t = np.arange(1, n + 1)[:, None] / n
+        if angle > 1e-12:
+            arc = (np.sin((1 - t) * angle) * a + np.sin(t * angle) * b) / np.sin(angle)
+        else:
+            arc = np.repeat(b[None, :], n, axis=0)
+        points.append(arc)
+    xyz = np.concatenate(points)
+    lat = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1, 1)))
+    lon = np.unwrap(np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])), period=360)
+    return lon, lat
+
+
+def entry_geometry(entry: dict):
+    """Geometry of the ``boxes`` and ``polygons`` of a CMR granule entry.
+
+    Boxes are ``S W N E`` strings; polygons are lists of rings of ``lat lon``
+    pairs, the exterior ring first, with geodetic edges. Geometries crossing
+    the antimeridian extend beyond 180 degrees of longitude.
+
+    Args:
+        entry (dict): CMR granule entry
+
+    Returns:
+        shapely geometry, or None if the entry has no boxes or polygons that
+        can be parsed, e.g. polygons around a pole
+    """
+    import shapely
+
+    parts = []
+    try:
+        for box in entry.get('boxes') or []:
+            south, west, north, east = (float(v) for v in box.split())
+            # boxes crossing the antimeridian have west > east
+            parts.append(shapely.box(west, south, east + 360 if west > east else east, north))
+        for polygon in entry.get('polygons') or []:
+            rings = []
+            for ring in polygon:
+                coords = np.array(ring.split(), dtype=float).reshape(-1, 2)
+                lon, lat = _geodetic_ring(coords[:, 0], coords[:, 1])
+                # a ring around a pole does not close once unwrapped
+                if abs(lon[-1] - lon[0]) > 180:
+                    return None
+                rings.append(np.column_stack([lon, lat]))
+            parts.append(shapely.make_valid(shapely.Polygon(rings[0], rings[1:])))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if not parts:
+        return None
+    return shapely.buffer(shapely.union_all(parts), GEODETIC_MARGIN)
+
+
+def entry_intersects(entry: dict, aoi) -> bool:
+    """Tests whether the geometry of a CMR granule entry intersects the 
+    area of interest. Entries without a usable geometry are kept.
+
+    Args:
+        entry (dict): CMR granule entry
+        aoi: prepared shapely geometry of the area of interest
+
+    Returns:
+        bool: False only if the granule surely misses the area of interest
+    """
+    import shapely
+
+    geometry = entry_geometry(entry)
+    if geometry is None:
+        return True
+    minx, _, maxx, _ = geometry.bounds
+    # unwrapped geometries are also tested one turn east or west
+    shifts = [0] + ([-360] if maxx > 180 else []) + ([360] if minx < -180 else [])
+    return any(aoi.intersects(shapely.transform(geometry, lambda xy: xy + [dx, 0])) for dx in shifts)
+
+
+def granule_links(entry: dict, data_center: str, fmt: str = "h5"):
+    """Get the url, sha256 url and size of the data file of a CMR granule 
+    entry.
+
+    Args:
+        entry (dict): CMR granule entry
+        data_center (str): data center of the collection, e.g. ORNL_CLOUD
+        fmt (str): extension of the data file
+
+    Returns:
+        dict: granule ``url`` and ``sha256`` url, empty if not found, and 
+        ``size`` in bytes, 0 if unknown
+    """
+    href = ''
+    sha256 = ''
+    for links in entry['links']:
+        if 'href' in links:
+            if not data_center.startswith('ORNL'):
+                if links['href'].endswith(fmt):
+                    href = links['href']
+            else:
+                if links['href'].endswith(fmt) and links['title'].startswith('Download'):
+                    href = links['href']
+                if links['href'].endswith('.sha256'):
+                    sha256 = links['href']
+    try:
+        # CMR granule sizes are in MB
+        size = int(float(entry.get('granule_size') or 0) * 1e6)
+    except ValueError:
+        size = 0
+    return {'url': href, 'sha256': sha256, 'size': size}
+
+
+class CMRClient:
+    """Searches NASA CMR over a keep-alive session. Granule search results
+    are cached on disk for ``ttl`` seconds, and the collection of a DOI for
+    ``collection_ttl`` seconds, so a repeated query is answered without any
+    network call.
+
+    Args:
+        url (str): CMR search API base url
+        cache_dir (str): directory of the result cache, None disables it
+        ttl (float): lifetime of cached granule search results in seconds
+        workers (int): number of result pages fetched concurrently
+        metrics (Metrics): metrics to add the requests and bytes of the
+        ``cmr_search`` stage to, if any
+        collection_ttl (float): lifetime of cached collections in seconds
+    """
+    def __init__(self, url: str = CMR_URL, cache_dir: str = CACHE_DIR, ttl: float = CACHE_TTL, workers: int = 4,
+                 metrics=None, collection_ttl: float = COLLECTION_TTL):
+        self.url = url
+        self.metrics = metrics
+        self.collection_ttl = collection_ttl
+        self.cache_dir = path.join(cache_dir, "cmr") if cache_dir else None
+        self.ttl = ttl
+        self.workers = workers
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=workers))
+        self._memo = {}
+
+    def _record(self, response):
+        if self.metrics:
+            self.metrics.add('cmr_search', requests=1, bytes=len(response.content), retries=response_retries(response))
+
+    def _cache_file(self, key: str):
+        return path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.json.gz')
+
+    def _cache_get(self, key: str, ttl: float):
+        if ttl <= 0:
+            return None
+        # values are memoized with the time they were cached, and expire 
+        # as the cache files do
+        if key in self._memo:
+            cached, value = self._memo[key]
+            return value if time.time() - cached <= ttl else None
+        if not self.cache_dir:
+            return None
+        cache_file = self._cache_file(key)
+        try:
+            cached = path.getmtime(cache_file)
+            if time.time() - cached > ttl:
+                return None
+            with gzip.open(cache_file, 'rt') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._memo[key] = (cached, value)
+        return value
+
+    def _cache_put(self, key: str, value, ttl: float):
+        if ttl <= 0:
+            return
+        self._memo[key] = (time.time(), value)
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_file = self._cache_file(key)
+        tmp = f"{cache_file}.{os.getpid()}.tmp"
+        with gzip.open(tmp, 'wt') as f:
+            json.dump(value, f)
+        os.replace(tmp, cache_file)
+
+    def collection(self, doi: str):
+        """Get the CMR collection entry of a dataset DOI.
+
+        Args:
+            doi (str): dataset DOI
+
+        Returns:
+            dict: CMR collection entry, including ``id`` and ``data_center``
+
+        Raises:
+            IndexError: no collection has the DOI
+        """
+        key = json.dumps(['collection', self.url, doi])
+        entry = self._cache_get(key, self.collection_ttl)
+        if entry is None:
+            response = self.session.get(self.url + 'collections.json', params={'doi': doi})
+            self._record(response)
+            entry = response.json()['feed']['entry'][0]
+            self._cache_put(key, entry, self.collection_ttl)
+        return entry
+
+    def _granules_page(self, params: dict, files: dict, page_num: int):
+        response = self.session.post(self.url + 'granules.json', data=dict(params, page_num=page_num), files=files)
+        response.raise_for_status()
+        self._record(response)
+        return response
+
+    def granules(self, concept_id: str, temporal: str, shapefile: str, **params):
+        """Get the CMR entries of the granules of a collection that overlap
+        temporal and spatial bounds. After the first page reports the number
+        of hits, the remaining pages are fetched concurrently.
+
+        Args:
+            concept_id (str): CMR collection concept id
+            temporal (str): temporal ranges with start and end datetimes 
+            in NASA CMR-required format
+            shapefile (str): GeoJSON of the area of interest
+            params: additional CMR search parameters
+
+        Returns:
+            list: CMR granule entries
+        """
+        poly_hash = hashlib.sha256(shapefile.encode()).hexdigest()
+        key = json.dumps(['granules', self.url, concept_id, temporal, poly_hash, sorted(params.items())])
+        entries = self._cache_get(key, self.ttl)
+        if entries is not None:
+            return entries
+
+        params = dict(params, collection_concept_id=concept_id, temporal=temporal, page_size=PAGE_SIZE)
+        files = {"shapefile": ("poly.json", shapefile, "application/geo+json")}
+
+        response = self._granules_page(params, files, 1)
+        entries = response.json()['feed']['entry']
+        if 'CMR-Hits' in response.headers:
+            pages = range(2, math.ceil(int(response.headers['CMR-Hits']) / PAGE_SIZE) + 1)
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for r in executor.map(lambda p: self._granules_page(params, files, p), pages):
+                    entries.extend(r.json()['feed']['entry'])
+        else:
+            page_num = 1
+            while entries and len(entries) == page_num * PAGE_SIZE:
+                page_num += 1
+                entries.extend(self._granules_page(params, files, page_num).json()['feed']['entry'])
+
+        self._cache_put(key, entries, self.ttl)
+        return entries
+
+    def search(self, doi: str, poly_epsg4326, temporal: str):
+        """Get the collection of a DOI and the CMR entries of its granules 
+        that overlap the temporal and spatial bounds. CMR is sent a 
+        simplified polygon covering the area of interest, and the granules
+        whose boxes or polygons miss the exact area are dropped.
+
+        Args:
+            doi (str): dataset DOI
+            poly_epsg4326: GeoDataFrame object containing the polygon object
+            temporal (str): temporal ranges with start and end datetimes 
+            in NASA CMR-required format
+
+        Returns:
+            tuple: CMR collection entry and CMR granule entries
+        """
+        import shapely
+        from shapely.ops import orient
+
+        aoi = shapely.union_all(np.asarray(poly_epsg4326.geometry))
+        # a few hundred vertices bypass the 5000 coordinates limit of CMR
+        # and keep the request small; orienting coordinates clockwise
+        envelope = orient(superset_polygon(aoi), 1)
+        shapefile = json.dumps({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'properties': {}, 'geometry': json.loads(shapely.to_geojson(envelope))}
+        ]})
+
+        collection = self.collection(doi)
+        granules = self.granules(collection['id'], temporal, shapefile)
+        shapely.prepare(aoi)
+        return collection, [g for g in granules if entry_intersects(g, aoi)]
+
+
+# CMR client shared by the DOI check and the granule search of the scripts
+CMR = CMRClient(metrics=METRICS)
@@ -0,0 +1,240 @@
+"""Consolidated subset h5 file of many granules.
+
+The shots of all BEAM groups of all granules are appended to the chunked,
+extendable datasets of the ``/shots`` group, with the same paths relative
+to the group as relative to a BEAM group, plus two index columns:
+
+    /shots/granule_index  index of the granule in /granules
+    /shots/beam_index     index of the BEAM name in /beams
+    /granules             granule file names
+    /granule_stop         end row of the shots of each granule in /shots
+    /granule_ancillary    index of the ANCILLARY group of each granule
+    /granule_metadata     index of the METADATA group of each granule
+    /ANCILLARY/<k>        distinct ANCILLARY groups
+    /METADATA/<k>         distinct METADATA groups
+
+The ANCILLARY and METADATA groups of a granule are only stored if no
+earlier granule had the same content. A granule is committed by appending
+its row to ``/granules`` after its shots, so the shots of a granule whose
+append was interrupted are dropped when the file is reopened.
+"""
+import hashlib
+import numpy as np
+from gedi_l4a.h5utils import H5_CHUNK_SIZE, H5_COMPRESSION, H5_COMPRESSION_LEVEL, H5_LIBVER, memory_window, storage_options
+
+SHOTS = 'shots'
+INDEX_COLUMNS = ['granule_index', 'beam_index']
+SHARED_GROUPS = ['ANCILLARY', 'METADATA']
+MOVE_CHUNKS = 10 # chunks of shots moved at once by ConsolidatedFile.remove
+
+
+def group_digest(group):
+    """SHA-256 of the attributes and datasets of an h5 group and its subgroups."""
+    import h5py
+
+    hasher = hashlib.sha256()
+
+    def update_value(value):
+        value = np.asarray(value)
+        # object arrays hold pointers to variable-length strings
+        hasher.update(repr(value.tolist()).encode() if value.dtype.kind == 'O' else value.tobytes())
+
+    def update(obj):
+        for k in sorted(obj.attrs.keys()):
+            hasher.update(k.encode())
+            update_value(obj.attrs[k])
+        if isinstance(obj, h5py.Dataset):
+            hasher.update(str((obj.dtype, obj.shape)).encode())
+            update_value(obj[()])
+        else:
+            for k in sorted(obj.keys()):
+                hasher.update(k.encode())
+                update(obj[k])
+
+    update(group)
+    return hasher.hexdigest()
+
+
+def is_consolidated(hf):
+    """True if an open h5 file is a consolidated subset file."""
+    return SHOTS in hf and 'granules' in hf
+
+
+class ConsolidatedFile:
+    """Appends the BEAM groups of per-granule subset h5 files to one
+    consolidated h5 file.
+
+    Args:
+        filename (str): path of the consolidated h5 file
+        compression (str): gzip, lzf or none
+        level (int): gzip compression level
+        chunk_size (int): rows per chunk of the shot datasets
+        append (bool): keeps the granules of an existing file
+    """
+    def __init__(self, filename: str, compression: str = H5_COMPRESSION, level: int = H5_COMPRESSION_LEVEL,
+                 chunk_size: int = H5_CHUNK_SIZE, append: bool = False):
+        import h5py
+
+        self.filename = filename
+        self.storage = {'compression': compression, 'level': level, 'chunk_size': chunk_size}
+        self.hf = h5py.File(filename, 'a' if append else 'w', libver=H5_LIBVER)
+        string = h5py.string_dtype()
+        for name, dtype in [('granules', string), ('beams', string), ('granule_stop', np.int64),
+                            ('granule_ancillary', np.int32), ('granule_metadata', np.int32)]:
+            if name not in self.hf:
+                self.hf.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(1024,))
+        self.hf.require_group(SHOTS)
+        # drops the rows of a granule whose append was interrupted
+        ngranules = len(self.hf['granules'])
+        for name in ['granule_stop', 'granule_ancillary', 'granule_metadata']:
+            self.hf[name].resize(ngranules, axis=0)
+        self.nshots = int(self.hf['granule_stop'][-1]) if ngranules else 0
+        self._resize(self.nshots)
+        self.beams = [b.decode() if isinstance(b, bytes) else b for b in self.hf['beams'][()]]
+        self.digests = {
+            name: {g.attrs['digest']: int(k) for k, g in self.hf.require_group(name).items()}
+            for name in SHARED_GROUPS
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _datasets(self):
+        import h5py
+
+        datasets = []
+        self.hf[SHOTS].visititems(lambda k, v: datasets.append(v) if isinstance(v, h5py.Dataset) else None)
+        return datasets
+
+    def _resize(self, nshots: int):
+        for dataset in self._datasets():
+            if len(dataset) != nshots:
+                dataset.resize(nshots, axis=0)
+
+    def _append_rows(self, name: str, data, attrs=None, offset: int = 0):
+        # offset is the first row of data within the rows of the beam
+        shots = self.hf[SHOTS]
+        if name not in shots:
+            options = storage_options(data.shape, resizable=True, **self.storage)
+            fillvalue = attrs.get('_FillValue') if attrs is not None else None
+            shots.create_dataset(name, shape=(self.nshots,) + data.shape[1:], dtype=data.dtype,
+                                 fillvalue=fillvalue, **options)
+            for k, v in (attrs or {}).items():
+                shots[name].attrs[k] = v
+        dataset = shots[name]
+        start = self.nshots + offset
+        if len(dataset) < start + len(data):
+            dataset.resize(start + len(data), axis=0)
+        dataset[start:start + len(data)] = data
+
+    @staticmethod
+    def _append_value(dataset, value):
+        dataset.resize(len(dataset) + 1, axis=0)
+        dataset[-1] = value
+
+    def _shared_group(self, hf_in, name: str):
+        """Index of the stored group with the content of a group of the input file."""
+        if name not in hf_in:
+            return -1
+        digest = group_digest(hf_in[name])
+        if digest not in self.digests[name]:
+            k = len(self.digests[name])
+            hf_in.copy(hf_in[name], self.hf[name], name=str(k))
+            self.hf[name][str(k)].attrs['digest'] = digest
+            self.digests[name][digest] = k
+        return self.digests[name][digest]
+
+    def append(self, subfile: str, granule: str, window: int = None, memory_mb: float = None):
+        """Appends the shots of a per-granule subset h5 file.
+
+        Args:
+            subfile (str): path of the subset h5 file
+            granule (str): name of the granule in /granules
+            window (int): maximum number of shots copied at once; whole
+            beams if None
+            memory_mb (float): memory ceiling in MB of the shots copied at 
+            once, if any
+
+        Returns:
+            int: number of shots appended
+        """
+        import h5py
+
+        first = self.nshots
+        g = len(self.hf['granules'])
+        with h5py.File(subfile, 'r') as hf_in:
+            for v in list(hf_in.keys()):
+                if not v.startswith('BEAM'):
+                    continue
+                beam = hf_in[v]
+                n = len(beam['shot_number'])
+                if v not in self.beams:
+                    self.beams.append(v)
+                    self._append_value(self.hf['beams'], v)
+                datasets = []
+                beam.visititems(lambda k, value: datasets.append((k, value)) if isinstance(value, h5py.Dataset) else None)
+                size = memory_window(beam, memory_mb, window=window) or max(n, 1)
+                for start in range(0, n, size):
+                    for k, value in datasets:
+                        self._append_rows(k, value[start:start + size], value.attrs, start)
+                    rows = min(size, n - start)
+                    self._append_rows('granule_index', np.full(rows, g, dtype=np.uint32), offset=start)
+                    self._append_rows('beam_index', np.full(rows, self.beams.index(v), dtype=np.uint8), offset=start)
+                self.nshots += n
+                # datasets missing from this beam are left to their fill value
+                self._resize(self.nshots)
+            ancillary = self._shared_group(hf_in, 'ANCILLARY')
+            metadata = self._shared_group(hf_in, 'METADATA')
+        self._append_value(self.hf['granule_stop'], self.nshots)
+        self._append_value(self.hf['granule_ancillary'], ancillary)
+        self._append_value(self.hf['granule_metadata'], metadata)
+        # the granule row commits its shots
+        self._append_value(self.hf['granules'], granule)
+        self.hf.flush()
+        return self.nshots - first
+
+    def remove(self, granule: str, window: int = None):
+        """Removes the shots of a granule, e.g. of one that changed since it
+        was appended. The shots of the later granules move up in its place,
+        and their granule indices down by one. Unlike an append, a removal
+        is not undone when it is interrupted; rerun with a new journal to
+        rebuild the file.
+
+        Args:
+            granule (str): name of the granule in /granules
+            window (int): maximum number of shots moved at once
+
+        Returns:
+            int: number of shots removed
+        """
+        granules = list(self.hf['granules'].asstr()[()])
+        if granule not in granules:
+            return 0
+        g = granules.index(granule)
+        stops = self.hf['granule_stop'][()]
+        start = int(stops[g - 1]) if g else 0
+        n = int(stops[g]) - start
+        size = window or self.storage['chunk_size'] * MOVE_CHUNKS
+        for dataset in self._datasets():
+            for row in range(start + n, self.nshots, size):
+                rows = dataset[row:min(row + size, self.nshots)]
+                if dataset.name.rsplit('/', 1)[-1] == 'granule_index':
+                    rows[rows > g] -= 1
+                dataset[row - n:row - n + len(rows)] = rows
+        self.nshots -= n
+        self._resize(self.nshots)
+        stops[g + 1:] -= n
+        for name, values in [('granule_stop', stops), ('granule_ancillary', self.hf['granule_ancillary'][()]),
+                             ('granule_metadata', self.hf['granule_metadata'][()]), ('granules', granules)]:
+            values = list(values[:g]) + list(values[g + 1:])
+            self.hf[name].resize(len(values), axis=0)
+            if values:
+                self.hf[name][:] = values
+        self.hf.flush()
+        return n
+
+    def close(self):
+        self.hf.close()
@@ -0,0 +1,74 @@
+"""Persistent cache of GEDI shot coordinates."""
+import hashlib
+import os
+import threading
+import numpy as np
+from os import path
+from gedi_l4a.cmr import CACHE_DIR
+
+COORD_CACHE_MB = 2048 # cache size limit
+
+
+class CoordinateCache:
+    """Compressed on-disk cache of the lat/lon arrays of granule beams, keyed
+    by granule url and beam name. The least recently used entries are 
+    evicted once the cache grows beyond ``max_mb``.
+
+    Args:
+        cache_dir (str): directory of the cache
+        max_mb (float): cache size limit in MB
+    """
+    def __init__(self, cache_dir: str = path.join(CACHE_DIR, "coords"), max_mb: float = COORD_CACHE_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(e.stat().st_size for e in os.scandir(cache_dir) if e.name.endswith('.npz'))
+
+    def _file(self, url: str, beam: str):
+        return path.join(self.cache_dir, hashlib.sha256(f"{url}\n{beam}".encode()).hexdigest() + '.npz')
+
+    def get(self, url: str, beam: str):
+        """Get the cached coordinates of a granule beam.
+
+        Returns:
+            tuple: lat and lon arrays, or None if they are not cached
+        """
+        cache_file = self._file(url, beam)
+        try:
+            with np.load(cache_file) as npz:
+                lat, lon = npz['lat'], npz['lon']
+            # mark as recently used
+            os.utime(cache_file)
+        except (OSError, ValueError, KeyError):
+            return None
+        return lat, lon
+
+    def put(self, url: str, beam: str, lat, lon):
+        """Caches the coordinates of a granule beam. Empty arrays record
+        a beam that does not exist in the granule."""
+        cache_file = self._file(url, beam)
+        tmp = f"{cache_file}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, lat=lat, lon=lon)
+        size = path.getsize(tmp)
+        os.replace(tmp, cache_file)
+        with self._lock:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(
+            (e for e in os.scandir(self.cache_dir) if e.name.endswith('.npz')),
+            key=lambda e: e.stat().st_mtime
+        )
+        self._size = sum(e.stat().st_size for e in entries)
+        for e in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                self._size -= e.stat().st_size
+                os.remove(e.path)
+            except OSError:
+                pass
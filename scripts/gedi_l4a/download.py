@@ -0,0 +1,478 @@
+"""Granule downloads shared by the GEDI L4A scripts.
+
+Granules are streamed to a ``.part`` file that is renamed once its sha256
+hash is verified, and interrupted transfers are resumed with HTTP Range
+requests, either as one stream or as concurrent byte-range segments.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path, remove
+from urllib.parse import urlsplit
+from gedi_l4a.metrics import METRICS
+from gedi_l4a.session import EDLSession
+
+EDL_AUTH = "https://wiki.earthdata.nasa.gov/display/EL/How+To+Access+Data+With+cURL+And+Wget"
+PART_SUFFIX = ".part"
+SEGMENTS_SUFFIX = ".segments" # log of the completed segments of a .part file
+MANIFEST_NAME = ".gedi_manifest.jsonl"
+CHUNK_SIZE = 1024 * 1024 # bytes read per iteration of a download stream
+MAX_ATTEMPTS = 5 # download attempts per granule before giving up
+SEGMENT_SIZE_MB = 16 # size of the byte ranges of a segmented download
+
+
+def file_sha256(local_file: str, hasher=None):
+    """Computes the sha256 hash of a local file.
+
+    Args:
+        local_file (str): full path of local file
+        hasher: hashlib object to continue updating, if any
+
+    Returns:
+        hashlib object updated with the file content
+    """
+    hasher = hasher or hashlib.sha256()
+    with open(local_file, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            hasher.update(data)
+    return hasher
+
+
+def remote_sha256(granule_url: str, session=None):
+    """Retrieves the published sha256 hash of a granule.
+
+    Args:
+        granule_url (str): url of the granule sha256 file
+        session: requests session to use, if any
+
+    Returns:
+        string: hex digest of the remote file
+    """
+    with METRICS.stage('sha256', path.basename(granule_url).removesuffix('.sha256'), requests=1) as m:
+        response = (session or requests).get(granule_url)
+        m['bytes'] += len(response.content)
+    response.raise_for_status()
+    return response.content.decode("utf-8").strip()
+
+
+def check_sha256(granule_url: str, local_file: str):
+    """Checks if the local file matches the sha256 hash of the remote file.
+
+    Args:
+        granule_url (str): download url of granule
+        local_file (str): full path of local file
+    
+    Returns:
+        bool: whether the sha256 hashes of local and remote file 
+        are same
+    """
+    return remote_sha256(granule_url) == file_sha256(local_file).hexdigest()
+
+
+class Manifest:
+    """Append-only record of the granules in the download directory.
+
+    Each line is a JSON object with the filename, size, mtime, local sha256
+    and remote sha256 of a granule; the last line for a filename wins. A 
+    file is rehashed only if its size or mtime no longer match its entry.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.entries = {}
+        if path.isfile(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partial line from an interrupted run
+                        continue
+                    self.entries[entry['filename']] = entry
+        # compact the log, dropping files that were removed since
+        dirname = path.dirname(filename)
+        self.entries = {k: e for k, e in self.entries.items() if path.isfile(path.join(dirname, k))}
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp, filename)
+
+    def lookup(self, local_file: str):
+        """Returns the entry of a local file if it is unchanged since recorded."""
+        entry = self.entries.get(path.basename(local_file))
+        st = os.stat(local_file)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+            return entry
+        return None
+
+    def record(self, local_file: str, sha256: str, remote_sha256: str):
+        """Adds or replaces the entry of a local file."""
+        st = os.stat(local_file)
+        entry = {
+            'filename': path.basename(local_file),
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'sha256': sha256,
+            'remote_sha256': remote_sha256,
+        }
+        with self._lock:
+            self.entries[entry['filename']] = entry
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+class HostLimiter:
+    """Caps the number of granules downloaded concurrently per host. A
+    granule holds one slot for all of its ``--segments`` streams."""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def __call__(self, url: str):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.limit)
+            return self._slots[host]
+
+
+class ScratchBudget:
+    """Caps the bytes of the granules on a scratch disk at once. A granule
+    is always let through when the disk holds no other granule, however
+    large it is.
+
+    Args:
+        limit (int): bytes of granules allowed on the disk at once
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes: int):
+        """Waits until nbytes more fit within the limit, and reserves them."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.used == 0 or self.used + nbytes <= self.limit)
+            self.used += nbytes
+
+    def release(self, nbytes: int):
+        """Frees nbytes reserved by acquire."""
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+
+def write_at(fd: int, data, offset: int):
+    """Writes data at an offset of a file descriptor, with pwrite where
+    available, so concurrent writers need no shared file position."""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            n = os.pwrite(fd, view, offset)
+        else:
+            # the descriptor is private to the writing thread
+            os.lseek(fd, offset, os.SEEK_SET)
+            n = os.write(fd, view)
+        view, offset = view[n:], offset + n
+
+
+class HashFrontier:
+    """Hashes a file front to back while its segments are written in any 
+    order. The hash reaches the end of the file as soon as the last 
+    segment is complete, reading the segments back from the page cache.
+
+    Args:
+        filename (str): path of the file being written
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        self._done = {}
+        self._lock = threading.Lock()
+
+    def complete(self, start: int, stop: int):
+        """Marks the bytes from start to stop as written, and hashes the 
+        segments that continue the hashed bytes."""
+        with self._lock:
+            self._done[start] = stop
+            if self.offset not in self._done:
+                return
+            with open(self.filename, 'rb') as f:
+                f.seek(self.offset)
+                while self.offset in self._done:
+                    stop = self._done.pop(self.offset)
+                    while self.offset < stop:
+                        data = f.read(min(CHUNK_SIZE, stop - self.offset))
+                        self.hasher.update(data)
+                        self.offset += len(data)
+
+
+def download_segments(url: str, part_file: str, session, m, streams: int, segment_size: int, chunk_size: int = CHUNK_SIZE):
+    """Downloads a granule to a preallocated ``.part`` file over several
+    concurrent streams, each fetching byte-range segments and writing them
+    in place. Completed segments are logged next to the ``.part`` file, so 
+    an interrupted download resumes with the missing segments, and a 
+    ``.part`` file of a single-stream download with its missing bytes.
+
+    Args:
+        url (str): url of the granule
+        part_file (str): full path of the .part file
+        session: EDLSession shared by the download threads
+        m (Counter): counts of the download stage
+        streams (int): number of concurrent streams
+        segment_size (int): bytes per segment
+        chunk_size (int): bytes read per iteration of a segment stream
+
+    Returns:
+        hashlib object of the granule, or None if the server ignores Range
+        requests
+    """
+    log_file = part_file + SEGMENTS_SUFFIX
+    lock = threading.Lock()
+    # the first segment also gives the size of the granule
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        m['requests'] += 1
+        m['retries'] += attempt > 1
+        try:
+            first = session.get(url, stream=True, headers={'Range': f'bytes=0-{segment_size - 1}'})
+            if first.status_code < 500 or attempt == MAX_ATTEMPTS:
+                break
+            first.close()
+        except requests.exceptions.ConnectionError:
+            if attempt == MAX_ATTEMPTS:
+                raise
+        time.sleep(2 ** attempt)
+    if first.status_code != 206:
+        # the single-stream download handles the errors and full responses,
+        # and cannot resume a preallocated .part file
+        first.close()
+        if path.isfile(log_file):
+            remove(log_file)
+            if path.isfile(part_file):
+                remove(part_file)
+        return None
+    size = int(first.headers['Content-Range'].rsplit('/', 1)[-1])
+    # the segments skip the redirects, e.g. to a signed S3 url
+    resolved = first.url
+
+    segments = [(start, min(start + segment_size, size)) for start in range(0, size, segment_size)]
+    written = {start: 0 for start, _ in segments}
+    if path.isfile(log_file) and not (path.isfile(part_file) and path.getsize(part_file) == size):
+        # the log of a removed or replaced .part file is stale, start from byte 0
+        remove(log_file)
+        if path.isfile(part_file):
+            remove(part_file)
+    if path.isfile(log_file):
+        with open(log_file) as f:
+            for line in f:
+                try:
+                    start, stop = (int(v) for v in line.split())
+                except ValueError:
+                    # partial line from an interrupted run
+                    continue
+                if start in written:
+                    written[start] = stop - start
+    elif path.isfile(part_file) and not path.isfile(log_file):
+        # the bytes of an interrupted single-stream download
+        prefix = min(path.getsize(part_file), size)
+        written = {start: max(min(prefix, stop) - start, 0) for start, stop in segments}
+
+    fd = os.open(part_file, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+    try:
+        if os.fstat(fd).st_size != size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+    frontier = HashFrontier(part_file)
+    with open(log_file, 'a') as log:
+        for start, stop in segments:
+            if written[start] == stop - start:
+                log.write(f"{start} {stop}\n")
+                frontier.complete(start, stop)
+        log.flush()
+
+        def fetch(start: int, stop: int, response=None):
+            offset = start + written[start]
+            target = resolved
+            fd = os.open(part_file, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                for attempt in range(1, MAX_ATTEMPTS + 1):
+                    try:
+                        if response is None:
+                            with lock:
+                                m['requests'] += 1
+                                m['retries'] += attempt > 1
+                            response = session.get(target, stream=True, headers={'Range': f'bytes={offset}-{stop - 1}'})
+                        with response:
+                            if response.status_code in (401, 403) and target != url:
+                                # the resolved url expired, the original one redirects again
+                                target = url
+                                raise requests.exceptions.ConnectionError(f"{response}")
+                            response.raise_for_status()
+                            if response.status_code != 206:
+                                raise Exception(f"{url} ignored the Range header of a segment")
+                            for chunk in response.iter_content(chunk_size=chunk_size):
+                                write_at(fd, chunk, offset)
+                                offset += len(chunk)
+                                with lock:
+                                    m['bytes'] += len(chunk)
+                        if offset < stop:
+                            raise requests.exceptions.ChunkedEncodingError(f"{stop - offset} bytes missing")
+                        break
+                    except requests.exceptions.HTTPError as e:
+                        if e.response.status_code < 500 or attempt == MAX_ATTEMPTS:
+                            raise Exception(f"{e.response}.\r\n Set up NASA Earthdata Login authentication at {EDL_AUTH}")
+                    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                        if attempt == MAX_ATTEMPTS:
+                            raise
+                    response = None
+                    time.sleep(2 ** attempt)
+            finally:
+                os.close(fd)
+            frontier.complete(start, stop)
+            with lock:
+                log.write(f"{start} {stop}\n")
+                log.flush()
+
+        pending = [(start, stop) for start, stop in segments if written[start] < stop - start]
+        if not pending or pending[0][0] != 0 or written[0]:
+            first.close()
+            first = None
+        if pending:
+            with ThreadPoolExecutor(max_workers=min(streams, len(pending))) as executor:
+                futures = [executor.submit(fetch, start, stop, first if start == 0 else None) for start, stop in pending]
+                for future in futures:
+                    future.result()
+    if frontier.offset != size:
+        raise Exception(f"{path.basename(part_file)} is incomplete")
+    return frontier.hasher
+
+
+def is_downloaded(local_file: str, session, manifest=None, **granule):
+    """Checks if a local granule matches the remote sha256 hash. Hashes 
+    already recorded in the manifest are reused instead of rehashing the 
+    file or requesting the remote hash again.
+
+    Args:
+        local_file (str): full path of local file
+        session: requests session to use
+        manifest (Manifest): manifest of the download directory, if any
+        granule (dict): granule url and sha256 
+
+    Returns:
+        bool: whether the local file is a complete copy of the granule
+    """
+    if not (path.isfile(local_file) and granule['sha256']):
+        return False
+    entry = manifest.lookup(local_file) if manifest else None
+    if entry and entry['remote_sha256']:
+        return entry['sha256'] == entry['remote_sha256']
+    if entry:
+        local = entry['sha256']
+    else:
+        with METRICS.stage('verify', path.basename(local_file), bytes=path.getsize(local_file)):
+            local = file_sha256(local_file).hexdigest()
+    remote = remote_sha256(granule['sha256'], session)
+    if manifest:
+        manifest.record(local_file, local, remote)
+    return local == remote
+
+
+def download_files(local_file: str, session, chunk_size: int = CHUNK_SIZE, host_limiter=None, manifest=None,
+                   segments: int = 1, segment_size: int = SEGMENT_SIZE_MB * 1024 ** 2, **granule):
+    """Downloads the granules.
+
+    The granule is streamed to a ``.part`` file next to ``local_file`` and
+    renamed once complete. An interrupted transfer, either from a previous 
+    run or a 5xx/connection error, is resumed with an HTTP Range request.
+    The sha256 hash is computed while streaming and checked against the 
+    remote hash once the download completes. With several segments, the 
+    granule is fetched in byte-range segments over concurrent streams by
+    download_segments instead.
+    
+    Args:
+        granule (dict): granule url and sha256 
+        local_file (str): full path of local file
+        session: EDLSession shared by the download threads
+        chunk_size (int): bytes read per iteration of the download stream
+        host_limiter (HostLimiter): per-host limit of the granules downloaded at once, if any
+        manifest (Manifest): manifest of the download directory, if any
+        segments (int): number of concurrent byte-range streams
+        segment_size (int): bytes per byte-range segment
+    """
+
+    if session is None:
+        session = EDLSession()
+    
+    if is_downloaded(local_file, session, manifest, **granule):
+        print(f'{path.basename(local_file)} is already downloaded at {path.dirname(local_file)}')
+        return
+
+    print(f'Downloading {path.basename(local_file)} ...')
+    part_file = local_file + PART_SUFFIX
+    slot = host_limiter(granule['url']) if host_limiter else contextlib.nullcontext()
+    with slot, METRICS.stage('download', path.basename(local_file)) as m:
+        hasher = None
+        if segments > 1 or path.isfile(part_file + SEGMENTS_SUFFIX):
+            hasher = download_segments(granule['url'], part_file, session, m, segments, segment_size, chunk_size)
+        if hasher is None:
+            hasher, hashed = hashlib.sha256(), 0
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                m['requests'] += 1
+                m['retries'] += attempt > 1
+                offset = path.getsize(part_file) if path.isfile(part_file) else 0
+                if hashed != offset:
+                    # hash the bytes already on disk before resuming
+                    hasher, hashed = file_sha256(part_file), offset
+                headers = {'Range': f'bytes={offset}-'} if offset else {}
+                try:
+                    with session.get(granule['url'], stream=True, headers=headers) as r:
+                        if r.status_code == 416:
+                            # .part file already holds the full granule
+                            break
+                        r.raise_for_status()
+                        mode = 'ab'
+                        if r.status_code != 206:
+                            # server ignored the Range header, start over
+                            mode, hasher, hashed = 'wb', hashlib.sha256(), 0
+                        with open(part_file, mode) as f:
+                            for chunk in r.iter_content(chunk_size=chunk_size):
+                                f.write(chunk)
+                                hasher.update(chunk)
+                                hashed += len(chunk)
+                                m['bytes'] += len(chunk)
+                    break
+                except requests.exceptions.HTTPError as e:
+                    if e.response.status_code < 500 or attempt == MAX_ATTEMPTS:
+                        raise Exception(f"{e.response}.\r\n Set up NASA Earthdata Login authentication at {EDL_AUTH}")
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                    if attempt == MAX_ATTEMPTS:
+                        raise
+                print(f'Resuming {path.basename(local_file)} (attempt {attempt + 1}/{MAX_ATTEMPTS}) ...')
+                time.sleep(2 ** attempt)
+
+    local = hasher.hexdigest()
+    remote = remote_sha256(granule['sha256'], session) if granule['sha256'] else ''
+    if path.isfile(part_file + SEGMENTS_SUFFIX):
+        remove(part_file + SEGMENTS_SUFFIX)
+    if remote and local != remote:
+        remove(part_file)
+        raise Exception(f"sha256 of {path.basename(local_file)} does not match {granule['sha256']}")
+    os.replace(part_file, local_file)
+    if manifest:
+        manifest.record(local_file, local, remote)
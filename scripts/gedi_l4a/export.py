@@ -0,0 +1,396 @@
+"""Streaming export of GEDI subsets to tabular formats.
+
+Subsets are written one batch at a time, of up to a number of shots of one
+BEAM group of one granule, so memory use does not grow with the number of 
+shots exported.
+"""
+import json
+import os
+import numpy as np
+from gedi_l4a.h5utils import memory_window, subset_filename
+
+FORMATS = ['parquet', 'geoparquet', 'fgb']
+PARQUET_COMPRESSION = 'zstd'
+ROW_GROUP_SIZE = 100000
+
+
+def _add_column(columns: dict, name: str, values):
+    # xvar variables have 2D
+    if name.startswith('xvar') and values.ndim == 2:
+        for r in range(values.shape[1]):
+            columns[name + '_' + str(r + 1)] = values[:, r]
+    elif values.dtype.kind == 'S':
+        columns[name] = values.astype(str)
+    else:
+        columns[name] = values
+
+
+def beam_columns(beam, rows=slice(None), skip: list = ()):
+    """Reads the datasets of a BEAM group as numpy columns. Datasets of the
+    subgroups are flattened, except their duplicate ``shot_number``.
+
+    Args:
+        beam (h5py.Group): BEAM group of a subset h5 file
+        rows (slice): rows of the datasets to read
+        skip (list): names of the datasets of the group not to read
+
+    Returns:
+        dict: column name to numpy array
+    """
+    import h5py
+
+    columns = {}
+    for key, value in beam.items():
+        # looping through subgroups
+        if isinstance(value, h5py.Group):
+            for key2, value2 in value.items():
+                if (key2 != "shot_number"):
+                    _add_column(columns, key2, value2[rows])
+        #looping through base group
+        elif key not in skip:
+            _add_column(columns, key, value[rows])
+    return columns
+
+
+def consolidated_batches(hf_in, batch_size: int = ROW_GROUP_SIZE, memory_mb: float = None):
+    """Yields the shots of a consolidated subset h5 file in DataFrames of up
+    to batch_size rows, with the same columns as those of ``subset_batches``.
+
+    Args:
+        hf_in (h5py.File): consolidated subset h5 file
+        batch_size (int): number of rows per DataFrame
+        memory_mb (float): memory ceiling in MB of a DataFrame, if any
+
+    Yields:
+        pandas DataFrame with the subset file name, BEAM name and datasets of
+        shots
+    """
+    import pandas as pd
+    from gedi_l4a.consolidate import INDEX_COLUMNS, SHOTS
+
+    shots = hf_in[SHOTS]
+    # named after the subset h5 files of the granules, as by subset_batches
+    granules = np.array([subset_filename(g) for g in hf_in['granules'].asstr()[()]], dtype=object)
+    beams = hf_in['beams'].asstr()[()]
+    # no index columns until the first shot is appended
+    if 'granule_index' not in shots:
+        return
+    nshots = len(shots['granule_index'])
+    batch_size = memory_window(shots, memory_mb, window=batch_size)
+    for start in range(0, nshots, batch_size):
+        rows = slice(start, min(start + batch_size, nshots))
+        columns = beam_columns(shots, rows, skip=INDEX_COLUMNS)
+        batch_df = pd.DataFrame(columns, copy=False)
+        batch_df.insert(0, 'BEAM', beams[shots['beam_index'][rows]])
+        batch_df.insert(0, 'filename', granules[shots['granule_index'][rows]])
+        yield batch_df
+
+
+def subset_batches(subfiles, batch_size: int = ROW_GROUP_SIZE, memory_mb: float = None):
+    """Yields DataFrames of up to batch_size shots of the BEAM groups of the
+    subset h5 files, or of the shots of consolidated subset h5 files.
+
+    Args:
+        subfiles (list): paths of subset h5 files
+        batch_size (int): maximum number of rows per DataFrame
+        memory_mb (float): memory ceiling in MB of a DataFrame, if any
+
+    Yields:
+        pandas DataFrame with the filename, BEAM name and datasets of shots
+    """
+    import h5py
+    import pandas as pd
+    from gedi_l4a.consolidate import is_consolidated
+
+    for subfile in subfiles:
+        with h5py.File(subfile, 'r') as hf_in:
+            if is_consolidated(hf_in):
+                yield from consolidated_batches(hf_in, batch_size, memory_mb)
+                continue
+            for v in list(hf_in.keys()):
+                if v.startswith('BEAM'):
+                    beam = hf_in[v]
+                    size = memory_window(beam, memory_mb, window=batch_size)
+                    nshots = len(beam['shot_number'])
+                    for start in range(0, nshots, size):
+                        columns = beam_columns(beam, slice(start, start + size))
+                        rows = len(next(iter(columns.values())))
+                        beam_df = pd.DataFrame(columns, copy=False)
+                        # Inserting BEAM names
+                        beam_df.insert(0, 'BEAM', np.full(rows, v))
+                        beam_df.insert(0, 'filename', np.full(rows, subfile.rsplit('/', 1)[-1]))
+                        yield beam_df
+
+
+def _point_wkb(pa, df, lon: str, lat: str):
+    """Arrow binary array of the WKB points of the lon, lat columns of df."""
+    import shapely
+
+    points = shapely.points(df[lon].to_numpy(), df[lat].to_numpy())
+    return pa.array(shapely.to_wkb(points), pa.binary())
+
+
+def _unify_schemas(pa, schema, other):
+    """Schema with the columns of both schemas, in the order they first
+    appear, of types that hold the values of both, e.g. float64 for int8 
+    and float64 columns. A ``geometry`` column stays the last one."""
+    schema = pa.unify_schemas([schema, other], promote_options='permissive')
+    if 'geometry' in schema.names:
+        i = schema.get_field_index('geometry')
+        schema = schema.remove(i).append(schema.field(i))
+    return schema
+
+
+def _conform(pa, table, schema):
+    """Table with the columns of a schema, of its types. Columns the table
+    does not have are null."""
+    columns = [table[f.name].cast(f.type) if f.name in table.column_names else pa.nulls(len(table), f.type)
+               for f in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class CSVWriter:
+    """Appends batches of rows to a CSV file. The header has the columns of
+    all batches in the order they first appear, as a concatenation of the
+    batches would have; rows of batches without a column leave it empty.
+    Columns that only appear after the first batch are added to the header,
+    and to the rows written before them, when the writer is closed."""
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.columns = None
+        # number of rows of each batch, and of columns when it was written
+        self._batches = []
+
+    def write(self, df):
+        if self.columns is None:
+            self.columns = list(df.columns)
+            df.to_csv(self.filename, index=False)
+        else:
+            known = set(self.columns)
+            self.columns += [c for c in df.columns if c not in known]
+            df.reindex(columns=self.columns).to_csv(self.filename, mode='a', index=False, header=False)
+        self._batches.append((len(df), len(self.columns)))
+
+    def close(self):
+        if self.columns is None or all(width == len(self.columns) for _, width in self._batches):
+            return
+        import pandas as pd
+
+        # rewrites the header, and pads the rows of the earlier batches
+        tmp_file = self.filename + '.tmp'
+        with open(self.filename, newline='') as src, open(tmp_file, 'w', newline='') as dst:
+            src.readline()
+            pd.DataFrame(columns=self.columns).to_csv(dst, index=False)
+            for nrows, width in self._batches:
+                pad = ',' * (len(self.columns) - width)
+                for _ in range(nrows):
+                    line = src.readline()
+                    row = line.rstrip('\r\n')
+                    dst.write(row + pad + line[len(row):])
+        os.replace(tmp_file, self.filename)
+
+
+class GeoJSONWriter:
+    """Streams batches of rows to a GeoJSON FeatureCollection of points,
+    located by their ``lon_lowestmode`` and ``lat_lowestmode`` columns."""
+    def __init__(self, filename: str, lon: str = 'lon_lowestmode', lat: str = 'lat_lowestmode'):
+        self.filename = filename
+        self.lon = lon
+        self.lat = lat
+        self._f = None
+
+    def write(self, df):
+        if self._f is None:
+            self._f = open(self.filename, 'w')
+            self._f.write('{"type": "FeatureCollection", "features": [\n')
+            sep = ''
+        else:
+            sep = ',\n'
+        properties = df.to_json(orient='records', lines=True, double_precision=15).splitlines()
+        coordinates = zip(df[self.lon].tolist(), df[self.lat].tolist())
+        self._f.write(sep + ',\n'.join(
+            f'{{"type": "Feature", "properties": {p}, "geometry": {{"type": "Point", "coordinates": [{json.dumps(x)}, {json.dumps(y)}]}}}}'
+            for p, (x, y) in zip(properties, coordinates)
+        ))
+
+    def close(self):
+        if self._f is not None:
+            self._f.write('\n]}\n')
+            self._f.close()
+
+
+class ParquetWriter:
+    """Appends batches of rows to a Parquet file with typed columns. Batches
+    are buffered until a row group is full. With ``geometry`` set, points 
+    are added as a WKB ``geometry`` column with GeoParquet metadata.
+
+    Columns of a batch that are missing from the file, or whose type does 
+    not hold the values of the batch, start a new segment file with the 
+    columns of all batches; columns a batch does not have are null. The 
+    segments are rewritten to the file when the writer is closed.
+
+    Args:
+        filename (str): output file name
+        compression (str): Parquet compression codec
+        row_group_size (int): number of rows per row group
+        geometry (bool): write GeoParquet
+    """
+    def __init__(self, filename: str, compression: str = PARQUET_COMPRESSION, row_group_size: int = ROW_GROUP_SIZE,
+                 geometry: bool = False, lon: str = 'lon_lowestmode', lat: str = 'lat_lowestmode'):
+        # pyarrow is only needed for Parquet outputs
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.filename = filename
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.geometry = geometry
+        self.lon = lon
+        self.lat = lat
+        self._writer = None
+        self._schema = None
+        # files of the batches written before the schema last changed
+        self._segments = []
+        self._buffer = []
+        self._nrows = 0
+
+    def _table(self, df):
+        table = self._pa.Table.from_pandas(df, preserve_index=False)
+        if self.geometry:
+            table = table.append_column('geometry', _point_wkb(self._pa, df, self.lon, self.lat))
+        return table
+
+    def _open(self, schema):
+        self._schema = schema
+        if self.geometry:
+            geo = {
+                'version': '1.0.0',
+                'primary_column': 'geometry',
+                'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point']}},
+            }
+            schema = schema.with_metadata(dict(schema.metadata or {}, geo=json.dumps(geo)))
+        self._writer = self._pq.ParquetWriter(self.filename, schema, compression=self.compression)
+
+    def _close_segment(self):
+        if self._buffer:
+            self._flush(final=True)
+        self._writer.close()
+        segment = f"{self.filename}.{len(self._segments)}"
+        os.replace(self.filename, segment)
+        self._segments.append(segment)
+
+    def _flush(self, final: bool = False):
+        table = self._pa.concat_tables(self._buffer)
+        n = len(table) if final else len(table) - len(table) % self.row_group_size
+        if n > 0:
+            self._writer.write_table(table.slice(0, n), row_group_size=self.row_group_size)
+        self._buffer = [table.slice(n)] if n < len(table) else []
+        self._nrows = len(table) - n
+
+    def _append(self, table):
+        self._buffer.append(_conform(self._pa, table, self._schema))
+        self._nrows += len(table)
+        if self._nrows >= self.row_group_size:
+            self._flush()
+
+    def write(self, df):
+        table = self._table(df)
+        if self._writer is None:
+            self._open(table.schema)
+        else:
+            schema = _unify_schemas(self._pa, self._schema, table.schema)
+            if not schema.equals(self._schema):
+                self._close_segment()
+                self._open(schema)
+        self._append(table)
+
+    def close(self):
+        if self._writer is None:
+            return
+        if self._segments:
+            # rewriting the segments with the columns of all batches
+            self._close_segment()
+            self._open(self._schema)
+            for segment in self._segments:
+                for batch in self._pq.ParquetFile(segment).iter_batches(batch_size=self.row_group_size):
+                    self._append(self._pa.Table.from_batches([batch]))
+                os.remove(segment)
+            self._segments = []
+        if self._buffer:
+            self._flush(final=True)
+        self._writer.close()
+
+
+class FlatGeobufWriter:
+    """Writes batches of rows to a FlatGeobuf file of points. Batches are 
+    spooled to temporary Arrow files, then streamed to GDAL on close, as
+    FlatGeobuf files cannot be appended to without being rewritten. A new 
+    spool file is started when a batch adds columns or widens their type, 
+    the columns a batch does not have are null in the FlatGeobuf file.
+
+    Args:
+        filename (str): output file name
+    """
+    def __init__(self, filename: str, lon: str = 'lon_lowestmode', lat: str = 'lat_lowestmode'):
+        import pyarrow
+        import pyarrow.ipc
+        self._pa = pyarrow
+        self.filename = filename
+        self.lon = lon
+        self.lat = lat
+        self._spools = []
+        self._writer = None
+        self._schema = None
+
+    def write(self, df):
+        # OGR has no unsigned 64-bit field type, shot numbers fit in int64
+        df = df.astype({c: 'int64' for c, t in df.dtypes.items() if t == np.uint64})
+        table = self._pa.Table.from_pandas(df, preserve_index=False)
+        table = table.append_column('geometry', _point_wkb(self._pa, df, self.lon, self.lat))
+        schema = table.schema if self._schema is None else _unify_schemas(self._pa, self._schema, table.schema)
+        if self._schema is None or not schema.equals(self._schema):
+            if self._writer is not None:
+                self._writer.close()
+            self._schema = schema
+            spool = f"{self.filename}.{len(self._spools)}.arrow"
+            self._writer = self._pa.ipc.new_file(spool, self._schema)
+            self._spools.append(spool)
+        self._writer.write_table(_conform(self._pa, table, self._schema))
+
+    def _batches(self):
+        for spool in self._spools:
+            with self._pa.memory_map(spool) as source:
+                reader = self._pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    table = self._pa.Table.from_batches([reader.get_batch(i)])
+                    yield from _conform(self._pa, table, self._schema).to_batches()
+
+    def close(self):
+        if self._writer is None:
+            return
+        import pyogrio
+        self._writer.close()
+        reader = self._pa.RecordBatchReader.from_batches(self._schema, self._batches())
+        pyogrio.write_arrow(reader, self.filename, driver='FlatGeobuf', geometry_name='geometry',
+                            geometry_type='Point', crs='EPSG:4326')
+        for spool in self._spools:
+            os.remove(spool)
+
+
+def open_writer(fmt: str, filename: str, compression: str = PARQUET_COMPRESSION, row_group_size: int = ROW_GROUP_SIZE):
+    """Creates a batch writer for one of the FORMATS.
+
+    Args:
+        fmt (str): parquet, geoparquet or fgb
+        filename (str): output file name, without extension
+        compression (str): Parquet compression codec
+        row_group_size (int): number of rows per Parquet row group
+
+    Returns:
+        writer with ``write(df)`` and ``close()`` methods
+    """
+    if fmt == 'fgb':
+        return FlatGeobufWriter(filename + '.fgb')
+    return ParquetWriter(filename + '.parquet', compression=compression, row_group_size=row_group_size,
+                         geometry=(fmt == 'geoparquet'))
@@ -0,0 +1,146 @@
+"""Shot filters on the datasets of GEDI BEAM groups.
+
+A filter is a comparison of a dataset with a value, e.g.
+``l4_quality_flag==1``, ``sensitivity>=0.95`` or ``agbd!=_FillValue``,
+where ``_FillValue`` stands for the fill value attribute of the dataset.
+Values are numbers, quoted strings or ``_FillValue``.
+Filters are evaluated on the shots within the area of interest only,
+before the other datasets are read.
+"""
+import operator
+import re
+import numpy as np
+from gedi_l4a.h5utils import read_indices
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+}
+FILL_VALUE = '_FillValue'
+
+
+def _unquote(value: str):
+    # the string within single or double quotes, None if value is not quoted
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '\'"':
+        return value[1:-1]
+    return None
+
+
+class Filter:
+    """Comparison of a BEAM dataset with a value.
+
+    Args:
+        variable (str): dataset path relative to the BEAM group, e.g.
+        ``land_cover_data/pft_class``
+        op (str): comparison operator, one of ``==, !=, >=, <=, >, <``
+        value (str): number, quoted string, or ``_FillValue``
+    """
+    def __init__(self, variable: str, op: str, value: str):
+        self.variable = variable
+        self.op = op
+        self.value = value
+
+    @classmethod
+    def parse(cls, expr: str):
+        """Parses a filter expression such as ``l4_quality_flag==1``.
+
+        Raises:
+            ValueError: the expression is not a comparison, or its value is
+            not a number, a quoted string or ``_FillValue``
+        """
+        m = re.fullmatch(r'\s*([\w/]+)\s*(==|!=|>=|<=|>|<)\s*(\S+)\s*', expr)
+        if m is None:
+            raise ValueError(f"not a filter expression: {expr}")
+        value = m.group(3)
+        if value != FILL_VALUE and _unquote(value) is None:
+            try:
+                float(value)
+            except ValueError:
+                raise ValueError(f"not a number, a quoted string or {FILL_VALUE}: {value}")
+        return cls(*m.groups())
+
+    def __repr__(self):
+        return f"{self.variable}{self.op}{self.value}"
+
+    def _value(self, dataset):
+        if self.value == FILL_VALUE:
+            if FILL_VALUE not in dataset.attrs:
+                raise ValueError(f"{dataset.name} has no {FILL_VALUE}")
+            return dataset.attrs[FILL_VALUE]
+        string = _unquote(self.value)
+        if dataset.dtype.kind == 'S':
+            return (self.value if string is None else string).encode()
+        if string is not None:
+            raise ValueError(f"cannot compare {dataset.name} of numbers with a string")
+        return float(self.value)
+
+    def mask(self, beam, indices):
+        """Evaluates the filter on the shots at indices of a BEAM group.
+
+        Args:
+            beam (h5py.Group): BEAM group
+            indices (array): sorted indices of the shots
+
+        Returns:
+            array: boolean mask of the shots that pass the filter
+
+        Raises:
+            KeyError: the BEAM group has no such dataset
+            ValueError: the dataset has more than one value per shot
+        """
+        dataset = beam[self.variable]
+        if dataset.ndim != 1:
+            raise ValueError(f"cannot filter on {dataset.name} with {dataset.ndim} dimensions")
+        return OPERATORS[self.op](read_indices(dataset, indices), self._value(dataset))
+
+    def compare(self, values, fill_value=None):
+        """Evaluates the filter on the values of a table column, e.g. of a
+        CSV or Parquet export.
+
+        Args:
+            values (array): column values
+            fill_value: value ``_FillValue`` stands for
+
+        Returns:
+            array: boolean mask of the values that pass the filter
+
+        Raises:
+            ValueError: the filter compares with ``_FillValue`` and there is
+            no fill_value
+        """
+        values = np.asarray(values)
+        if self.value == FILL_VALUE:
+            if fill_value is None:
+                raise ValueError(f"{self.variable} has no {FILL_VALUE}")
+            value = fill_value
+        elif values.dtype.kind in 'OSU':
+            string = _unquote(self.value)
+            value = self.value if string is None else string
+            values = values.astype(str)
+        else:
+            value = float(self.value)
+        return OPERATORS[self.op](values, value)
+
+
+def filter_indices(beam, indices, filters: list):
+    """Keeps the shots at indices of a BEAM group that pass all filters.
+    Each filter only reads the shots that passed the previous ones.
+
+    Args:
+        beam (h5py.Group): BEAM group
+        indices (array): sorted indices of the shots
+        filters (list): Filter objects
+
+    Returns:
+        array: sorted indices of the shots that pass the filters
+    """
+    indices = np.asarray(indices)
+    for f in filters:
+        if len(indices) == 0:
+            break
+        indices = indices[f.mask(beam, indices)]
+    return indices
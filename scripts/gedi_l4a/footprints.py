@@ -0,0 +1,140 @@
+"""Sidecar spatial index of the footprints of downloaded GEDI granules."""
+import os
+import h5py
+import numpy as np
+import shapely
+from os import path
+
+INDEX_NAME = ".gedi_index.npz"
+SEGMENT_SIZE = 1000 # shots per track segment
+
+SEGMENT_DTYPE = np.dtype([
+    ('granule', 'u4'), ('beam', 'S8'), ('start', 'u4'), ('stop', 'u4'),
+    ('minx', 'f8'), ('miny', 'f8'), ('maxx', 'f8'), ('maxy', 'f8'),
+])
+
+
+def granule_segments(infile: str, segment_size: int = SEGMENT_SIZE):
+    """Splits the beam tracks of a granule into segments of shots.
+
+    Args:
+        infile (str): path of the h5 file
+        segment_size (int): number of shots per segment
+
+    Returns:
+        array: SEGMENT_DTYPE array with the shot index range and bounding 
+        box of each segment
+    """
+    segments = []
+    with h5py.File(infile, 'r') as hf_in:
+        for v in list(hf_in.keys()):
+            if v.startswith('BEAM'):
+                lat = hf_in[v]['lat_lowestmode'][:]
+                lon = hf_in[v]['lon_lowestmode'][:]
+                if len(lat) == 0:
+                    continue
+                starts = np.arange(0, len(lat), segment_size)
+                seg = np.zeros(len(starts), dtype=SEGMENT_DTYPE)
+                seg['beam'] = v
+                seg['start'] = starts
+                seg['stop'] = np.minimum(starts + segment_size, len(lat))
+                # fmin/fmax skip NaN coordinates
+                seg['minx'] = np.fmin.reduceat(lon, starts)
+                seg['miny'] = np.fmin.reduceat(lat, starts)
+                seg['maxx'] = np.fmax.reduceat(lon, starts)
+                seg['maxy'] = np.fmax.reduceat(lat, starts)
+                segments.append(seg)
+    return np.concatenate(segments) if segments else np.zeros(0, dtype=SEGMENT_DTYPE)
+
+
+class FootprintIndex:
+    """Index of the beam track segments of the h5 files in a directory, 
+    stored as a compact binary sidecar file in the directory. Files are 
+    indexed once and re-indexed only when their size or mtime changes.
+
+    Args:
+        indir (str): directory with the h5 files
+        segment_size (int): number of shots per track segment
+    """
+    def __init__(self, indir: str, segment_size: int = SEGMENT_SIZE):
+        self.indir = indir
+        self.filename = path.join(indir, INDEX_NAME)
+        self.segment_size = segment_size
+        # filename -> (size, mtime, segments)
+        self.granules = {}
+        if path.isfile(self.filename):
+            with np.load(self.filename) as npz:
+                if int(npz['segment_size']) == segment_size:
+                    segments = npz['segments']
+                    order = np.argsort(segments['granule'], kind='stable')
+                    bounds = np.searchsorted(segments['granule'][order], np.arange(len(npz['names']) + 1))
+                    for k, (name, size, mtime) in enumerate(zip(npz['names'], npz['sizes'], npz['mtimes'])):
+                        self.granules[str(name)] = (int(size), int(mtime), segments[order[bounds[k]:bounds[k + 1]]])
+
+    def update(self, files: list, map=map):
+        """Indexes new or changed files, and drops the files that are no
+        longer in the directory. Indexed files that are not listed, e.g.
+        granules a journaled run skips, are kept.
+
+        Args:
+            files (list): paths of the h5 files
+            map: map function used to index the files, e.g., of a process pool
+        """
+        stats = {path.basename(f): os.stat(f) for f in files}
+        stale = [f for f in files if self.granules.get(path.basename(f), (None, None))[:2]
+                 != (stats[path.basename(f)].st_size, stats[path.basename(f)].st_mtime_ns)]
+        removed = [k for k in self.granules if k not in stats and not path.isfile(path.join(self.indir, k))]
+        changed = len(stale) > 0 or len(removed) > 0
+        for f, segments in zip(stale, map(granule_segments, stale, [self.segment_size] * len(stale))):
+            st = stats[path.basename(f)]
+            self.granules[path.basename(f)] = (st.st_size, st.st_mtime_ns, segments)
+        for k in removed:
+            del self.granules[k]
+        if changed:
+            self.save()
+
+    def save(self):
+        names = list(self.granules)
+        segments = [self.granules[name][2].copy() for name in names]
+        for k, seg in enumerate(segments):
+            seg['granule'] = k
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f, segment_size=self.segment_size, names=np.array(names, dtype=str),
+                sizes=np.array([self.granules[n][0] for n in names], dtype=np.int64),
+                mtimes=np.array([self.granules[n][1] for n in names], dtype=np.int64),
+                segments=np.concatenate(segments) if segments else np.zeros(0, dtype=SEGMENT_DTYPE),
+            )
+        os.replace(tmp, self.filename)
+
+    def candidates(self, infile: str, aoi):
+        """Get the shot index ranges of a granule that may be within the area
+        of interest, from the segments whose bounding box intersects it.
+
+        Args:
+            infile (str): path of an indexed h5 file
+            aoi (AOI): area of interest
+
+        Returns:
+            dict: beam name to (n, 2) array of [start, stop) shot ranges; 
+            empty if no beam of the granule crosses the area of interest
+        """
+        segments = self.granules[path.basename(infile)][2]
+        minx, miny, maxx, maxy = aoi.bounds
+        segments = segments[(segments['maxx'] >= minx) & (segments['minx'] <= maxx)
+                            & (segments['maxy'] >= miny) & (segments['miny'] <= maxy)]
+        if len(segments) > 0:
+            boxes = shapely.box(segments['minx'], segments['miny'], segments['maxx'], segments['maxy'])
+            # boxes of a single shot or an axis-aligned run are degenerate
+            degenerate = (segments['minx'] == segments['maxx']) | (segments['miny'] == segments['maxy'])
+            segments = segments[degenerate | shapely.intersects(aoi.geometry, boxes)]
+        ranges = {}
+        for beam in np.unique(segments['beam']):
+            seg = segments[segments['beam'] == beam]
+            # joining adjacent segments
+            breaks = np.flatnonzero(seg['start'][1:] != seg['stop'][:-1])
+            starts = seg['start'][np.r_[0, breaks + 1]]
+            stops = seg['stop'][np.r_[breaks, len(seg) - 1]]
+            ranges[beam.decode()] = np.column_stack([starts, stops]).astype(np.int64)
+        return ranges
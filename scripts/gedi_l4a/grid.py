@@ -0,0 +1,254 @@
+"""Gridded statistics of GEDI shots.
+
+Shots are binned into the cells of a global grid, either regular in
+latitude and longitude or the EASE-Grid 2.0 global equal-area grid
+(EPSG:6933) of the GEDI L4B product. ``GridStats`` holds the count, mean
+and sum of squared deviations (M2) of a variable in each occupied cell;
+statistics of separate batches, granules or processes merge exactly, so
+partial aggregates can be computed in parallel and reduced in any order.
+"""
+import numpy as np
+
+GRIDS = ['latlon', 'ease2']
+LATLON_RESOLUTION = 0.1 # degrees
+EASE2_RESOLUTION = 1000.89502334956 # meters, the 1 km EASE-Grid 2.0 of GEDI L4B
+# WGS84 ellipsoid, and the extent and standard parallel of EASE-Grid 2.0
+WGS84_A = 6378137.0
+WGS84_E = 0.0818191908426215
+EASE2_XMAX = 17367530.445161376
+EASE2_YMAX = 7314540.830638504
+EASE2_LAT_TS = 30.0
+RASTER_BAND_CELLS = 2 ** 22 # cells of the bands of rows of netCDF rasters written at once
+
+
+def ease2_xy(lat, lon):
+    """Projects coordinates to EASE-Grid 2.0 global x and y in meters,
+    the cylindrical equal-area projection of the WGS84 ellipsoid with a
+    standard parallel at 30 degrees."""
+    e = WGS84_E
+    sin_ts = np.sin(np.radians(EASE2_LAT_TS))
+    k0 = np.cos(np.radians(EASE2_LAT_TS)) / np.sqrt(1 - e ** 2 * sin_ts ** 2)
+    sin_lat = np.sin(np.radians(lat))
+    q = (1 - e ** 2) * (sin_lat / (1 - e ** 2 * sin_lat ** 2)
+                        - np.log((1 - e * sin_lat) / (1 + e * sin_lat)) / (2 * e))
+    return WGS84_A * k0 * np.radians(lon), WGS84_A * q / (2 * k0)
+
+
+class Grid:
+    """Global grid of square cells, numbered row by row from the north-west
+    corner.
+
+    Args:
+        kind (str): latlon, cells of resolution degrees from 180W 90N, or
+        ease2, cells of resolution meters of EASE-Grid 2.0 global
+        resolution (float): cell size, LATLON_RESOLUTION or
+        EASE2_RESOLUTION if None
+    """
+    def __init__(self, kind: str = 'latlon', resolution: float = None):
+        if kind not in GRIDS:
+            raise ValueError(f"unknown grid {kind}, not one of {', '.join(GRIDS)}")
+        self.kind = kind
+        self.resolution = resolution or (LATLON_RESOLUTION if kind == 'latlon' else EASE2_RESOLUTION)
+        if self.resolution <= 0:
+            raise ValueError("the grid resolution must be positive")
+        self.xmin, self.ymax = (-180.0, 90.0) if kind == 'latlon' else (-EASE2_XMAX, EASE2_YMAX)
+        width, height = (360.0, 180.0) if kind == 'latlon' else (2 * EASE2_XMAX, 2 * EASE2_YMAX)
+        self.shape = (int(np.ceil(height / self.resolution - 1e-9)), int(np.ceil(width / self.resolution - 1e-9)))
+
+    def cells(self, lat, lon):
+        """Flat indices of the cells of coordinates, -1 for invalid ones.
+
+        Args:
+            lat (array): latitudes in degrees
+            lon (array): longitudes in degrees
+
+        Returns:
+            array: int64 cell indices
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        x, y = (lon, lat) if self.kind == 'latlon' else ease2_xy(lat, lon)
+        with np.errstate(invalid='ignore'):
+            col = np.floor((x - self.xmin) / self.resolution)
+            row = np.floor((self.ymax - y) / self.resolution)
+            # the east and south edges belong to the last cells
+            col = np.minimum(col, self.shape[1] - 1)
+            row = np.minimum(row, self.shape[0] - 1)
+            valid = (col >= 0) & (row >= 0) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+        cells = np.full(len(lat), -1, dtype=np.int64)
+        cells[valid] = row[valid].astype(np.int64) * self.shape[1] + col[valid].astype(np.int64)
+        return cells
+
+    def centers(self, rows, cols):
+        """Cell center y (latitude or meters) of rows and x (longitude or
+        meters) of columns."""
+        return (self.ymax - (np.asarray(rows) + 0.5) * self.resolution,
+                self.xmin + (np.asarray(cols) + 0.5) * self.resolution)
+
+
+def _std(count, m2):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 1, np.sqrt(m2 / np.maximum(count - 1, 1)), np.nan)
+
+
+class GridStats:
+    """Count, mean and M2 of a variable in the occupied cells of a grid.
+
+    Args:
+        cells (array): sorted unique flat cell indices
+        count (array): number of values of each cell
+        mean (array): mean of each cell
+        m2 (array): sum of the squared deviations from the mean of each cell
+    """
+    def __init__(self, cells=None, count=None, mean=None, m2=None):
+        self.cells = np.empty(0, dtype=np.int64) if cells is None else np.asarray(cells, dtype=np.int64)
+        self.count = np.empty(0, dtype=np.int64) if count is None else np.asarray(count, dtype=np.int64)
+        self.mean = np.empty(0) if mean is None else np.asarray(mean, dtype=np.float64)
+        self.m2 = np.empty(0) if m2 is None else np.asarray(m2, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.cells)
+
+    @classmethod
+    def from_values(cls, cells, values):
+        """Statistics of values binned into cells; cells of -1 are skipped."""
+        cells = np.asarray(cells)
+        values = np.asarray(values, dtype=np.float64)
+        keep = cells >= 0
+        cells, values = cells[keep], values[keep]
+        unique, inverse = np.unique(cells, return_inverse=True)
+        count = np.bincount(inverse, minlength=len(unique))
+        mean = np.bincount(inverse, values, minlength=len(unique)) / np.maximum(count, 1)
+        m2 = np.bincount(inverse, (values - mean[inverse]) ** 2, minlength=len(unique))
+        return cls(unique, count, mean, m2)
+
+    @classmethod
+    def reduce(cls, parts):
+        """Merges the statistics of several parts: the mean is the weighted
+        mean of the means, and M2 adds the deviations of the part means
+        from it to the M2 of the parts."""
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls()
+        if len(parts) == 1:
+            return parts[0]
+        cells = np.concatenate([p.cells for p in parts])
+        count = np.concatenate([p.count for p in parts])
+        mean = np.concatenate([p.mean for p in parts])
+        m2 = np.concatenate([p.m2 for p in parts])
+        unique, inverse = np.unique(cells, return_inverse=True)
+        total = np.bincount(inverse, count, minlength=len(unique))
+        merged_mean = np.bincount(inverse, count * mean, minlength=len(unique)) / total
+        merged_m2 = np.bincount(inverse, m2 + count * (mean - merged_mean[inverse]) ** 2, minlength=len(unique))
+        return cls(unique, total.astype(np.int64), merged_mean, merged_m2)
+
+    def merge(self, other):
+        """Statistics of the values of both self and other."""
+        return GridStats.reduce([self, other])
+
+    @property
+    def std(self):
+        """Sample standard deviation of each cell, NaN for single values."""
+        return _std(self.count, self.m2)
+
+    @property
+    def se(self):
+        """Standard error of the mean of each cell, NaN for single values."""
+        return self.std / np.sqrt(np.maximum(self.count, 1))
+
+    def window(self, grid: Grid):
+        """Rows and columns of the window of the grid that bounds the
+        occupied cells, a single cell if there are none.
+
+        Returns:
+            tuple: first row, last row + 1, first column, last column + 1
+        """
+        if len(self) == 0:
+            return 0, 1, 0, 1
+        rows, cols = np.divmod(self.cells, grid.shape[1])
+        return rows[0], rows[-1] + 1, cols.min(), cols.max() + 1
+
+    def raster(self, grid: Grid, rows: tuple, cols: tuple):
+        """Dense arrays of the statistics of a window of the grid.
+
+        Args:
+            grid (Grid): grid of the cells
+            rows (tuple): first row and last row + 1 of the window
+            cols (tuple): first column and last column + 1 of the window
+
+        Returns:
+            dict: count, mean, std and se arrays of the window; empty cells
+            have a count of 0 and NaN statistics
+        """
+        shape = (rows[1] - rows[0], cols[1] - cols[0])
+        arrays = {'count': np.zeros(shape, dtype=np.uint32)}
+        for k in ['mean', 'std', 'se']:
+            arrays[k] = np.full(shape, np.nan, dtype=np.float32)
+        # the cells are sorted by row
+        lo, hi = np.searchsorted(self.cells, [rows[0] * grid.shape[1], rows[1] * grid.shape[1]])
+        r, c = np.divmod(self.cells[lo:hi], grid.shape[1])
+        inside = (c >= cols[0]) & (c < cols[1])
+        r, c = r[inside] - rows[0], c[inside] - cols[0]
+        count, m2 = self.count[lo:hi][inside], self.m2[lo:hi][inside]
+        std = _std(count, m2)
+        arrays['count'][r, c] = count
+        arrays['mean'][r, c] = self.mean[lo:hi][inside]
+        arrays['std'][r, c] = std
+        arrays['se'][r, c] = std / np.sqrt(np.maximum(count, 1))
+        return arrays
+
+
+def write_npz(filename: str, stats: GridStats, grid: Grid, variable: str):
+    """Writes the statistics of the occupied cells, with their rows and
+    columns in the grid, to a compressed numpy .npz file."""
+    rows, cols = np.divmod(stats.cells, grid.shape[1])
+    np.savez_compressed(filename, grid=grid.kind, resolution=grid.resolution, shape=grid.shape, variable=variable,
+                        row=rows, col=cols, count=stats.count, mean=stats.mean, std=stats.std, se=stats.se)
+
+
+def write_netcdf(filename: str, stats: GridStats, grid: Grid, variable: str):
+    """Writes the statistics of the window of the grid that bounds the
+    occupied cells to a CF netCDF file, with latitude and longitude, or
+    EASE-Grid 2.0 y and x, cell center coordinates."""
+    import netCDF4
+
+    row0, row1, col0, col1 = stats.window(grid)
+    y, x = grid.centers(np.arange(row0, row1), np.arange(col0, col1))
+    with netCDF4.Dataset(filename, 'w') as nc:
+        nc.Conventions = 'CF-1.8'
+        nc.title = f"GEDI L4A {variable} per {grid.resolution:g} {'degree' if grid.kind == 'latlon' else 'm'} cell"
+        if grid.kind == 'latlon':
+            dims = ('lat', 'lon')
+            attrs = [{'standard_name': 'latitude', 'units': 'degrees_north'},
+                     {'standard_name': 'longitude', 'units': 'degrees_east'}]
+        else:
+            dims = ('y', 'x')
+            attrs = [{'standard_name': 'projection_y_coordinate', 'units': 'm'},
+                     {'standard_name': 'projection_x_coordinate', 'units': 'm'}]
+            crs = nc.createVariable('crs', 'i4')
+            crs.setncatts({'grid_mapping_name': 'lambert_cylindrical_equal_area', 'standard_parallel': EASE2_LAT_TS,
+                           'longitude_of_central_meridian': 0.0, 'false_easting': 0.0, 'false_northing': 0.0,
+                           'semi_major_axis': WGS84_A, 'inverse_flattening': 298.257223563,
+                           'crs_wkt': 'EPSG:6933'})
+        for dim, values, attr in zip(dims, (y, x), attrs):
+            nc.createDimension(dim, len(values))
+            v = nc.createVariable(dim, 'f8', (dim,))
+            v.setncatts(attr)
+            v[:] = values
+        long_names = {'count': 'number of shots', 'mean': f'mean {variable}',
+                      'std': f'standard deviation of {variable}', 'se': f'standard error of the mean {variable}'}
+        band = max(RASTER_BAND_CELLS // len(x), 1)
+        chunks = (min(band, len(y)), len(x))
+        for k in long_names:
+            # a count of 0 is a value, empty cells have NaN statistics
+            dtype, fill = ('u4', False) if k == 'count' else ('f4', np.float32(np.nan))
+            v = nc.createVariable(k, dtype, dims, zlib=True, chunksizes=chunks, fill_value=fill)
+            v.long_name = long_names[k]
+            if grid.kind == 'ease2':
+                v.grid_mapping = 'crs'
+        # written in bands of rows, so the raster is never held in memory
+        for start in range(row0, row1, band):
+            stop = min(start + band, row1)
+            arrays = stats.raster(grid, (start, stop), (col0, col1))
+            for k, a in arrays.items():
+                nc[k][start - row0:stop - row0] = a
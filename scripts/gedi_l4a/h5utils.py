@@ -0,0 +1,182 @@
+"""Helpers for reading and writing GEDI h5 datasets."""
+from os import path
+import numpy as np
+
+CHUNK_CACHE_MB = 16 # HDF5 chunk cache size per open file
+H5_COMPRESSIONS = ['gzip', 'lzf', 'none']
+H5_COMPRESSION = 'gzip'
+H5_COMPRESSION_LEVEL = 4 # gzip level, 0-9
+H5_CHUNK_SIZE = 10000 # rows per HDF5 chunk of the subset outputs
+# compact chunk indexes, the default B-trees outweigh the data of small subsets; readable by HDF5 1.10+
+H5_LIBVER = ('v110', 'latest')
+# copies of the data of a window of shots held at once, e.g. input and 
+# output datasets, export DataFrame and formatted text
+WINDOW_COPIES = 4
+
+
+def subset_filename(infile: str):
+    """Name of the subset h5 file of a granule."""
+    name, ext = path.splitext(path.basename(infile))
+    return "{name}_sub{ext}".format(name=name, ext=ext)
+
+
+def index_runs(indices, gap: int = 0):
+    """Groups sorted indices into runs of consecutive indices.
+
+    Args:
+        indices (array): sorted indices
+        gap (int): runs separated by up to this many indices are merged
+
+    Returns:
+        array: (n, 2) array of the [start, stop) of each run
+    """
+    indices = np.asarray(indices)
+    if len(indices) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(indices) > gap + 1)
+    starts = indices[np.r_[0, breaks + 1]]
+    stops = indices[np.r_[breaks, len(indices) - 1]] + 1
+    return np.column_stack([starts, stops])
+
+
+def read_indices(dataset, indices):
+    """Reads the elements of a dataset at sorted indices of its first axis.
+
+    Only the hyperslabs that contain the indices are read. Runs of indices
+    that fall within one HDF5 chunk of each other are read together, as 
+    the chunk has to be read in full anyway.
+
+    Args:
+        dataset (h5py.Dataset): dataset to read
+        indices (array): sorted indices along the first axis
+
+    Returns:
+        array: dataset values at the indices
+    """
+    indices = np.asarray(indices)
+    gap = dataset.chunks[0] if dataset.chunks else 0
+    runs = index_runs(indices, gap)
+    if len(runs) == 0:
+        return dataset[0:0]
+    bounds = np.searchsorted(indices, runs[:, 0])
+    parts = []
+    for (start, stop), lo, hi in zip(runs, bounds, np.r_[bounds[1:], len(indices)]):
+        parts.append(dataset[start:stop][indices[lo:hi] - start])
+    return np.concatenate(parts)
+
+
+def read_ranges(dataset, ranges):
+    """Reads ranges of a dataset along its first axis.
+
+    Args:
+        dataset (h5py.Dataset): dataset to read
+        ranges (array): (n, 2) array of [start, stop) ranges
+
+    Returns:
+        array: concatenated dataset values of the ranges
+    """
+    if len(ranges) == 0:
+        return dataset[0:0]
+    return np.concatenate([dataset[start:stop] for start, stop in ranges])
+
+
+def range_indices(ranges):
+    """Returns the indices covered by (n, 2) [start, stop) ranges."""
+    if len(ranges) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, stop) for start, stop in ranges])
+
+
+def storage_options(shape: tuple, compression: str = H5_COMPRESSION, level: int = H5_COMPRESSION_LEVEL,
+                    chunk_size: int = H5_CHUNK_SIZE, resizable: bool = False):
+    """Keyword arguments of h5py create_dataset for the chunking and 
+    compression of a dataset of shots.
+
+    Args:
+        shape (tuple): shape of the dataset, shots along the first axis
+        compression (str): gzip, lzf or none
+        level (int): gzip compression level
+        chunk_size (int): rows per chunk
+        resizable (bool): the dataset can be extended along its first axis
+
+    Returns:
+        dict: create_dataset keyword arguments
+    """
+    options = {}
+    if resizable:
+        options['maxshape'] = (None,) + tuple(shape[1:])
+    elif compression == 'none' or len(shape) == 0:
+        # small fixed-size datasets are read fastest unchunked
+        return options
+    rows = chunk_size if resizable else max(1, min(chunk_size, shape[0]))
+    options['chunks'] = (rows,) + tuple(max(1, n) for n in shape[1:])
+    if compression != 'none':
+        options['compression'] = compression
+        options['shuffle'] = True
+        if compression == 'gzip':
+            options['compression_opts'] = level
+    return options
+
+
+def window_ranges(ranges, window: int = None):
+    """Splits [start, stop) ranges into windows of up to window shots.
+
+    Args:
+        ranges (array): (n, 2) array of [start, stop) ranges
+        window (int): number of shots per window; one window if None
+
+    Yields:
+        array: (k, 2) array of the ranges of a window
+    """
+    ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+    if window is None:
+        yield ranges
+        return
+    parts, left = [], window
+    for start, stop in ranges:
+        while start < stop:
+            n = min(stop - start, left)
+            parts.append((start, start + n))
+            start += n
+            left -= n
+            if left == 0:
+                yield np.array(parts, dtype=np.int64)
+                parts, left = [], window
+    if parts:
+        yield np.array(parts, dtype=np.int64)
+
+
+def shot_bytes(group, variables: list = None):
+    """Bytes per shot of the datasets of a BEAM group and its subgroups.
+
+    Args:
+        group (h5py.Group): BEAM group
+        variables (list): paths of the datasets relative to the group; all 
+        datasets if None
+    """
+    import h5py
+
+    sizes = []
+    group.visititems(lambda k, v: sizes.append(v.dtype.itemsize * int(np.prod(v.shape[1:])))
+                     if isinstance(v, h5py.Dataset) and v.ndim > 0 and (variables is None or k in variables) else None)
+    return sum(sizes)
+
+
+def memory_window(group, memory_mb: float, variables: list = None, window: int = None):
+    """Number of shots of a BEAM group that can be processed at once within
+    memory_mb, given the WINDOW_COPIES of each shot held by a window.
+
+    Args:
+        group (h5py.Group): BEAM group
+        memory_mb (float): memory ceiling in MB; no ceiling if None
+        variables (list): paths of the datasets processed; all if None
+        window (int): upper bound of the window, if any
+
+    Returns:
+        int: shots per window, or None for whole beams
+    """
+    if memory_mb is None:
+        return window
+    nbytes = max(shot_bytes(group, variables), 1) * WINDOW_COPIES
+    size = max(int(memory_mb * 1024 ** 2 / nbytes), 1)
+    return size if window is None else min(size, window)
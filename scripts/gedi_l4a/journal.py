@@ -0,0 +1,60 @@
+"""Checkpoint journal of resumable runs."""
+import json
+import sqlite3
+
+
+class Journal:
+    """Journal of the completed units of work of a run, e.g., granules or 
+    granule beams, kept in a SQLite database. Each unit is committed 
+    atomically with the size of the output file after it was written, so
+    an interrupted run can resume from the last completed unit.
+
+    Args:
+        filename (str): path of the journal database
+        params (dict): parameters of the run; a journal cannot be resumed
+        with different parameters
+    """
+    def __init__(self, filename: str, params: dict):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS params (params TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS units ("
+                "unit TEXT PRIMARY KEY, signature TEXT, output TEXT, offset INTEGER, nrows INTEGER, "
+                "completed TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+            )
+            row = self.conn.execute("SELECT params FROM params").fetchone()
+            params = json.dumps(params, sort_keys=True, default=str)
+            if row is None:
+                self.conn.execute("INSERT INTO params VALUES (?)", (params,))
+            elif row[0] != params:
+                raise ValueError(f"{filename} is the journal of a run with different parameters")
+
+    def done(self, unit: str, signature: str = None):
+        """Checks if a unit was completed, with the same signature if given."""
+        row = self.conn.execute("SELECT signature FROM units WHERE unit = ?", (unit,)).fetchone()
+        return row is not None and (signature is None or row[0] == signature)
+
+    def count(self):
+        """Returns the number of completed units."""
+        return self.conn.execute("SELECT COUNT(*) FROM units").fetchone()[0]
+
+    def offset(self, output: str):
+        """Returns the size of an output file after its last completed unit,
+        or None if no unit wrote to it."""
+        row = self.conn.execute(
+            "SELECT offset FROM units WHERE output = ? AND offset IS NOT NULL ORDER BY rowid DESC LIMIT 1", (output,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def record(self, unit: str, signature: str = None, output: str = None, offset: int = None, nrows: int = 0):
+        """Records a completed unit."""
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO units (unit, signature, output, offset, nrows) VALUES (?, ?, ?, ?, ?)",
+                (unit, signature, output, offset, nrows)
+            )
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,155 @@
+"""Per-stage metrics of the GEDI L4A scripts.
+
+Each stage (CMR search, download, HDF5 read, point-in-polygon, output
+writing, ...) accumulates its busy seconds, number of calls, bytes,
+requests, retries and shots, in total and per granule. Stages run by
+concurrent threads add up their seconds, so a stage may be busier than
+the elapsed time of the run. Metrics of worker processes are merged into
+the main process with ``merge``.
+"""
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+COUNTS = ['seconds', 'calls', 'bytes', 'requests', 'retries', 'shots']
+
+
+class Metrics:
+    """Thread-safe accumulator of per-stage and per-granule counts."""
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.granules = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, granule: str = None, **counts):
+        """Adds counts, e.g. ``bytes=1024, requests=1``, to a stage."""
+        with self._lock:
+            self.stages.setdefault(stage, Counter()).update(counts)
+            if granule:
+                self.granules.setdefault(granule, {}).setdefault(stage, Counter()).update(counts)
+
+    @contextmanager
+    def stage(self, stage: str, granule: str = None, **counts):
+        """Times a block as one call of a stage. The block may add counts to
+        the yielded Counter, e.g. ``s['bytes'] += len(data)``.
+        """
+        counts = Counter(counts)
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            counts['seconds'] += time.perf_counter() - start
+            counts['calls'] += 1
+            self.add(stage, granule, **counts)
+
+    def reset(self):
+        """Clears all counts, e.g., in a reused worker process."""
+        with self._lock:
+            self.started = time.time()
+            self.stages = {}
+            self.granules = {}
+
+    def snapshot(self):
+        """Picklable copy of the counts, for ``merge``."""
+        with self._lock:
+            return {
+                'stages': {k: dict(v) for k, v in self.stages.items()},
+                'granules': {g: {k: dict(v) for k, v in s.items()} for g, s in self.granules.items()},
+            }
+
+    def merge(self, snapshot: dict):
+        """Adds the counts of a snapshot of another Metrics."""
+        for stage, counts in snapshot['stages'].items():
+            self.add(stage, **counts)
+        with self._lock:
+            for granule, stages in snapshot['granules'].items():
+                for stage, counts in stages.items():
+                    self.granules.setdefault(granule, {}).setdefault(stage, Counter()).update(counts)
+
+    @staticmethod
+    def _summary(counts: Counter):
+        summary = {k: counts.get(k, 0) for k in COUNTS}
+        summary['seconds'] = round(summary['seconds'], 6)
+        summary['shots_per_second'] = round(counts['shots'] / counts['seconds'], 1) if counts.get('shots') and counts['seconds'] > 0 else None
+        return summary
+
+    def report(self):
+        """Dictionary of the elapsed seconds and the counts of each stage and granule."""
+        with self._lock:
+            return {
+                'elapsed': round(time.time() - self.started, 6),
+                'stages': {k: self._summary(v) for k, v in sorted(self.stages.items())},
+                'granules': {
+                    g: {k: self._summary(v) for k, v in sorted(s.items())} for g, s in sorted(self.granules.items())
+                },
+            }
+
+    def prometheus(self, job: str):
+        """Prometheus textfile exposition of the stage totals; per-granule
+        counts are left out to keep the label cardinality bounded.
+
+        Args:
+            job (str): value of the ``script`` label
+        """
+        report = self.report()
+        lines = [
+            '# HELP gedi_l4a_elapsed_seconds Elapsed seconds of the run.',
+            '# TYPE gedi_l4a_elapsed_seconds gauge',
+            f'gedi_l4a_elapsed_seconds{{script="{job}"}} {report["elapsed"]}',
+        ]
+        for count in COUNTS:
+            name = f'gedi_l4a_stage_{count}_total'
+            lines.append(f'# HELP {name} {count.capitalize()} of each stage of the run.')
+            lines.append(f'# TYPE {name} counter')
+            for stage, summary in report['stages'].items():
+                lines.append(f'{name}{{script="{job}",stage="{stage}"}} {summary[count]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename: str, job: str):
+        """Writes the report as a Prometheus textfile if the filename ends
+        with ``.prom``, otherwise as JSON.
+
+        Args:
+            filename (str): output file name
+            job (str): name of the script
+        """
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            if str(filename).endswith('.prom'):
+                f.write(self.prometheus(job))
+            else:
+                json.dump(dict(self.report(), script=job), f, indent=2)
+        # node_exporter must never read a partial textfile
+        os.replace(tmp, filename)
+
+
+# metrics of the running script, written with --metrics
+METRICS = Metrics()
+
+
+@contextmanager
+def profiled(filename: str = None):
+    """Profiles the block with cProfile and dumps the stats to filename,
+    e.g., for ``python -m pstats`` or snakeviz. Does nothing without a filename.
+    """
+    if not filename:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
+
+
+def response_retries(response):
+    """Number of retries urllib3 made for a requests response."""
+    retries = getattr(response.raw, 'retries', None)
+    return len(retries.history) if retries is not None else 0
@@ -0,0 +1,183 @@
+"""Remote GEDI granules read by h5py over HTTP range requests.
+
+A ``RemoteFile`` is a read-only file object of a granule URL. Reads are
+served from a cache of fixed-size blocks, and runs of missing blocks are
+fetched with one range request each, so h5py only transfers the HDF5
+metadata and the chunks of the datasets it reads. Reads that continue the
+previous one, e.g. of all chunks of a dataset, read ahead of it, twice as
+far as the time before up to READ_AHEAD_KB, so whole datasets take a few
+requests rather than one per chunk.
+"""
+import io
+import threading
+from collections import OrderedDict
+from gedi_l4a.metrics import METRICS, response_retries
+
+BLOCK_SIZE_KB = 8 # size of the cached blocks of remote granules, about a small chunk
+BLOCK_CACHE_MB = 64 # block cache size per remote granule
+READ_AHEAD_KB = 256 # largest read ahead of sequential reads
+
+
+def is_url(granule: str):
+    """True if a granule is a http(s) URL rather than a local path."""
+    return str(granule).startswith(('http://', 'https://'))
+
+
+class RemoteFile(io.RawIOBase):
+    """Read-only, block-cached file object of a URL, for h5py.
+
+    Args:
+        url (str): URL of the file; the server must support range requests
+        session: requests session, e.g. an EDLSession
+        block_size (int): size of the cached blocks in bytes
+        cache_size (int): block cache size in bytes
+        metrics (Metrics): metrics to add the ``remote_read`` stage to
+        read_ahead (int): largest read ahead of sequential reads in bytes
+
+    Raises:
+        OSError: the server does not support range requests
+    """
+    def __init__(self, url: str, session, block_size: int = BLOCK_SIZE_KB * 1024,
+                 cache_size: int = BLOCK_CACHE_MB * 1024 ** 2, metrics=METRICS,
+                 read_ahead: int = READ_AHEAD_KB * 1024):
+        super().__init__()
+        self.url = url
+        self.session = session
+        self.block_size = block_size
+        self.max_blocks = max(cache_size // block_size, 1)
+        self.metrics = metrics
+        self.max_ahead = read_ahead // block_size
+        self.blocks = OrderedDict()
+        self.pos = 0
+        # end of the previous read, and blocks read ahead of the next one
+        self._end = None
+        self._ahead = 0
+        self._lock = threading.Lock()
+        # the first block also gives the file size; later requests skip the
+        # redirects, e.g. to a signed S3 URL, unless the resolved URL expires
+        self._resolved = url
+        self.size = None
+        self._fetch(0, 0)
+
+    def __repr__(self):
+        # h5py names the file after the repr of the file object
+        return self.url
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        return self.pos
+
+    def _get(self, start: int, stop: int):
+        headers = {'Range': f'bytes={start}-{stop - 1}'}
+        response = self.session.get(self._resolved, headers=headers)
+        if response.status_code in (401, 403) and self._resolved != self.url:
+            # the resolved URL expired, the original one redirects again
+            response = self.session.get(self.url, headers=headers)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise OSError(f"{self.url} does not support range requests")
+        self._resolved = response.url
+        if self.size is None:
+            self.size = int(response.headers['Content-Range'].rsplit('/', 1)[-1])
+        return response
+
+    def _fetch(self, first: int, last: int):
+        """Fetches the blocks first to last, inclusive, in one request, and
+        returns their bytes."""
+        start = first * self.block_size
+        stop = (last + 1) * self.block_size if self.size is None else min((last + 1) * self.block_size, self.size)
+        with self.metrics.stage('remote_read', self.url.rsplit('/', 1)[-1], requests=1) as m:
+            response = self._get(start, stop)
+            data = response.content
+            m['bytes'] += len(data)
+            m['retries'] += response_retries(response)
+        for k, block in enumerate(range(first, last + 1)):
+            self.blocks[block] = data[k * self.block_size:(k + 1) * self.block_size]
+            self.blocks.move_to_end(block)
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return data
+
+    def readinto(self, b):
+        with self._lock:
+            view = memoryview(b).cast('B')
+            stop = min(self.pos + len(view), self.size)
+            if stop <= self.pos:
+                return 0
+            first, last = self.pos // self.block_size, (stop - 1) // self.block_size
+            # cached blocks are copied before any fetch can evict them
+            missing = []
+            for k in range(first, last + 1):
+                block = self.blocks.get(k)
+                if block is None:
+                    missing.append(k)
+                else:
+                    self.blocks.move_to_end(k)
+                    self._copy(view, k * self.block_size, block, stop)
+            # one request per run of missing blocks
+            runs = []
+            for k in missing:
+                if runs and runs[-1][1] == k - 1:
+                    runs[-1][1] = k
+                else:
+                    runs.append([k, k])
+            sequential = self._end is not None and 0 <= self.pos - self._end < self.block_size
+            self._ahead = min(max(2 * self._ahead, 1), self.max_ahead, self.max_blocks) if sequential else 0
+            if runs and runs[-1][1] == last and self._ahead:
+                # the read ahead stops at the next cached block
+                end = min(last + self._ahead, (self.size - 1) // self.block_size)
+                while runs[-1][1] < end and runs[-1][1] + 1 not in self.blocks:
+                    runs[-1][1] += 1
+            # fetched runs are copied straight from the response, as runs
+            # longer than the cache evict their own first blocks
+            for run_first, run_last in runs:
+                self._copy(view, run_first * self.block_size, self._fetch(run_first, run_last), stop)
+            n = stop - self.pos
+            self.pos = stop
+            self._end = self.pos
+            return n
+
+    def _copy(self, view, offset: int, data: bytes, stop: int):
+        """Copies the bytes of data, which start at offset of the file,
+        that fall within the current read from pos to stop into view."""
+        start = max(offset, self.pos)
+        end = min(offset + len(data), stop)
+        if end > start:
+            view[start - self.pos:end - self.pos] = data[start - offset:end - offset]
+
+_SESSION = None
+
+
+def open_remote(url: str, block_kb: float = BLOCK_SIZE_KB, cache_mb: float = BLOCK_CACHE_MB):
+    """Opens a granule URL as a RemoteFile with the EDLSession of the
+    process, authenticated by the .netrc file.
+
+    Args:
+        url (str): URL of the granule
+        block_kb (float): size of the cached blocks in KB
+        cache_mb (float): block cache size in MB
+
+    Returns:
+        RemoteFile
+    """
+    global _SESSION
+    if _SESSION is None:
+        from urllib3.util import Retry
+        from gedi_l4a.session import EDLSession
+        _SESSION = EDLSession(pool_size=1, retries=Retry(total=3, backoff_factor=0.1,
+                                                         status_forcelist=[500, 502, 503, 504]))
+    return RemoteFile(url, _SESSION, int(block_kb * 1024), int(cache_mb * 1024 ** 2))
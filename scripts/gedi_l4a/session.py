@@ -0,0 +1,38 @@
+"""NASA Earthdata Login HTTP session shared by the GEDI L4A scripts."""
+import http.cookiejar
+import requests
+from requests.adapters import HTTPAdapter
+
+AUTH_HOST = "https://urs.earthdata.nasa.gov"
+
+
+class EDLSession(requests.Session):
+    """Creates a NASA EarthData Login session. More info at https://urs.earthdata.nasa.gov/documentation/what_do_i_need_to_know
+    From https://github.com/asfadmin/Discovery-asf_search/
+
+    Args:
+        pool_size (int): connections kept alive per host, one per thread 
+        sharing the session
+        retries: urllib3 Retry of failed requests, if any
+    """
+    def __init__(self, pool_size: int = 10, retries=None):
+        super().__init__()
+        # one connection pool shared by all threads
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries or 0)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def auth_with_creds(self, username: str, password: str):
+        self.auth = (username, password)
+        self.get(AUTH_HOST)
+        if "urs_user_already_logged" not in self.cookies.get_dict():
+            raise Exception("Username or password is incorrect")
+        return self
+
+    def auth_with_token(self, token: str):
+        self.headers.update({'Authorization': 'Bearer {0}'.format(token)})
+        return self
+
+    def auth_with_cookiejar(self, cookies: http.cookiejar):
+        self.cookies = cookies
+        return self
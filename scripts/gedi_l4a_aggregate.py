@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import argparse
+import pathlib
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from os import path
+import numpy as np
+from gedi_l4a.cli import check_where
+from gedi_l4a.export import ROW_GROUP_SIZE
+from gedi_l4a.filters import FILL_VALUE, filter_indices
+from gedi_l4a.grid import GRIDS, Grid, GridStats, write_netcdf, write_npz
+from gedi_l4a.h5utils import read_indices
+from gedi_l4a.metrics import METRICS, profiled
+
+LAT, LON = 'lat_lowestmode', 'lon_lowestmode'
+# fill value of the GEDI L4A variables in CSV and Parquet exports
+TABLE_FILL_VALUE = -9999
+OUTPUT_FORMATS = ['.nc', '.npz']
+
+def parse_args(args):
+    """Parses command line agruments."""
+
+    parser = argparse.ArgumentParser(
+        description="Aggregate GEDI L4A shots over a grid",
+        usage="gedi_l4a_aggregate.py --inputs <paths_to_files_or_directories> --output <output_nc_or_npz_file> [--grid <latlon|ease2>] [--resolution <size>] [--variable <gedi_variable>] [--where <filter>] [--workers <n>] [--batch-size <n>] [--metrics <path>] [--profile <path>]\n"
+    )
+    parser.add_argument(
+        "--inputs",
+        required=True,
+        nargs='+',
+        help="paths to subset h5 files, consolidated or not, CSV or Parquet files of gedi_l4a_subsets.py or gedi_l4a_hyrax.py, or directories of subset h5 files"
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        type=pathlib.Path,
+        help="output file name, a netCDF raster of the cells around the shots if it ends with .nc, or a numpy .npz file of the occupied cells only"
+    )
+    parser.add_argument(
+        "--grid",
+        default='latlon',
+        choices=GRIDS,
+        help="grid of the cells, regular in latitude and longitude, or the global EASE-Grid 2.0 (EPSG:6933) of GEDI L4B (default: latlon)"
+    )
+    parser.add_argument(
+        "--resolution",
+        type=float,
+        help="cell size, in degrees for latlon or meters for ease2 (default: 0.1 degrees, or the 1 km of GEDI L4B)"
+    )
+    parser.add_argument(
+        "--variable",
+        default='agbd',
+        help="GEDI variable aggregated (default: agbd)"
+    )
+    parser.add_argument(
+        "--where",
+        action='append',
+        type=check_where,
+        help="keeps the shots for which a variable compares with a value, e.g., l4_quality_flag==1; may be repeated, shots must pass all filters"
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="number of input files aggregated concurrently in separate processes (default: 1)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        default=ROW_GROUP_SIZE,
+        type=int,
+        help=f"number of shots read and binned at once (default: {ROW_GROUP_SIZE})"
+    )
+    parser.add_argument(
+        "--metrics",
+        type=pathlib.Path,
+        help="path to a per-stage metrics report, in Prometheus textfile format if it ends with .prom, JSON otherwise"
+    )
+    parser.add_argument(
+        "--profile",
+        type=pathlib.Path,
+        help="path to a cProfile stats file of the main process"
+    )
+
+    parsed = parser.parse_args(args)
+    if parsed.output.suffix not in OUTPUT_FORMATS:
+        parser.error(f"--output must end with {' or '.join(OUTPUT_FORMATS)}")
+    return parsed
+
+def input_files(inputs: list):
+    """Expands directories to the subset h5 files they contain. CSV and
+    Parquet files have to be given by name, as exports sit next to the h5
+    files they were made from."""
+    files = []
+    for p in inputs:
+        if path.isdir(p):
+            files.extend(sorted(glob(path.join(p, '*.h5'))))
+        else:
+            files.append(p)
+    return files
+
+def valid_values(values, fill_value=None):
+    """Mask of the finite values that are not fill values."""
+    valid = np.isfinite(values)
+    if fill_value is not None:
+        valid &= values != fill_value
+    return valid
+
+def h5_batches(infile: str, variable: str, filters: list, batch_size: int):
+    """Yields the latitudes, longitudes and values of the shots of the
+    BEAM groups of a subset h5 file, or of a consolidated subset h5 file,
+    that pass the filters, up to batch_size shots at a time."""
+    import h5py
+    from gedi_l4a.consolidate import SHOTS, is_consolidated
+
+    with h5py.File(infile, 'r') as hf:
+        if is_consolidated(hf):
+            groups = [hf[SHOTS]] if LAT in hf[SHOTS] else []
+        else:
+            groups = [hf[k] for k in hf.keys() if k.startswith('BEAM')]
+        for group in groups:
+            dataset = group[variable]
+            if dataset.ndim != 1:
+                raise ValueError(f"cannot aggregate {dataset.name} with {dataset.ndim} dimensions")
+            fill_value = dataset.attrs.get(FILL_VALUE)
+            nshots = len(group[LAT])
+            for start in range(0, nshots, batch_size):
+                indices = filter_indices(group, np.arange(start, min(start + batch_size, nshots)), filters or [])
+                values = read_indices(dataset, indices).astype(np.float64)
+                valid = valid_values(values, fill_value)
+                yield read_indices(group[LAT], indices)[valid], read_indices(group[LON], indices)[valid], values[valid]
+
+def table_column(columns, variable: str):
+    # subset exports flatten subgroups, e.g. land_cover_data/pft_class to pft_class
+    if variable in columns:
+        return variable
+    if variable.rsplit('/', 1)[-1] in columns:
+        return variable.rsplit('/', 1)[-1]
+    raise KeyError(f"no {variable} column")
+
+def table_batches(infile: str, variable: str, filters: list, batch_size: int):
+    """Yields the latitudes, longitudes and values of the rows of a CSV or
+    Parquet file that pass the filters, up to batch_size rows at a time."""
+    filters = filters or []
+    if infile.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        pf = pq.ParquetFile(infile)
+        names = pf.schema_arrow.names
+    else:
+        import pandas as pd
+
+        names = pd.read_csv(infile, nrows=0).columns
+    value_column = table_column(names, variable)
+    filter_columns = [table_column(names, f.variable) for f in filters]
+    usecols = list(dict.fromkeys([LAT, LON, value_column] + filter_columns))
+    if infile.endswith('.parquet'):
+        batches = (b.to_pandas() for b in pf.iter_batches(batch_size=batch_size, columns=usecols))
+    else:
+        batches = pd.read_csv(infile, usecols=usecols, chunksize=batch_size)
+    for df in batches:
+        keep = np.ones(len(df), dtype=bool)
+        for f, column in zip(filters, filter_columns):
+            keep &= f.compare(df[column].to_numpy(), TABLE_FILL_VALUE)
+        values = df[value_column].to_numpy(dtype=np.float64)
+        keep &= valid_values(values, TABLE_FILL_VALUE)
+        yield df[LAT].to_numpy()[keep], df[LON].to_numpy()[keep], values[keep]
+
+def aggregate_file(infile: str, grid: Grid, variable: str, filters: list = None, batch_size: int = ROW_GROUP_SIZE):
+    """Aggregates the shots of a file over a grid, one batch at a time.
+
+    Args:
+        infile (str): subset h5 file, or CSV or Parquet file
+        grid (Grid): grid of the cells
+        variable (str): variable aggregated
+        filters (list): Filter objects the shots must pass
+        batch_size (int): number of shots read and binned at once
+
+    Returns:
+        GridStats: statistics of the variable in the cells of the shots
+    """
+    batches = h5_batches if infile.endswith('.h5') else table_batches
+    parts = []
+    with METRICS.stage('aggregate', path.basename(infile)) as m:
+        for lat, lon, values in batches(infile, variable, filters, batch_size):
+            m['shots'] += len(values)
+            parts.append(GridStats.from_values(grid.cells(lat, lon), values))
+            # bounds the partial statistics held, whatever the number of batches
+            if len(parts) > 1 and sum(len(p) for p in parts) > batch_size:
+                parts = [GridStats.reduce(parts)]
+        return GridStats.reduce(parts)
+
+def aggregate_file_metrics(*args):
+    """Aggregates a file in a worker process.
+
+    Returns:
+        tuple: GridStats of the file, and the snapshot of the metrics of the
+        worker process
+    """
+    METRICS.reset()
+    stats = aggregate_file(*args)
+    return stats, METRICS.snapshot()
+
+def main(args: list = None):
+    """Aggregates the shots of the input files over a grid and writes the
+    count, mean, standard deviation and standard error of the mean of each
+    cell; args default to the command line arguments."""
+    parser = parse_args(sys.argv[1:] if args is None else args)
+    # metrics of earlier calls in the same process
+    METRICS.reset()
+    grid = Grid(parser.grid, parser.resolution)
+    files = input_files(parser.inputs)
+    if not files:
+        sys.exit("no input files found")
+
+    parts = []
+    failed = []
+    with profiled(parser.profile):
+        if parser.workers > 1:
+            # partial statistics of each file are reduced in the main process
+            with ProcessPoolExecutor(max_workers=parser.workers) as executor:
+                futures = {
+                    executor.submit(aggregate_file_metrics, f, grid, parser.variable, parser.where,
+                                    parser.batch_size): f
+                    for f in files
+                }
+                for n, future in enumerate(as_completed(futures), 1):
+                    f = futures[future]
+                    try:
+                        stats, snapshot = future.result()
+                        METRICS.merge(snapshot)
+                        parts.append(stats)
+                        print(f"[{n}/{len(futures)}] {f}: {len(stats)} cells")
+                    except Exception as e:
+                        failed.append(f)
+                        print(f"[{n}/{len(futures)}] {f}: failed, {e}")
+        else:
+            for f in files:
+                try:
+                    stats = aggregate_file(f, grid, parser.variable, parser.where, parser.batch_size)
+                    parts.append(stats)
+                    print(f"{f}: {len(stats)} cells")
+                except Exception as e:
+                    failed.append(f)
+                    print(f"{f}: failed, {e}")
+
+        stats = GridStats.reduce(parts)
+        with METRICS.stage('write'):
+            if parser.output.suffix == '.nc':
+                write_netcdf(str(parser.output), stats, grid, parser.variable)
+            else:
+                write_npz(str(parser.output), stats, grid, parser.variable)
+        print(f"{int(stats.count.sum())} shots in {len(stats)} cells written to {parser.output}")
+
+    if parser.metrics:
+        METRICS.write(parser.metrics, 'gedi_l4a_aggregate')
+
+    if failed:
+        sys.exit(f"{len(failed)} file(s) failed to aggregate")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,36 @@
 #!/usr/bin/env python3
 import argparse
-import http.cookiejar
+import hashlib
 import pathlib
-import requests
 import sys
-import datetime as dt
-import geopandas as gpd
-import netCDF4 as nc
-import pandas as pd
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from os import path
-from shapely.ops import orient
-from urllib.parse import urlsplit
-from requests.adapters import HTTPAdapter, Retry
+from gedi_l4a.cli import check_datefmt, check_doi, cmr_temporal, read_poly
+from gedi_l4a.cmr import CMR, CACHE_TTL
+from gedi_l4a.coordcache import COORD_CACHE_MB, CoordinateCache
+from gedi_l4a.export import FORMATS, PARQUET_COMPRESSION, ROW_GROUP_SIZE, open_writer
+from gedi_l4a.h5utils import index_runs
+from gedi_l4a.journal import Journal
+from gedi_l4a.metrics import METRICS, profiled, response_retries
+from gedi_l4a.session import EDLSession
+from urllib3.util import Retry
 import warnings
 warnings.filterwarnings('ignore')
 
-DT_FORMAT = "%Y-%m-%d"
-CMR_URL="https://cmr.earthdata.nasa.gov/search/"
-AUTH_HOST = "https://urs.earthdata.nasa.gov"
 HEADERS = ['lat_lowestmode', 'lon_lowestmode', 'elev_lowestmode', 'shot_number']
+MERGE_GAP = 10000 # shots
+# the netCDF-C library is not thread-safe
+NC_LOCK = threading.Lock()
 
 def parse_args(args):
     """Parses command line agruments."""
 
     parser = argparse.ArgumentParser(
         description="Access GEDI L4A using NASA OPeNDAP in the Cloud",
-        usage="gedi_l4a_hyrax.py --doi <DOI> --date1 <start_date> --date2 <end_date> --poly <path_to_geojson_file> --beams <gedi_beams> --variables <gedi_variables> --outfile <output_csv_file> [--json]\n"
+        usage="gedi_l4a_hyrax.py --doi <DOI> --date1 <start_date> --date2 <end_date> --poly <path_to_geojson_file> --beams <gedi_beams> --variables <gedi_variables> --outfile <output_csv_file> [--json] [--workers <n>] [--merge-gap <n>] [--coord-cache-mb <MB>] [--journal <path>] [--format <parquet|geoparquet|fgb>] [--compression <codec>] [--row-group-size <n>] [--cache-ttl <hours>] [--metrics <path>] [--profile <path>]\n"
     )
     parser.add_argument(
         "--doi",
@@ -75,41 +80,64 @@ def parse_args(args):
         action='store_true',
         help="setting this creates additional output GeoJSON subset file"
     )
+    parser.add_argument(
+        "--workers",
+        default=4,
+        type=int,
+        help="number of granule beams fetched concurrently from Hyrax (default: 4)"
+    )
+    parser.add_argument(
+        "--merge-gap",
+        default=MERGE_GAP,
+        type=int,
+        help=f"runs of shots separated by up to this many shots are fetched in one request (default: {MERGE_GAP})"
+    )
+    parser.add_argument(
+        "--coord-cache-mb",
+        default=COORD_CACHE_MB,
+        type=float,
+        help=f"size limit in MB of the local cache of shot coordinates, 0 disables the cache (default: {COORD_CACHE_MB})"
+    )
+    parser.add_argument(
+        "--journal",
+        type=pathlib.Path,
+        help="path to a checkpoint journal; an interrupted run with the same journal resumes where it stopped"
+    )
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        help="setting this creates additional output file in Parquet, GeoParquet or FlatGeobuf format"
+    )
+    parser.add_argument(
+        "--compression",
+        default=PARQUET_COMPRESSION,
+        help=f"Parquet compression codec (default: {PARQUET_COMPRESSION})"
+    )
+    parser.add_argument(
+        "--row-group-size",
+        default=ROW_GROUP_SIZE,
+        type=int,
+        help=f"number of rows per Parquet row group (default: {ROW_GROUP_SIZE})"
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        default=CACHE_TTL / 3600,
+        type=float,
+        help="hours CMR search results are cached for, 0 disables the cache (default: 24)"
+    )
+    parser.add_argument(
+        "--metrics",
+        type=pathlib.Path,
+        help="path to a per-stage metrics report, in Prometheus textfile format if it ends with .prom, JSON otherwise"
+    )
+    parser.add_argument(
+        "--profile",
+        type=pathlib.Path,
+        help="path to a cProfile stats file of the run"
+    )
 
     return parser.parse_args(args)
 
-def check_datefmt(d: str):
-    """Checks if date parameters are in correct format.
-    
-    Args:
-        d (str): date string in YYYY-MM-DD
-    
-    Returns:
-        datetime object
-    """
-    try:
-        return dt.datetime.strptime(d, DT_FORMAT)
-    except ValueError:
-        msg = "not a valid date in YYYY-MM-DD format"
-        raise argparse.ArgumentTypeError(msg)
-
-def check_doi(d: str):
-    """Checks if DOI passed is valid and the dataset exists at NASA CMR
-    
-    Args:
-        d (str): DOI
-    
-    Returns:
-        string: DOI stripped off https://doi.org, if any
-    """
-    try:
-        dpath = urlsplit(d).path.strip("/")
-        requests.get(CMR_URL + 'collections.json?doi=' + dpath).json()['feed']['entry'][0]['id']
-        return dpath
-    except (ValueError, IndexError):
-        msg = "not a valid DOI"
-        raise argparse.ArgumentTypeError(msg)
-
 def get_granules_hyrax(doi: str, poly_epsg4326, temporal_str: str):
     """Get hyrax url for the granules that overlaps the temporal and 
     spatial bounds.
@@ -126,56 +154,160 @@ def get_granules_hyrax(doi: str, poly_epsg4326, temporal_str: str):
     
     print("Searching for granules ..")
 
-    # orienting coordinates clockwise
-    poly_epsg4326.geometry = poly_epsg4326.geometry.apply(orient, args=(1,))
+    _, granules = CMR.search(doi, poly_epsg4326, temporal_str)
 
-    # reducing number of vertices in the polygon
-    # CMR has 1000000 bytes limit
-    grsm_epsg4326 = poly_epsg4326.simplify(0.0005)
+    granule_arr = []
 
-    doisearch = requests.get(CMR_URL + 'collections.json?doi=' + doi).json()['feed']['entry'][0]
-    concept_id = doisearch['id']
-    geojson = {"shapefile": ("poly.json", poly_epsg4326.geometry.to_json(), "application/geo+json")}
+    for g in granules:          
+        # Get Hyrax URL
+        for links in g['links']:
+            if 'title' in links and links['title'].startswith('OPeNDAP'):
+                granule_arr.append({'url':links['href']})
+    
+    print(f"Total granules found: {len(granule_arr)}")
+    return granule_arr   
 
-    page_num = 1
-    page_size = 2000 # CMR page size limit
+def get_hyrax_variables(session, url: str, beam: str, variables: list, i: int, j: int):
+    """Get a range of shots of several variables of a beam with a single 
+    Hyrax request. If the request fails, e.g., because a variable does not 
+    exist, the variables are requested one at a time and the missing ones 
+    are set to None.
 
-    granule_arr = []
+    Args:
+        session: requests session
+        url (str): Hyrax url of the granule
+        beam (str): GEDI beam name
+        variables (list): GEDI variable names
+        i (int): index of the first shot
+        j (int): index of the last shot, inclusive
 
-    while True:
-        
-        # defining parameters
-        cmr_param = {
-            "collection_concept_id": concept_id, 
-            "page_size": page_size,
-            "page_num": page_num,
-            "temporal": temporal_str,
-            "simplify-shapefile": 'true' # this is needed to bypass 5000 coordinates limit of CMR
-        }
-        
-        granulesearch = CMR_URL + 'granules.json'
-        response = requests.post(granulesearch, data=cmr_param, files=geojson)
-        granules = response.json()['feed']['entry']
-        
-        if granules:
-            for g in granules:          
-                # Get Hyrax URL
-                href=''
-                for links in g['links']:
-                    if 'title' in links and links['title'].startswith('OPeNDAP'):
-                        granule_arr.append({'url':links['href']})
-            page_num += 1   
-        else: 
-            break
-        
-        print(f"Total granules found: {len(granule_arr)}")
-    return granule_arr   
+    Returns:
+        dict: variable name to numpy array, or None if Hyrax rejected it
+    """
+    import netCDF4 as nc
+
+    var_s = ';'.join(f"/{beam}/{v}[{i}:{j}]" for v in variables)
+    with METRICS.stage('variables', url.rsplit('/', 1)[-1], requests=1) as m:
+        r = session.get(f"{url}.dap.nc4?dap4.ce={var_s}")
+        m.update(bytes=len(r.content), retries=response_retries(r))
+    if (r.status_code != 400):
+        with NC_LOCK:
+            ds = nc.Dataset('hyrax', memory=r.content)
+            values = {v: np.ma.getdata(ds[beam][v][:]) for v in variables}
+            ds.close()
+        return values
+    if len(variables) == 1:
+        return {variables[0]: None}
+    values = {}
+    for v in variables:
+        values.update(get_hyrax_variables(session, url, beam, [v], i, j))
+    return values
+
+def get_hyrax_coordinates(session, url: str, beam: str, coords=None):
+    """Get the lat, lon coordinates of the shots of a beam, from the 
+    coordinate cache if available.
+
+    Args:
+        session: requests session
+        url (str): Hyrax url of the granule
+        beam (str): GEDI beam name
+        coords (CoordinateCache): coordinate cache, if any
+
+    Returns:
+        tuple: lat and lon arrays, empty if the beam does not exist
+    """
+    import netCDF4 as nc
+
+    granule = url.rsplit('/', 1)[-1]
+    if coords:
+        with METRICS.stage('coordinate_cache', granule):
+            cached = coords.get(url, beam)
+        if cached is not None:
+            return cached
+
+    hyrax_url = f"{url}.dap.nc4?dap4.ce=/{beam}/lon_lowestmode;/{beam}/lat_lowestmode"
+    with METRICS.stage('coordinates', granule, requests=1) as m:
+        r = session.get(hyrax_url)
+        m.update(bytes=len(r.content), retries=response_retries(r))
+    if (r.status_code == 400):
+        lat = lon = np.empty(0)
+    else:
+        with NC_LOCK:
+            ds = nc.Dataset('hyrax', memory=r.content)
+            lat = np.ma.getdata(ds[beam]['lat_lowestmode'][:])
+            lon = np.ma.getdata(ds[beam]['lon_lowestmode'][:])
+            ds.close()
+    if coords:
+        coords.put(url, beam, lat, lon)
+    return lat, lon
+
+def get_hyrax_beam(session, url: str, beam: str, aoi, variables: list, merge_gap: int = MERGE_GAP, coords=None):
+    """Get the variables of the shots of a beam within the area of interest.
+
+    Args:
+        session: requests session
+        url (str): Hyrax url of the granule
+        beam (str): GEDI beam name
+        aoi (AOI): area of interest
+        variables (list): GEDI variable names besides lat_lowestmode and lon_lowestmode
+        merge_gap (int): runs of shots up to this many shots apart are fetched together
+        coords (CoordinateCache): coordinate cache, if any
+
+    Returns:
+        pandas DataFrame with the coordinates and variables of the shots, 
+        or None if no shots are within the area of interest
+    """
+    import pandas as pd
+
+    print(f"Downloading {url.rsplit('/', 1)[-1]} / {beam}")
 
-def main():
+    # retrieving lat, lon coordinates for the file
+    lat, lon = get_hyrax_coordinates(session, url, beam, coords)
+
+    # subsetting by bounds of the area of interest
+    with METRICS.stage('point_in_polygon', url.rsplit('/', 1)[-1], shots=len(lat)):
+        indices = aoi.indices(lat, lon)
+    if len(indices) == 0:
+        return None
+
+    # retrieving variables of interest, agbd, agbd_t in this case.
+    # We are only retriving the shots within subset area, with
+    # all variables and nearby runs of shots in one request.
+    columns = {v: [] for v in variables}
+    for i, j in index_runs(indices, merge_gap):
+        sel = indices[(indices >= i) & (indices < j)] - i
+        values = get_hyrax_variables(session, url, beam, variables, i, j - 1)
+        for v in variables:
+            columns[v].append(None if values[v] is None else values[v][sel])
+
+    # keeping the variable types, shot_number is uint64
+    df_sub = pd.DataFrame({'lat_lowestmode': lat[indices], 'lon_lowestmode': lon[indices]})
+    for v, values in columns.items():
+        if all(a is None for a in values):
+            # variables the granule does not have are left empty
+            df_sub[v] = np.full(len(indices), np.nan)
+        elif any(a is None for a in values):
+            # a NaN fill would turn integer variables, e.g. shot_number, to
+            # float; the granule beam is not written, and a journaled rerun
+            # fetches it again
+            raise Exception(f"Hyrax rejected some shots of {v} of {url.rsplit('/', 1)[-1]} / {beam}")
+        else:
+            df_sub[v] = np.concatenate(values)
+    return df_sub
+
+def main(args: list = None):
     """Access GEDI L4A variables from Hyrax for polygon (GeoJSON file) and start/end dates, and
-    saves the output as a csv file"""
+    saves the output as a csv file; args default to the command line arguments"""
+
+    parser = parse_args(sys.argv[1:] if args is None else args)
+    # metrics of earlier calls in the same process
+    METRICS.reset()
+    # heavy libraries are loaded once the arguments are valid
+    import pandas as pd
+    import shapely
+    from gedi_l4a.aoi import AOI
 
-    parser = parse_args(sys.argv[1:])
+    CMR.ttl = parser.cache_ttl * 3600
 
     doi = parser.doi
     outfile = parser.outfile
@@ -184,71 +316,116 @@ def main():
     beams  = parser.beams
     variables  = parser.variables
     fmt_json = parser.json
-    poly = gpd.read_file(parser.poly)
-    poly.crs = 'EPSG:4326'
+    poly = read_poly(parser.poly)
+    # all features of the GeoJSON file
+    aoi = AOI.from_geodataframe(poly)
 
-    dt_cmr = '%Y-%m-%dT%H:%M:%SZ'
-    temporal = start_date.strftime(dt_cmr) + ',' + end_date.strftime(dt_cmr)
+    temporal = cmr_temporal(start_date, end_date)
 
     # setting up maximum retries to get around Hyrax 500 error
-    s = requests.Session()
+    # one connection pool is shared by all fetch threads
     retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[ 500, 502, 503, 504 ])
-    s.mount('https://', HTTPAdapter(max_retries=retries))
+    s = EDLSession(pool_size=parser.workers, retries=retries)
 
     # appending science variables to lat, lon, elev, shot_number
-    for v in variables:
-        if v not in HEADERS:
-            HEADERS.append(v)
+    headers = HEADERS + [v for v in dict.fromkeys(variables) if v not in HEADERS]
+
+    coords = CoordinateCache(max_mb=parser.coord_cache_mb) if parser.coord_cache_mb > 0 else None
+
+    journal = None
+    if parser.journal:
+        journal = Journal(parser.journal, {
+            'doi': doi, 'temporal': temporal, 'aoi': hashlib.sha256(shapely.to_wkb(aoi.geometry)).hexdigest(),
+            'beams': beams, 'variables': headers, 'outfile': path.abspath(outfile),
+        })
+        # discarding rows written after the last completed granule beam
+        offset = journal.offset(str(outfile))
+        if offset is not None and (not path.isfile(outfile) or path.getsize(outfile) < offset):
+            sys.exit(f"{outfile} is shorter than recorded in {parser.journal}, remove the journal to start over")
+        if offset is not None and path.getsize(outfile) > offset:
+            with open(outfile, 'r+b') as f:
+                f.truncate(offset)
+    resumed = journal is not None and journal.count() > 0
+
+    writer = None
+    if parser.format:
+        writer = open_writer(parser.format, path.splitext(outfile)[0], parser.compression, parser.row_group_size)
 
     # writing header row to the output file
     if not path.isfile(outfile):
         with open(outfile, "w") as f:
-            f.write(','.join(HEADERS)+'\n')
-
-    for g in get_granules_hyrax(doi, poly, temporal):
-        for beam in beams:
-            print(f"Downloading {g['url'].rsplit('/', 1)[-1]} / {beam}")
-
-            # retrieving lat, lon coordinates for the file
-            
-            hyrax_url = f"{g['url']}.dap.nc4?dap4.ce=/{beam}/lon_lowestmode;/{beam}/lat_lowestmode"
-            r = s.get(hyrax_url)
-            if (r.status_code != 400):
-                ds = nc.Dataset('hyrax', memory=r.content)
-                lat = ds[beam]['lat_lowestmode'][:]
-                lon = ds[beam]['lon_lowestmode'][:]
-                ds.close()
-                df = pd.DataFrame({'lat_lowestmode': lat, 'lon_lowestmode': lon}) # creating pandas dataframe  
-
-                # subsetting by bounds of the area of interest
-                # converting to geopandas dataframe
-                gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon_lowestmode, df.lat_lowestmode)) 
-                gdf_sub = gdf[gdf['geometry'].within(poly.geometry[0])]   
-                if not gdf_sub.empty:
-                    # retrieving variables of interest, agbd, agbd_t in this case.
-                    # We are only retriving the shots within subset area.
-                    for _, df_gr in gdf_sub.groupby((gdf_sub.index.to_series().diff() > 1).cumsum()):
-                        i = df_gr.index.min()
-                        j = df_gr.index.max()
-                        for v in HEADERS[2:]:
-                            var_s = f"/{beam}/{v}[{i}:{j}]"
-                            hyrax_url = f"{g['url']}.dap.nc4?dap4.ce={var_s}"
-                            r = s.get(hyrax_url)
-                            if (r.status_code != 400):
-                                ds = nc.Dataset('hyrax', memory=r.content)
-                                gdf_sub.loc[i:j, (v)] = ds[beam][v][:]
-                                ds.close()
-
-                    # saving the output file
-                    gdf_sub['shot_number'] = gdf_sub['shot_number'].astype(str)
-                    gdf_sub.to_csv(outfile, mode='a', index=False, header=False, columns=HEADERS)
-
-    if fmt_json:
-        jsonf = f"{path.splitext(outfile)[0]}.json"
-        print (f"writing GeoJSON file {jsonf}")
-        df = pd.read_csv(outfile)
-        gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon_lowestmode, df.lat_lowestmode))
-        gdf.to_file(jsonf, driver='GeoJSON', drop_id=True)
+            f.write(','.join(headers)+'\n')
+
+    failed = []
+
+    def write_beam(unit, future):
+        try:
+            df_sub = future.result()
+        except Exception as e:
+            # the beam is not journaled, a rerun fetches it again
+            failed.append(unit)
+            print(f"{unit}: failed, {e}")
+            return
+        nrows = 0
+        if df_sub is not None:
+            # saving the output file
+            with METRICS.stage('write', unit.rsplit('/', 2)[-2], shots=len(df_sub)):
+                df_sub.to_csv(outfile, mode='a', index=False, header=False, columns=headers)
+                if writer and not resumed:
+                    writer.write(df_sub[headers])
+            nrows = len(df_sub)
+        if journal:
+            journal.record(unit, output=str(outfile), offset=path.getsize(outfile), nrows=nrows)
+
+    with profiled(parser.profile):
+        with METRICS.stage('cmr_search'):
+            granules = get_granules_hyrax(doi, poly, temporal)
+
+        try:
+            # beams are fetched concurrently and written in granule/beam order, 
+            # holding at most 2 x workers results in memory
+            with ThreadPoolExecutor(max_workers=parser.workers) as executor:
+                pending = deque()
+                for g in granules:
+                    for beam in beams:
+                        unit = f"{g['url']}/{beam}"
+                        if journal and journal.done(unit):
+                            continue
+                        future = executor.submit(get_hyrax_beam, s, g['url'], beam, aoi, headers[2:], parser.merge_gap, coords)
+                        pending.append((unit, future))
+                        if len(pending) >= 2 * parser.workers:
+                            write_beam(*pending.popleft())
+                while pending:
+                    write_beam(*pending.popleft())
+
+            if writer and resumed:
+                with METRICS.stage('export'):
+                    # rows of earlier runs are only in the CSV file
+                    for df in pd.read_csv(outfile, chunksize=parser.row_group_size, dtype={'shot_number': 'uint64'}):
+                        writer.write(df)
+        finally:
+            if writer:
+                with METRICS.stage('export'):
+                    writer.close()
+
+        if journal:
+            journal.close()
+
+        if fmt_json:
+            with METRICS.stage('export'):
+                jsonf = f"{path.splitext(outfile)[0]}.json"
+                print (f"writing GeoJSON file {jsonf}")
+                import geopandas as gpd
+
+                df = pd.read_csv(outfile)
+                gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.lon_lowestmode, df.lat_lowestmode))
+                gdf.to_file(jsonf, driver='GeoJSON', drop_id=True)
+
+    if parser.metrics:
+        METRICS.write(parser.metrics, 'gedi_l4a_hyrax')
+
+    if failed:
+        sys.exit(f"{len(failed)} granule beam(s) failed to fetch")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,35 +1,74 @@
 #!/usr/bin/env python3
 import argparse
-import h5py
+import contextlib
+import hashlib
 import pathlib
+import shutil
 import sys
-import geopandas as gpd
-import numpy as np
-import pandas as pd
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from glob import glob
-from os import path, remove
+from os import makedirs, path, remove, stat
+import numpy as np
+from gedi_l4a.cli import check_datefmt, check_doi, check_where, cmr_temporal, read_aoi
+from gedi_l4a.cmr import CMR, CACHE_TTL, granule_links
+from gedi_l4a.consolidate import ConsolidatedFile
+from gedi_l4a.export import FORMATS, PARQUET_COMPRESSION, ROW_GROUP_SIZE, CSVWriter, GeoJSONWriter, open_writer, subset_batches
+from gedi_l4a.filters import filter_indices
+from gedi_l4a.h5utils import (CHUNK_CACHE_MB, H5_CHUNK_SIZE, H5_COMPRESSION, H5_COMPRESSION_LEVEL, H5_COMPRESSIONS,
+                              H5_LIBVER, memory_window, range_indices, read_indices, read_ranges, storage_options,
+                              subset_filename, window_ranges)
+from gedi_l4a.journal import Journal
+from gedi_l4a.metrics import METRICS, profiled
+from gedi_l4a.remote import BLOCK_CACHE_MB, BLOCK_SIZE_KB, is_url, open_remote
 
 GRANULE_FORMAT = "h5"
+CONSOLIDATED_FILE = "subset.h5"
+SCRATCH_LIMIT_GB = 10 # granules downloaded to the scratch directory at once
+DOWNLOAD_WORKERS = 4 # granules downloaded concurrently to the scratch directory
+# datasets always copied with --variables
+KEEP_VARIABLES = ['lat_lowestmode', 'lon_lowestmode', 'shot_number']
 
 def parse_args(args):
     """Parses command line agruments."""
 
     parser = argparse.ArgumentParser(
         description="Subset GEDI L4A footprints",
-        usage="gedi_l4a_subsets.py --poly <path_to_geojson_file> --indir <path_to_input_directory> --subdir <path_to_output_directory> [--csv] [--json]\n"
+        usage="gedi_l4a_subsets.py (--poly <path_to_geojson_file> | --polys <paths_to_geojson_files_or_directories>) (--indir <path_to_input_directory> | --doi <DOI> --date1 <start_date> --date2 <end_date>) --subdir <path_to_output_directory> [--csv] [--json] [--format <parquet|geoparquet|fgb>] [--compression <codec>] [--row-group-size <n>] [--workers <n>] [--index] [--journal <path>] [--chunk-cache <MB>] [--block-size <KB>] [--block-cache <MB>] [--cache-ttl <hours>] [--scratch <path> [--scratch-limit <GB>] [--download-workers <n>]] [--consolidate] [--h5-compression <gzip|lzf|none>] [--h5-compression-level <0-9>] [--h5-chunk-size <n>] [--window <n>] [--max-memory <MB>] [--variables <gedi_variables>] [--where <filter>] [--metrics <path>] [--profile <path>]\n"
     )
-    parser.add_argument(
+    aoi = parser.add_mutually_exclusive_group(required=True)
+    aoi.add_argument(
         "--poly",
-        required=True, 
         type=argparse.FileType('r', encoding='UTF-8'), 
         help="path to a GeoJSON file defining area of interest"
     )
-    parser.add_argument(
+    aoi.add_argument(
+        "--polys",
+        nargs='+',
+        type=pathlib.Path,
+        help="paths to GeoJSON files, or directories of GeoJSON files, defining areas of interest subset in one pass"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
         "--indir",
-        required=True, 
         type=pathlib.Path, 
         help="path to the directory with downloaded h5 files"
     )
+    source.add_argument(
+        "--doi",
+        type=check_doi, 
+        help="DOI e.g., 10.3334/ORNLDAAC/2056 for GEDI L4A V2.1; subsets the granules found by a CMR search in place over HTTP range requests, without downloading them"
+    )
+    parser.add_argument(
+        "--date1",
+        type=check_datefmt,
+        help="start date in YYYY-MM-DD format, with --doi"
+    )
+    parser.add_argument(
+        "--date2",
+        type=check_datefmt,
+        help="end date in YYYY-MM-DD format, with --doi"
+    )
     parser.add_argument(
         "--subdir",
         required=True, 
@@ -48,144 +87,731 @@ def parse_args(args):
         action='store_true',
         help="setting this creates additional output GeoJSON subset file"
     )
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        help="setting this creates additional output subset file in Parquet, GeoParquet or FlatGeobuf format"
+    )
+    parser.add_argument(
+        "--compression",
+        default=PARQUET_COMPRESSION,
+        help=f"Parquet compression codec (default: {PARQUET_COMPRESSION})"
+    )
+    parser.add_argument(
+        "--row-group-size",
+        default=ROW_GROUP_SIZE,
+        type=int,
+        help=f"number of rows per Parquet row group (default: {ROW_GROUP_SIZE})"
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="number of granules subset in parallel processes (default: 1)"
+    )
+    parser.add_argument(
+        "--index",
+        default=False,
+        action='store_true',
+        help="setting this uses a footprint index of the indir to skip granules and beams outside the area of interest"
+    )
+    parser.add_argument(
+        "--journal",
+        type=pathlib.Path,
+        help="path to a checkpoint journal; later runs with the same journal only subset new or changed granules"
+    )
+    parser.add_argument(
+        "--chunk-cache",
+        default=CHUNK_CACHE_MB,
+        type=float,
+        help=f"HDF5 chunk cache size in MB per open file (default: {CHUNK_CACHE_MB})"
+    )
+    parser.add_argument(
+        "--block-size",
+        default=BLOCK_SIZE_KB,
+        type=float,
+        help=f"size in KB of the blocks read from remote granules with --doi (default: {BLOCK_SIZE_KB})"
+    )
+    parser.add_argument(
+        "--block-cache",
+        default=BLOCK_CACHE_MB,
+        type=float,
+        help=f"cache size in MB of the blocks read from a remote granule with --doi (default: {BLOCK_CACHE_MB})"
+    )
+    parser.add_argument(
+        "--scratch",
+        type=pathlib.Path,
+        help="with --doi, path to a directory the granules are downloaded to and subset from, each granule being removed once subset, instead of reading them over HTTP range requests"
+    )
+    parser.add_argument(
+        "--scratch-limit",
+        default=SCRATCH_LIMIT_GB,
+        type=float,
+        help=f"GB of granules downloaded to the --scratch directory at once; downloads wait for subset granules to be removed (default: {SCRATCH_LIMIT_GB})"
+    )
+    parser.add_argument(
+        "--download-workers",
+        default=DOWNLOAD_WORKERS,
+        type=int,
+        help=f"number of granules downloaded concurrently to the --scratch directory (default: {DOWNLOAD_WORKERS})"
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        default=CACHE_TTL / 3600,
+        type=float,
+        help="hours CMR search results are cached for with --doi, 0 disables the cache (default: 24)"
+    )
+    parser.add_argument(
+        "--consolidate",
+        default=False,
+        action='store_true',
+        help=f"setting this appends the shots of all granules to one {CONSOLIDATED_FILE} file per output directory, with granule and beam index columns, instead of one subset h5 file per granule"
+    )
+    parser.add_argument(
+        "--h5-compression",
+        default=H5_COMPRESSION,
+        choices=H5_COMPRESSIONS,
+        help=f"HDF5 compression filter of the subset h5 files (default: {H5_COMPRESSION})"
+    )
+    parser.add_argument(
+        "--h5-compression-level",
+        default=H5_COMPRESSION_LEVEL,
+        type=int,
+        choices=range(10),
+        metavar="{0-9}",
+        help=f"gzip compression level of the subset h5 files (default: {H5_COMPRESSION_LEVEL})"
+    )
+    parser.add_argument(
+        "--h5-chunk-size",
+        default=H5_CHUNK_SIZE,
+        type=int,
+        help=f"number of shots per HDF5 chunk of the subset h5 files (default: {H5_CHUNK_SIZE})"
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        help="maximum number of shots of a beam read, tested, written and exported at once (default: whole beams)"
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        help="memory ceiling in MB per process of the shots processed at once, besides the HDF5 chunk cache; sets the window of each beam from the size of its shots (default: no ceiling)"
+    )
+    parser.add_argument(
+        "--variables",
+        type=lambda arg: arg.split(','),
+        help="GEDI variable names in a comma-separated format, e.g., agbd,l4_quality_flag,land_cover_data/pft_class; lat_lowestmode, lon_lowestmode and shot_number are always included (default: all variables)"
+    )
+    parser.add_argument(
+        "--where",
+        action='append',
+        type=check_where,
+        help="keeps the shots for which a variable compares with a value, e.g., l4_quality_flag==1 or agbd!=_FillValue; may be repeated, shots must pass all filters"
+    )
+    parser.add_argument(
+        "--metrics",
+        type=pathlib.Path,
+        help="path to a per-stage metrics report, in Prometheus textfile format if it ends with .prom, JSON otherwise"
+    )
+    parser.add_argument(
+        "--profile",
+        type=pathlib.Path,
+        help="path to a cProfile stats file of the main process"
+    )
 
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    if parsed.doi and not (parsed.date1 and parsed.date2):
+        parser.error("--doi requires --date1 and --date2")
+    if parsed.doi and parsed.index:
+        parser.error("--index requires --indir")
+    if parsed.scratch and not parsed.doi:
+        parser.error("--scratch requires --doi")
+    return parsed
 
-def create_csv_json(outdir: str, fmt_json: bool, fmt_csv: bool):
+def create_csv_json(outdir: str, fmt_json: bool, fmt_csv: bool, fmt: str = None,
+                    compression: str = PARQUET_COMPRESSION, row_group_size: int = ROW_GROUP_SIZE,
+                    window: int = None, memory_mb: float = None):
     """Creates subset data in CSV and GeoJSON formats if the 
-    arguments --csv and/or --json are set.
+    arguments --csv and/or --json are set, and in the format set by 
+    --format. The subset h5 files are exported up to row_group_size, or
+    window, shots at a time.
 
     Args:
         outdir (str): directory path of subset h5 files
         fmt_json (bool): GeoJSON output requested
         fmt_csv (bool): CSV output requested
+        fmt (str): parquet, geoparquet or fgb output requested, if any
+        compression (str): Parquet compression codec
+        row_group_size (int): number of rows per Parquet row group
+        window (int): maximum number of shots exported at once, if less 
+        than row_group_size
+        memory_mb (float): memory ceiling in MB of the shots exported at
+        once, if any
     """
-    subset_df = pd.DataFrame()
-    for subfile in glob(path.join(outdir, '*.h5')):
-        hf_in = h5py.File(subfile, 'r')
-        for v in list(hf_in.keys()):
-            if v.startswith('BEAM'):
-                col_names = []
-                col_val = []
-                beam = hf_in[v]
-                # copy BEAMS 
-                for key, value in beam.items():
-                    # looping through subgroups
-                    if isinstance(value, h5py.Group):
-                        for key2, value2 in value.items():
-                            if (key2 != "shot_number"):
-                                # xvar variables have 2D
-                                if (key2.startswith('xvar')):
-                                    for r in range(4):
-                                        col_names.append(key2 + '_' + str(r+1))
-                                        col_val.append(value2[:, r].tolist())
-                                else:
-                                    col_names.append(key2)
-                                    col_val.append(value2[:].tolist())
-                    
-                    #looping through base group
-                    else:
-                        # xvar variables have 2D
-                        if (key.startswith('xvar')):
-                            for r in range(4):
-                                col_names.append(key + '_' + str(r+1))
-                                col_val.append(value[:, r].tolist())
-                        else:
-                            col_names.append(key)
-                            col_val.append(value[:].tolist())
-                
-                # create a pandas dataframe        
-                beam_df = pd.DataFrame(map(list, zip(*col_val)), columns=col_names) 
-                # Inserting BEAM names
-                beam_df.insert(0, 'BEAM', np.repeat(str(v), len(beam_df.index)).tolist())
-                beam_df.insert(0, 'filename', np.repeat(path.basename(subfile), len(beam_df.index)).tolist() )
-                # Appending to the subset_df dataframe
-                subset_df = pd.concat([subset_df, beam_df])
-        hf_in.close()
-
-    if not subset_df.empty:
-         # convert object types columns to strings. object types are not supported
-        for c in subset_df.columns:
-            if subset_df[c].dtype == 'object':
-                subset_df[c] = subset_df[c].astype(str)
-
-        if fmt_csv:
-            subset_df.to_csv(path.join(outdir, 'subset.csv'), index=False)
-        
-        # Export to GeoJSON
-        if fmt_json:
-            subset_gdf = gpd.GeoDataFrame(subset_df, geometry=gpd.points_from_xy(subset_df.lon_lowestmode, subset_df.lat_lowestmode))
-            subset_gdf.to_file(path.join(outdir, 'subset.json'), driver='GeoJSON', drop_id=True)
-
-def main():
-    """Subsets h5 files at the indir based on the polygon (GeoJSON file) and 
-    saves  as h5 files at the outdir"""
-
-    parser = parse_args(sys.argv[1:])
+    writers = []
+    if fmt_csv:
+        writers.append(CSVWriter(path.join(outdir, 'subset.csv')))
+    # Export to GeoJSON
+    if fmt_json:
+        writers.append(GeoJSONWriter(path.join(outdir, 'subset.json')))
+    if fmt:
+        writers.append(open_writer(fmt, path.join(outdir, 'subset'), compression, row_group_size))
 
-    fmt_csv = parser.csv
-    fmt_json = parser.json
-    indir = parser.indir
-    outdir = parser.subdir
+    with METRICS.stage('export') as m:
+        batch_size = min(window or row_group_size, row_group_size)
+        for beam_df in subset_batches(sorted(glob(path.join(outdir, '*.h5'))), batch_size, memory_mb):
+            for w in writers:
+                w.write(beam_df)
+            m['shots'] += len(beam_df)
+
+        for w in writers:
+            w.close()
+
+def copy_dataset(dataset, hf_out, indices, storage: dict = None, resizable: bool = False):
+    """Copies the elements at indices of a dataset, and its attributes, to 
+    the same path in the output file. The elements are appended to the 
+    output dataset if it exists already, which must then be resizable.
+
+    Args:
+        dataset (h5py.Dataset): dataset of the input file
+        hf_out (h5py.File): output file
+        indices (array): sorted indices of the shots
+        storage (dict): compression, level and chunk_size of the output 
+        dataset; the defaults of storage_options if None
+        resizable (bool): the output dataset can be extended by later windows
+    """
+    granule = path.basename(dataset.file.filename)
+    with METRICS.stage('hdf5_read', granule) as m:
+        data = read_indices(dataset, indices)
+        m['bytes'] += data.nbytes
+    with METRICS.stage('hdf5_write', granule, bytes=data.nbytes):
+        dataset_path = dataset.name
+        if resizable:
+            # later windows append to the dataset of the first one
+            out = hf_out.get(dataset_path)
+            if out is not None:
+                out.resize(len(out) + len(data), axis=0)
+                out[len(out) - len(data):] = data
+                return
+        hf_out.require_group(dataset.parent.name)
+        hf_out.create_dataset(dataset_path, data=data,
+                              **storage_options(data.shape, resizable=resizable, **(storage or {})))
+        for attr in dataset.attrs.keys():
+            hf_out[dataset_path].attrs[attr] = dataset.attrs[attr]
+
+def copy_beam(beam, hf_out, indices, variables: list = None, storage: dict = None, resizable: bool = False):
+    """Copies the shots at indices of a BEAM group to the output file.
+
+    Args:
+        beam (h5py.Group): BEAM group of the input file
+        hf_out (h5py.File): output file
+        indices (array): sorted indices of the shots
+        variables (list): paths of the datasets to copy relative to the 
+        BEAM group, e.g. land_cover_data/pft_class; all datasets if None
+        storage (dict): compression, level and chunk_size of the output datasets
+        resizable (bool): the output datasets can be extended by later windows
+    """
+    import h5py
+
+    for key, value in beam.items():
+        if isinstance(value, h5py.Group):
+            for key2, value2 in value.items():
+                if variables is None or f"{key}/{key2}" in variables:
+                    copy_dataset(value2, hf_out, indices, storage, resizable)
+        elif variables is None or key in variables:
+            copy_dataset(value, hf_out, indices, storage, resizable)
+
+def missing_variables(infile: str, variables: list, remote: dict = None):
+    """Get the variables that the first BEAM group of a h5 file does not 
+    have, as copy_beam would skip them in every granule.
+
+    Args:
+        infile (str): path or URL of the h5 file
+        variables (list): paths of the datasets relative to the BEAM group
+        remote (dict): block_kb and cache_mb of open_remote for a granule 
+        URL; its defaults if None
+
+    Returns:
+        list: paths of the variables the BEAM group does not have
+    """
+    import h5py
+
+    source = open_remote(infile, **(remote or {})) if is_url(infile) else infile
+    try:
+        with h5py.File(source, 'r') as hf_in:
+            beams = [k for k in hf_in.keys() if k.startswith('BEAM')]
+            if not beams:
+                return []
+            return [v for v in variables if v not in hf_in[beams[0]]]
+    finally:
+        if source is not infile:
+            source.close()
+
+def subset_granule(infile: str, outdir: str, aoi, cache_mb: float = CHUNK_CACHE_MB, ranges: dict = None,
+                   variables: list = None, filters: list = None, storage: dict = None, window: int = None,
+                   memory_mb: float = None, remote: dict = None):
+    """Subsets a h5 file based on the area of interest and saves the 
+    subset as a h5 file at the outdir. No subset file is created if no 
+    shots are within the area of interest. With several areas of interest, 
+    the coordinates are read once and the subset of each area is saved in 
+    a subdirectory of the outdir named after the area. The filters are 
+    evaluated on the shots within the area(s) of interest, and only the 
+    selected variables of the shots that pass them are read and copied.
+    With a window or a memory ceiling, each beam is read, tested and 
+    copied window by window, so memory use does not grow with the beams.
+    A granule URL is read in place, only the blocks of the file that h5py
+    reads are transferred.
 
-    poly = gpd.read_file(parser.poly)
-    poly.crs = 'EPSG:4326'
-
-    for g in sorted(glob(path.join(indir, '*.' + GRANULE_FORMAT))):
-        print(g)
-        name, ext = path.splitext(path.basename(g))
-        subfilename = "{name}_sub{ext}".format(name=name, ext=ext)
-        outfile = path.join(outdir, subfilename)
-        hf_in = h5py.File(g, 'r')
-        hf_out = h5py.File(outfile, 'w')
-
-         # loop through BEAMXXXX groups
-        for v in list(hf_in.keys()):
-            if v.startswith('BEAM'):
-                beam = hf_in[v]
+    Args:
+        infile (str): path or URL of the h5 file
+        outdir (str): directory path for saving the subset h5 file
+        aoi (AOI or AOISet): area(s) of interest
+        cache_mb (float): HDF5 chunk cache size in MB
+        ranges (dict): beam name to the shot ranges that may be within the
+        area of interest, from the footprint index; all shots of all beams 
+        are tested if None
+        variables (list): paths of the datasets to copy relative to the 
+        BEAM groups; all datasets if None
+        filters (list): Filter objects the shots must pass, if any
+        storage (dict): compression, level and chunk_size of the subset 
+        datasets; the defaults of storage_options if None
+        window (int): maximum number of shots of a beam processed at once;
+        whole beams if None
+        memory_mb (float): memory ceiling in MB of the data of a window, 
+        besides the HDF5 chunk cache; no ceiling if None
+        remote (dict): block_kb and cache_mb of open_remote for a granule 
+        URL; its defaults if None
+
+    Returns:
+        int: number of shots within the area(s) of interest
+    """
+    with METRICS.stage('subset', path.basename(infile)) as m:
+        m['shots'] = _subset_granule(infile, outdir, aoi, cache_mb, ranges, variables, filters, storage, window,
+                                     memory_mb, remote)
+    return m['shots']
+
+def _subset_granule(infile: str, outdir: str, aoi, cache_mb: float, ranges: dict, variables: list, filters: list,
+                    storage: dict, window: int, memory_mb: float, remote: dict):
+    import h5py
+
+    granule = path.basename(infile)
+    subfilename = subset_filename(infile)
+    # datasets of windowed beams are extended window by window
+    windowed = window is not None or memory_mb is not None
+    # a remote granule is read through the block cache of a file object
+    source = open_remote(infile, **(remote or {})) if is_url(infile) else infile
+    hf_in = h5py.File(source, 'r', rdcc_nbytes=int(cache_mb * 1024 ** 2))
+    hf_outs = {}
+    nshots = 0
+
+     # loop through BEAMXXXX groups
+    for v in list(hf_in.keys()):
+        if v.startswith('BEAM') and (ranges is None or v in ranges):
+            beam = hf_in[v]
+            size = memory_window(beam, memory_mb, variables, window)
+            if ranges is None and size is None:
+                windows = [None]
+            else:
+                beam_ranges = ranges[v] if ranges is not None else [[0, len(beam['lat_lowestmode'])]]
+                windows = window_ranges(beam_ranges, size)
+
+            # each window of shots is tested, filtered and copied in turn
+            for shot_ranges in windows:
                 # find the shots that overlays the area of interest
-                lat = beam['lat_lowestmode'][:]
-                lon = beam['lon_lowestmode'][:]
-                i = np.arange(0, len(lat), 1) # index
-                l4adf = pd.DataFrame(list(zip(lat,lon, i)), columns=["lat_lowestmode", "lon_lowestmode", "i"])
-                l4agdf = gpd.GeoDataFrame(l4adf, geometry=gpd.points_from_xy(l4adf.lon_lowestmode, l4adf.lat_lowestmode))
-                l4agdf.crs = "EPSG:4326"
-                indices = l4agdf[l4agdf['geometry'].within(poly.geometry[0])].i
-
-                # copy BEAMS to the output file
-                if (len(indices) > 0):
-                    for key, value in beam.items():
-                        if isinstance(value, h5py.Group):
-                            for key2, value2 in value.items():
-                                group_path = value2.parent.name
-                                group_id = hf_out.require_group(group_path)
-                                dataset_path = group_path + '/' + key2
-                                hf_out.create_dataset(dataset_path, data=value2[:][indices])
-                                for attr in value2.attrs.keys():
-                                    hf_out[dataset_path].attrs[attr] = value2.attrs[attr]
-                        else:
-                            group_path = value.parent.name
-                            group_id = hf_out.require_group(group_path)
-                            dataset_path = group_path + '/' + key
-                            hf_out.create_dataset(dataset_path, data=value[:][indices])
-                            for attr in value.attrs.keys():
-                                hf_out[dataset_path].attrs[attr] = value.attrs[attr]
-
-        if (len(hf_out.keys()) > 0):
+                with METRICS.stage('hdf5_read', granule) as m:
+                    if shot_ranges is None:
+                        lat = beam['lat_lowestmode'][:]
+                        lon = beam['lon_lowestmode'][:]
+                    else:
+                        lat = read_ranges(beam['lat_lowestmode'], shot_ranges)
+                        lon = read_ranges(beam['lon_lowestmode'], shot_ranges)
+                        shots = range_indices(shot_ranges)
+                    m['bytes'] += lat.nbytes + lon.nbytes
+                with METRICS.stage('point_in_polygon', granule, shots=len(lat)):
+                    areas = aoi.split(lat, lon)
+                if shot_ranges is not None:
+                    areas = {area: shots[indices] for area, indices in areas.items()}
+
+                # only the shots within the area(s) of interest are filtered
+                if filters and areas:
+                    with METRICS.stage('filter', granule) as m:
+                        candidates = np.unique(np.concatenate(list(areas.values())))
+                        m['shots'] = len(candidates)
+                        passed = filter_indices(beam, candidates, filters)
+                    areas = {area: np.intersect1d(indices, passed, assume_unique=True) for area, indices in areas.items()}
+
+                # copy BEAMS to the output file(s)
+                for area, indices in areas.items():
+                    if (len(indices) > 0):
+                        if area not in hf_outs:
+                            area_dir = outdir if area is None else path.join(outdir, area)
+                            hf_outs[area] = h5py.File(path.join(area_dir, subfilename), 'w', libver=H5_LIBVER)
+                        copy_beam(beam, hf_outs[area], indices, variables, storage, windowed)
+                        nshots += len(indices)
+
+    with METRICS.stage('hdf5_write', granule):
+        for hf_out in hf_outs.values():
             # copy ANCILLARY and METADATA groups
             for v in ["/ANCILLARY", "/METADATA"]:
                 hf_in.copy(hf_in[v],hf_out)
             hf_out.close()
-        else:
-            hf_out.close()
-            # delete file with no BEAMS
-            remove(outfile)
-        
-        hf_in.close()
+    
+    hf_in.close()
+    if source is not infile:
+        source.close()
+    return nshots
+
+def granule_ranges(granules: list, aoi, indir: str, map=map):
+    """Get the shot ranges of the granules that may be within the area of 
+    interest from the footprint index of the input directory. The index is
+    created, or updated with new granules, first.
+
+    Args:
+        granules (list): paths of the h5 files
+        aoi (AOI): area of interest
+        indir (str): directory path of the h5 files
+        map: map function used to index new granules
+
+    Returns:
+        dict: granule path to a dict of beam name to shot ranges; empty for
+        granules that do not cross the area of interest
+    """
+    from gedi_l4a.footprints import FootprintIndex
+
+    with METRICS.stage('footprint_index'):
+        index = FootprintIndex(indir)
+        index.update(granules, map)
+        return {g: index.candidates(g, aoi) for g in granules}
+
+def subset_granule_metrics(*args):
+    """Subsets a h5 file in a worker process.
+
+    Returns:
+        tuple: number of shots within the area(s) of interest, and the 
+        snapshot of the metrics of the worker process
+    """
+    METRICS.reset()
+    nshots = subset_granule(*args)
+    return nshots, METRICS.snapshot()
+
+def consolidate_granule(files: dict, subset_dir: str, outdir: str, infile: str, window: int = None,
+                        memory_mb: float = None):
+    """Appends the subset h5 files of a granule in the scratch subset_dir
+    to the consolidated files of the output directories, and removes them.
+
+    Args:
+        files (dict): output directory to its ConsolidatedFile
+        subset_dir (str): scratch directory mirroring the outdir
+        outdir (str): directory path of the subsets
+        infile (str): path of the h5 file
+        window (int): maximum number of shots appended at once, if any
+        memory_mb (float): memory ceiling in MB of the shots appended at
+        once, if any
+
+    Returns:
+        int: number of shots appended
+    """
+    nshots = 0
+    for d, consolidated in files.items():
+        subfile = path.join(subset_dir, path.relpath(d, outdir), subset_filename(infile))
+        if path.isfile(subfile):
+            nshots += consolidated.append(subfile, path.basename(infile), window, memory_mb)
+            remove(subfile)
+    return nshots
+
+def granule_signature(infile: str):
+    """Returns the size and mtime of a file, to detect changed granules; 
+    the URL of a remote granule names its version already."""
+    if is_url(infile):
+        return infile
+    st = stat(infile)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+def granule_unit(infile: str):
+    """Journal unit of a granule: the file name of a local granule, so the
+    input directory can move, or the URL of a remote one."""
+    return infile if is_url(infile) else path.basename(infile)
+
+def download_and_subset(granules: list, links: dict, scratch: str, limit: int, subset_args: tuple, finish,
+                        workers: int = 1, download_workers: int = DOWNLOAD_WORKERS):
+    """Downloads granules to a scratch directory and subsets each one as 
+    soon as it is downloaded and verified, removing it once subset. The
+    downloads wait for subset granules to be removed while the granules 
+    on the scratch disk would exceed the limit, so the disk holds a few 
+    granules at a time, and the subsets overlap with the downloads.
+
+    Args:
+        granules (list): urls of the granules
+        links (dict): granule url to its url, sha256 url and size
+        scratch (str): directory path of the downloaded granules
+        limit (int): bytes of granules on the scratch disk at once
+        subset_args (tuple): arguments of subset_granule after the infile
+        finish: called with each granule url and its number of shots, 
+        or None if it failed
+        workers (int): number of granules subset in parallel processes
+        download_workers (int): number of granules downloaded concurrently
+
+    Returns:
+        list: urls of the granules that failed to download or subset
+    """
+    from gedi_l4a.download import PART_SUFFIX, SEGMENTS_SUFFIX, ScratchBudget, download_files
+    from gedi_l4a.session import EDLSession
+
+    makedirs(scratch, exist_ok=True)
+    session = EDLSession(pool_size=max(download_workers, 1))
+    budget = ScratchBudget(limit)
+    failed = []
+
+    def download(g):
+        # granules of unknown size are downloaded one at a time
+        size = links[g]['size'] or limit
+        budget.acquire(size)
+        local = path.join(scratch, path.basename(g))
+        try:
+            download_files(local, session, **links[g])
+        except Exception:
+            # partial downloads are not counted in the scratch budget
+            for f in [local + PART_SUFFIX, local + PART_SUFFIX + SEGMENTS_SUFFIX]:
+                if path.isfile(f):
+                    remove(f)
+            budget.release(size)
+            raise
+        return local, size
+
+    def done(g, local, size, nshots):
+        if path.isfile(local):
+            remove(local)
+        budget.release(size)
+        finish(g, nshots)
+
+    n = 0
+    subsets = ProcessPoolExecutor(max_workers=workers) if workers > 1 else contextlib.nullcontext()
+    with ThreadPoolExecutor(max_workers=max(download_workers, 1)) as downloads, subsets as executor:
+        # each future maps to its granule, and to the downloaded file and 
+        # its reserved bytes once the granule is being subset
+        futures = {downloads.submit(download, g): (g, None) for g in granules}
+        while futures:
+            completed, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in completed:
+                g, downloaded = futures.pop(future)
+                try:
+                    if downloaded is None:
+                        downloaded = future.result()
+                        if executor is not None:
+                            futures[executor.submit(subset_granule_metrics, downloaded[0], *subset_args)] = (g, downloaded)
+                            continue
+                        nshots = subset_granule(downloaded[0], *subset_args)
+                    else:
+                        nshots, snapshot = future.result()
+                        METRICS.merge(snapshot)
+                    n += 1
+                    print(f"[{n}/{len(granules)}] {g}: {nshots} shots")
+                    done(g, *downloaded, nshots)
+                except Exception as e:
+                    n += 1
+                    failed.append(g)
+                    print(f"[{n}/{len(granules)}] {g}: failed, {e}")
+                    if downloaded is None:
+                        finish(g, None)
+                    else:
+                        done(g, *downloaded, None)
+    return failed
+
+def get_granules(doi: str, aoi, temporal: str):
+    """Get the url, sha256 url and size of the granules that overlap the 
+    temporal bounds and the area(s) of interest.
+
+    Args:
+        doi (str): dataset DOI
+        aoi (AOI or AOISet): area(s) of interest
+        temporal (str): temporal ranges with start and end datetimes 
+        in NASA CMR-required format
+
+    Returns:
+        dict: granule url to its granule_links dict, in url order
+    """
+    import geopandas as gpd
+    import shapely
+
+    print("Searching for granules ..")
+    # the areas of an AOISet are the parts of a geometry collection
+    poly = gpd.GeoSeries(shapely.get_parts(aoi.geometry), crs='EPSG:4326')
+    collection, granules = CMR.search(doi, poly, temporal)
+    links = [granule_links(g, collection['data_center'], GRANULE_FORMAT) for g in granules]
+    links = {g['url']: g for g in sorted(links, key=lambda g: g['url']) if g['url']}
+    print(f"Total granules found: {len(links)}")
+    return links
+
+def main(args: list = None):
+    """Subsets h5 files at the indir, or the granules of a DOI in place, 
+    based on the polygon (GeoJSON file) and saves  as h5 files at the 
+    outdir; args default to the command line arguments"""
+
+    parser = parse_args(sys.argv[1:] if args is None else args)
+    # metrics of earlier calls in the same process
+    METRICS.reset()
+    # heavy libraries are loaded once the arguments are valid
+    import shapely
+    from gedi_l4a.aoi import AOISet
+
+    fmt_csv = parser.csv
+    fmt_json = parser.json
+    indir = parser.indir
+    outdir = parser.subdir
+
+    if parser.poly:
+        # all features of the GeoJSON file
+        aoi = read_aoi(parser.poly)
+        outdirs = [outdir]
+    else:
+        # one output subdirectory per GeoJSON file
+        aoi = AOISet.from_files(parser.polys)
+        outdirs = [path.join(outdir, name) for name in aoi.names]
+        for d in outdirs:
+            makedirs(d, exist_ok=True)
+
+    if parser.doi:
+        CMR.ttl = parser.cache_ttl * 3600
+        links = get_granules(parser.doi, aoi, cmr_temporal(parser.date1, parser.date2))
+        granules = list(links)
+    else:
+        granules = sorted(glob(path.join(indir, '*.' + GRANULE_FORMAT)))
+    variables = KEEP_VARIABLES + [v for v in parser.variables if v not in KEEP_VARIABLES] if parser.variables else None
+    filters = parser.where or []
+    remote = {'block_kb': parser.block_size, 'cache_mb': parser.block_cache}
+    if variables and granules:
+        try:
+            missing = missing_variables(granules[0], variables, remote)
+        except Exception:
+            # a granule that cannot be read fails when it is subset
+            missing = []
+        if missing:
+            sys.exit(f"--variables not in {path.basename(granules[0])}: {','.join(missing)}")
+
+    journal = None
+    if parser.journal:
+        journal = Journal(parser.journal, {
+            'aoi': hashlib.sha256(shapely.to_wkb(aoi.geometry)).hexdigest(),
+            'areas': getattr(aoi, 'names', None), 'subdir': path.abspath(outdir),
+            'variables': variables, 'where': [repr(f) for f in filters],
+        })
+        # skipping granules subset by earlier runs, unless they changed since
+        signatures = {g: granule_signature(g) for g in granules}
+        granules = [g for g in granules if not journal.done(granule_unit(g), signatures[g])]
+
+    storage = {
+        'compression': parser.h5_compression, 'level': parser.h5_compression_level,
+        'chunk_size': parser.h5_chunk_size,
+    }
+    subset_dir = outdir
+    consolidated = {}
+    if parser.consolidate:
+        # granules are subset to uncompressed scratch files first, then
+        # appended to the consolidated files in granule order
+        subset_dir = tempfile.mkdtemp(prefix='.subset_', dir=outdir)
+        for d in outdirs:
+            makedirs(path.join(subset_dir, path.relpath(d, outdir)), exist_ok=True)
+            # a journaled run appends to the consolidated files of the earlier
+            # runs it records; otherwise they are rewritten, not appended twice
+            append = journal is not None and journal.count() > 0
+            consolidated[d] = ConsolidatedFile(path.join(d, CONSOLIDATED_FILE), append=append, **storage)
+            if append:
+                # granules recorded with another signature changed since
+                # they were appended, their earlier shots are replaced
+                for g in granules:
+                    if journal.done(granule_unit(g)):
+                        consolidated[d].remove(path.basename(g), parser.window)
+        storage = {'compression': 'none'}
+
+    def record(g, nshots):
+        if journal:
+            journal.record(granule_unit(g), signatures[g], nrows=nshots)
+
+    pending = list(granules)
+    finished = {}
+
+    def finish(g, nshots):
+        # nshots is None for failed granules, which are not recorded
+        if not consolidated:
+            if nshots is not None:
+                record(g, nshots)
+            return
+        finished[g] = nshots
+        while pending and pending[0] in finished:
+            g = pending.pop(0)
+            if finished.pop(g) is not None:
+                with METRICS.stage('consolidate', path.basename(g)) as m:
+                    m['shots'] = consolidate_granule(consolidated, subset_dir, outdir, g, parser.window,
+                                                     parser.max_memory)
+                record(g, m['shots'])
+
+    failed = []
+    with profiled(parser.profile):
+        try:
+            if parser.scratch:
+                # downloads, subsets and removals of the granules overlap
+                subset_args = (subset_dir, aoi, parser.chunk_cache, None, variables, filters, storage, parser.window,
+                               parser.max_memory)
+                failed = download_and_subset(granules, links, parser.scratch, int(parser.scratch_limit * 1e9),
+                                             subset_args, finish, parser.workers, parser.download_workers)
+            elif parser.workers > 1:
+                # each worker process opens its own h5 files
+                with ProcessPoolExecutor(max_workers=parser.workers) as executor:
+                    ranges = granule_ranges(granules, aoi, indir, executor.map) if parser.index else {}
+                    futures = {
+                        executor.submit(subset_granule_metrics, g, subset_dir, aoi, parser.chunk_cache, ranges.get(g),
+                                        variables, filters, storage, parser.window, parser.max_memory, remote): g
+                        for g in granules if ranges.get(g) != {}
+                    }
+                    for g in granules:
+                        if ranges.get(g) == {}:
+                            finish(g, 0)
+                    for n, future in enumerate(as_completed(futures), 1):
+                        g = futures[future]
+                        try:
+                            nshots, snapshot = future.result()
+                            METRICS.merge(snapshot)
+                            print(f"[{n}/{len(futures)}] {g}: {nshots} shots")
+                            finish(g, nshots)
+                        except Exception as e:
+                            failed.append(g)
+                            print(f"[{n}/{len(futures)}] {g}: failed, {e}")
+                            finish(g, None)
+            else:
+                ranges = granule_ranges(granules, aoi, indir) if parser.index else {}
+                for g in granules:
+                    if ranges.get(g) != {}:
+                        print(g)
+                        try:
+                            finish(g, subset_granule(g, subset_dir, aoi, parser.chunk_cache, ranges.get(g), variables,
+                                                     filters, storage, parser.window, parser.max_memory, remote))
+                        except Exception as e:
+                            # as with --workers, the other granules are still subset
+                            failed.append(g)
+                            print(f"{g}: failed, {e}")
+                            finish(g, None)
+                    else:
+                        finish(g, 0)
+        finally:
+            for f in consolidated.values():
+                f.close()
+            if consolidated:
+                shutil.rmtree(subset_dir, ignore_errors=True)
+
+        if journal:
+            journal.close()
+
+        if fmt_csv or fmt_json or parser.format:
+            for d in outdirs:
+                create_csv_json(d, fmt_json, fmt_csv, parser.format, parser.compression, parser.row_group_size,
+                                parser.window, parser.max_memory)
+
+    if parser.metrics:
+        METRICS.write(parser.metrics, 'gedi_l4a_subsets')
 
-    if fmt_csv or fmt_json:
-        create_csv_json(outdir, fmt_json, fmt_csv)
+    if failed:
+        sys.exit(f"{len(failed)} granule(s) failed to subset")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
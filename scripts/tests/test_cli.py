@@ -0,0 +1,33 @@
+"""Tests of the command line usage of the scripts."""
+import re
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import pytest
+import gedi_l4a_aggregate
+import gedi_l4a_hyrax
+import gedi_l4a_search_download
+import gedi_l4a_subsets
+
+SCRIPTS = [gedi_l4a_search_download, gedi_l4a_subsets, gedi_l4a_hyrax, gedi_l4a_aggregate]
+README = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'README.md')
+
+
+def help_text(module, capsys):
+    with pytest.raises(SystemExit):
+        module.parse_args(['--help'])
+    return capsys.readouterr().out
+
+
+@pytest.mark.parametrize('module', SCRIPTS, ids=lambda m: m.__name__)
+def test_usage(module, capsys):
+    """The usage string lists every option of the script once, and is the
+    usage block of the README."""
+    text = help_text(module, capsys)
+    usage = text[len('usage: '):text.index('\n')]
+    options = re.findall(r'^  (--[\w-]+)', text, re.MULTILINE)
+    assert sorted(re.findall(r'--[\w-]+', usage)) == sorted(o for o in options if o != '--help')
+    with open(README) as f:
+        assert f"./{usage}\n" in f.read()
@@ -0,0 +1,41 @@
+"""Tests of the cached CMR searches against the mock CMR server."""
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import pytest
+from benchmarks.mockservers import MockServer
+from gedi_l4a.cmr import CMRClient
+
+DOI = '10.3334/ORNLDAAC/2056'
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = MockServer(str(tmp_path)).start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize('cache_dir', [False, True], ids=['memo', 'cache_dir'])
+def test_no_cache_ttl(tmp_path, server, cache_dir):
+    """A ttl of 0 disables the in-process memo as well as the cache files."""
+    client = CMRClient(server.cmr_url, cache_dir=str(tmp_path / 'cache') if cache_dir else None, collection_ttl=0)
+    client.collection(DOI)
+    client.collection(DOI)
+    assert server.requests['collections'] == 2
+
+
+@pytest.mark.parametrize('cache_dir', [False, True], ids=['memo', 'cache_dir'])
+def test_cache_expiry(tmp_path, server, cache_dir, monkeypatch):
+    """Memoized results expire after the ttl, as cached files do."""
+    client = CMRClient(server.cmr_url, cache_dir=str(tmp_path / 'cache') if cache_dir else None, collection_ttl=60)
+    client.collection(DOI)
+    client.collection(DOI)
+    assert server.requests['collections'] == 1
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    client.collection(DOI)
+    assert server.requests['collections'] == 2
@@ -0,0 +1,46 @@
+"""Tests of the resumable granule downloads against the mock data server."""
+import os
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import pytest
+import requests
+from benchmarks.mockservers import MockServer
+from gedi_l4a.download import PART_SUFFIX, SEGMENTS_SUFFIX, download_files
+
+GRANULE = 'GEDI04_A_2020000000000_O00000_02_T00000_02_002_02_V002.h5'
+
+
+@pytest.fixture
+def granule(tmp_path):
+    """A granule of random bytes served by the mock data server."""
+    root = tmp_path / 'server'
+    root.mkdir()
+    data = os.urandom(300000)
+    (root / GRANULE).write_bytes(data)
+    server = MockServer(str(root)).start()
+    url = f'{server.url}/data/{GRANULE}'
+    yield {'url': url, 'sha256': url + '.sha256', 'size': len(data)}, data
+    server.stop()
+
+
+@pytest.mark.parametrize('part', [None, b'x' * 1000], ids=['no_part', 'short_part'])
+def test_stale_segments_log(tmp_path, granule, part):
+    """A segments log left without its .part file, or with a .part file of
+    another size, is dropped and the granule is downloaded from byte 0."""
+    g, data = granule
+    local_file = str(tmp_path / GRANULE)
+    with open(local_file + PART_SUFFIX + SEGMENTS_SUFFIX, 'w') as f:
+        f.write("0 65536\n65536 131072\n")
+    if part is not None:
+        with open(local_file + PART_SUFFIX, 'wb') as f:
+            f.write(part)
+
+    download_files(local_file, requests.Session(), segments=2, segment_size=65536, **g)
+
+    with open(local_file, 'rb') as f:
+        assert f.read() == data
+    assert not path.exists(local_file + PART_SUFFIX)
+    assert not path.exists(local_file + PART_SUFFIX + SEGMENTS_SUFFIX)
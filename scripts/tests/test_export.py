@@ -0,0 +1,85 @@
+"""Tests of the streaming exports of gedi_l4a.export."""
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+import pytest
+from gedi_l4a.export import CSVWriter, FlatGeobufWriter, ParquetWriter
+
+
+def batch(start, nrows, **columns):
+    df = pd.DataFrame({
+        'lat_lowestmode': np.linspace(-10, 10, nrows), 'lon_lowestmode': np.linspace(20, 40, nrows),
+        'shot_number': np.arange(start, start + nrows, dtype=np.uint64),
+    })
+    for name, values in columns.items():
+        df[name] = values
+    return df
+
+
+def changing_batches():
+    """Batches of which the second lacks a column, of which the third adds
+    one, and of which the last has the float NaN column of a variable that
+    Hyrax does not have in place of an integer one."""
+    return [
+        batch(0, 5, agbd=np.arange(5, dtype=np.float32), l4_quality_flag=np.ones(5, dtype=np.uint8)),
+        batch(5, 3, agbd=np.arange(3, dtype=np.float32)),
+        batch(8, 4, agbd=np.arange(4, dtype=np.float32), l4_quality_flag=np.zeros(4, dtype=np.uint8),
+              sensitivity=np.full(4, 0.9)),
+        batch(12, 2, agbd=np.arange(2, dtype=np.float32), l4_quality_flag=np.full(2, np.nan)),
+    ]
+
+
+def check_columns(df):
+    # FlatGeobuf files are ordered by their spatial index
+    df = df.sort_values('shot_number', ignore_index=True)
+    assert list(df.columns[:6]) == ['lat_lowestmode', 'lon_lowestmode', 'shot_number', 'agbd',
+                                    'l4_quality_flag', 'sensitivity']
+    assert df['shot_number'].tolist() == list(range(14))
+    assert df['l4_quality_flag'].tolist()[:5] == [1] * 5
+    assert df['l4_quality_flag'].isna().tolist() == [False] * 5 + [True] * 3 + [False] * 4 + [True] * 2
+    assert df['sensitivity'].notna().tolist() == [False] * 8 + [True] * 4 + [False] * 2
+
+
+def test_csv_changing_columns(tmp_path):
+    """Columns first seen in a later batch are added to the header and
+    padded in the rows written before them."""
+    filename = str(tmp_path / 'subset.csv')
+    writer = CSVWriter(filename)
+    for df in changing_batches():
+        writer.write(df)
+    writer.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['subset.csv']
+    with open(filename) as f:
+        widths = {line.count(',') for line in f}
+    assert widths == {5}
+    check_columns(pd.read_csv(filename))
+
+
+@pytest.mark.parametrize('geometry', [False, True], ids=['parquet', 'geoparquet'])
+def test_parquet_changing_columns(tmp_path, geometry):
+    """Columns missing from a batch are null, columns added by a later batch
+    are null in the earlier rows, and types are widened to hold all rows."""
+    filename = str(tmp_path / 'subset.parquet')
+    writer = ParquetWriter(filename, row_group_size=4, geometry=geometry)
+    for df in changing_batches():
+        writer.write(df)
+    writer.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['subset.parquet']
+    check_columns(pd.read_parquet(filename))
+
+
+def test_flatgeobuf_changing_columns(tmp_path):
+    """As with Parquet, the FlatGeobuf file has the columns of all batches."""
+    gpd = pytest.importorskip('geopandas')
+    pytest.importorskip('pyogrio')
+    filename = str(tmp_path / 'subset.fgb')
+    writer = FlatGeobufWriter(filename)
+    for df in changing_batches():
+        writer.write(df)
+    writer.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['subset.fgb']
+    check_columns(gpd.read_file(filename))
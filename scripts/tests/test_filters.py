@@ -0,0 +1,47 @@
+"""Tests of the --where filter expressions."""
+import argparse
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import numpy as np
+import pytest
+import gedi_l4a_aggregate
+from gedi_l4a.cli import check_where
+from gedi_l4a.filters import Filter
+
+
+@pytest.mark.parametrize('expr', ['agbd>=abc', 'agbd>=1.5x', 'agbd==_fillvalue', "pft_class=='1"])
+def test_invalid_value(expr):
+    """Values that are not numbers, quoted strings or _FillValue are
+    rejected when the expression is parsed."""
+    with pytest.raises(ValueError, match='not a number'):
+        Filter.parse(expr)
+    with pytest.raises(argparse.ArgumentTypeError):
+        check_where(expr)
+
+
+def test_invalid_value_argument(capsys):
+    """An invalid --where value is an argument error."""
+    with pytest.raises(SystemExit) as e:
+        gedi_l4a_aggregate.parse_args(['--inputs', 'subsets', '--output', 'grid.nc', '--where', 'agbd>=abc'])
+    assert e.value.code == 2
+    assert 'argument --where: not a number' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('expr, variable, op, value', [
+    ('l4_quality_flag==1', 'l4_quality_flag', '==', '1'),
+    (' sensitivity >= 0.95 ', 'sensitivity', '>=', '0.95'),
+    ('agbd!=_FillValue', 'agbd', '!=', '_FillValue'),
+    ("land_cover_data/pft_class=='4'", 'land_cover_data/pft_class', '==', "'4'"),
+])
+def test_valid_expression(expr, variable, op, value):
+    f = Filter.parse(expr)
+    assert (f.variable, f.op, f.value) == (variable, op, value)
+
+
+def test_compare_quoted_string():
+    """Quoted values are compared with string columns without their quotes."""
+    f = Filter.parse('BEAM=="BEAM0101"')
+    assert f.compare(np.array(['BEAM0000', 'BEAM0101'], dtype=object)).tolist() == [False, True]
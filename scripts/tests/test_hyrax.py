@@ -0,0 +1,77 @@
+"""Tests of gedi_l4a_hyrax.py against the mock CMR and Hyrax servers."""
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import pandas as pd
+import pytest
+import gedi_l4a_hyrax
+from benchmarks.mockservers import MockServer
+from benchmarks.run import write_box
+from benchmarks.synthetic import write_granules
+from gedi_l4a.cmr import CMR
+
+SEARCH_ARGS = ['--doi', '10.3334/ORNLDAAC/2056', '--date1', '2020-01-01', '--date2', '2020-12-31']
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    """Two small synthetic granules served by the mock CMR and Hyrax
+    servers, and an area of interest that all their ground tracks cross."""
+    root = tmp_path_factory.mktemp('hyrax')
+    indir = root / 'granules'
+    indir.mkdir()
+    write_granules(str(indir), 2, nshots=500)
+    poly = str(root / 'aoi.json')
+    write_box(poly, -180, -60, 180, 60)
+    server = MockServer(str(indir)).start()
+    url, cache_dir = CMR.url, CMR.cache_dir
+    CMR.url, CMR.cache_dir = server.cmr_url, None
+    yield server, poly
+    CMR.url, CMR.cache_dir = url, cache_dir
+    server.stop()
+
+
+def run_hyrax(poly, outfile, *args):
+    gedi_l4a_hyrax.main(SEARCH_ARGS + ['--poly', poly, '--outfile', str(outfile), '--beams', 'BEAM0000',
+                                       '--coord-cache-mb', '0', '--cache-ttl', '0'] + list(args))
+
+
+def test_variables_of_earlier_calls(tmp_path, server):
+    """The --variables of a call are not written by the next calls."""
+    _, poly = server
+    headers = list(gedi_l4a_hyrax.HEADERS)
+    run_hyrax(poly, tmp_path / 'first.csv', '--variables', 'agbd')
+    run_hyrax(poly, tmp_path / 'second.csv', '--variables', 'agbd_se')
+    assert gedi_l4a_hyrax.HEADERS == headers
+    assert list(pd.read_csv(tmp_path / 'second.csv', nrows=0).columns) == headers + ['agbd_se']
+
+
+def test_failed_beam(tmp_path, server, monkeypatch):
+    """A beam that fails to fetch is reported and not journaled, the other
+    beams are written and a rerun fetches the failed beam only."""
+    _, poly = server
+    get_hyrax_beam = gedi_l4a_hyrax.get_hyrax_beam
+    fetched = []
+
+    def failing(s, url, *args):
+        fetched.append(url)
+        if len(fetched) == 1:
+            raise OSError("connection reset")
+        return get_hyrax_beam(s, url, *args)
+
+    monkeypatch.setattr(gedi_l4a_hyrax, 'get_hyrax_beam', failing)
+    outfile = tmp_path / 'subset.csv'
+    args = ['--variables', 'agbd', '--journal', str(tmp_path / 'journal.db'), '--format', 'parquet']
+    with pytest.raises(SystemExit, match='1 granule beam'):
+        run_hyrax(poly, outfile, *args)
+    assert len(fetched) == 2
+    partial = pd.read_csv(outfile)
+    assert len(partial) > 0
+    assert len(pd.read_parquet(tmp_path / 'subset.parquet')) == len(partial)
+
+    run_hyrax(poly, outfile, *args)
+    assert len(fetched) == 3 and fetched[2] == fetched[0]
+    df = pd.read_csv(outfile)
+    assert len(df) > len(partial) and df['shot_number'].is_unique
@@ -0,0 +1,57 @@
+"""Tests of the block-cached remote files against the mock data server."""
+import os
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import pytest
+import requests
+from benchmarks.mockservers import MockServer
+from gedi_l4a.remote import RemoteFile
+
+GRANULE = 'GEDI04_A_2020000000000_O00000_02_T00000_02_002_02_V002.h5'
+BLOCK_SIZE = 1024
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """A granule of random bytes served by the mock data server, opened
+    with a cache of 4 blocks."""
+    data = os.urandom(20 * BLOCK_SIZE + 100)
+    (tmp_path / GRANULE).write_bytes(data)
+    server = MockServer(str(tmp_path)).start()
+    with RemoteFile(f'{server.url}/data/{GRANULE}', requests.Session(), block_size=BLOCK_SIZE,
+                    cache_size=4 * BLOCK_SIZE, read_ahead=16 * BLOCK_SIZE) as f:
+        yield f, data
+    server.stop()
+
+
+def test_read_larger_than_cache(remote):
+    """A read of more blocks than the cache holds returns all of them."""
+    f, data = remote
+    f.seek(100)
+    assert f.read(10 * BLOCK_SIZE) == data[100:100 + 10 * BLOCK_SIZE]
+    f.seek(0)
+    assert f.read() == data
+
+
+def test_read_over_cached_blocks(remote):
+    """A long read over cached blocks and runs of missing blocks, which
+    evict the cached ones, returns all of them."""
+    f, data = remote
+    for offset in [2 * BLOCK_SIZE, 9 * BLOCK_SIZE]:
+        f.seek(offset)
+        f.read(10)
+    f.seek(BLOCK_SIZE + 5)
+    assert f.read(15 * BLOCK_SIZE) == data[BLOCK_SIZE + 5:16 * BLOCK_SIZE + 5]
+
+
+def test_sequential_reads_ahead(remote):
+    """Sequential reads, with a read ahead up to the cache size, return
+    the file."""
+    f, data = remote
+    chunks = []
+    while chunk := f.read(BLOCK_SIZE // 2 + 7):
+        chunks.append(chunk)
+    assert b''.join(chunks) == data
@@ -0,0 +1,130 @@
+"""Tests of gedi_l4a_subsets.py on synthetic granules."""
+import os
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import h5py
+import numpy as np
+import pytest
+import gedi_l4a_subsets
+from benchmarks.run import write_box
+from benchmarks.synthetic import write_granules
+from gedi_l4a.h5utils import subset_filename
+
+
+@pytest.fixture(scope='module')
+def granules(tmp_path_factory):
+    """Three small synthetic granules, and an area of interest that all
+    their ground tracks cross."""
+    root = tmp_path_factory.mktemp('granules')
+    indir = root / 'granules'
+    indir.mkdir()
+    files = write_granules(str(indir), 3, nshots=2000)
+    poly = str(root / 'aoi.json')
+    write_box(poly, -180, -60, 180, 60)
+    return str(indir), files, poly
+
+
+def consolidated_shots(subdir):
+    with h5py.File(path.join(subdir, gedi_l4a_subsets.CONSOLIDATED_FILE), 'r') as hf:
+        shots = hf['shots/shot_number'][()]
+        granules = hf['granules'].asstr()[()]
+        names = granules[hf['shots/granule_index'][()]]
+    return shots, names
+
+
+def test_consolidate_changed_granule(tmp_path, granules):
+    """A granule that changed since a journaled run replaces its shots in
+    subset.h5 rather than adding them a second time."""
+    indir, files, poly = granules
+    subdir = str(tmp_path / 'subsets')
+    os.makedirs(subdir)
+    args = ['--poly', poly, '--indir', indir, '--subdir', subdir, '--consolidate',
+            '--journal', str(tmp_path / 'journal.sqlite')]
+    gedi_l4a_subsets.main(args)
+    shots, names = consolidated_shots(subdir)
+    assert len(shots) > 0
+
+    st = os.stat(files[1])
+    os.utime(files[1], ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    gedi_l4a_subsets.main(args)
+    shots2, names2 = consolidated_shots(subdir)
+
+    assert len(shots2) == len(np.unique(shots2)) == len(shots)
+    # the shots of each granule are still indexed by the granule name
+    for name in np.unique(names):
+        assert np.array_equal(np.sort(shots[names == name]), np.sort(shots2[names2 == name]))
+
+
+def test_journaled_index_keeps_skipped_granules(tmp_path, granules):
+    """A journaled rerun with --index keeps the footprints of the granules
+    it skips in the index of the input directory."""
+    from gedi_l4a.footprints import INDEX_NAME
+
+    indir, files, poly = granules
+    subdir = str(tmp_path / 'subsets')
+    os.makedirs(subdir)
+    args = ['--poly', poly, '--indir', indir, '--subdir', subdir, '--index',
+            '--journal', str(tmp_path / 'journal.sqlite')]
+    gedi_l4a_subsets.main(args)
+    st = os.stat(files[0])
+    os.utime(files[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    gedi_l4a_subsets.main(args)
+    with np.load(path.join(indir, INDEX_NAME)) as npz:
+        assert sorted(npz['names']) == sorted(path.basename(f) for f in files)
+
+
+def test_failed_download_leaves_no_part(tmp_path, granules, monkeypatch):
+    """A granule that fails to download leaves no partial file on the
+    scratch disk, and the other granules are still subset."""
+    from benchmarks.mockservers import MockServer
+    from gedi_l4a import download
+    from gedi_l4a.cmr import CMR
+
+    indir, files, poly = granules
+    download_files = download.download_files
+
+    def failing(local_file, session, **links):
+        if local_file.endswith(path.basename(files[0])):
+            with open(local_file + download.PART_SUFFIX, 'wb') as f:
+                f.write(b'x' * 1000)
+            with open(local_file + download.PART_SUFFIX + download.SEGMENTS_SUFFIX, 'w') as f:
+                f.write("0 1000\n")
+            raise OSError("connection reset")
+        return download_files(local_file, session, **links)
+
+    monkeypatch.setattr(download, 'download_files', failing)
+    server = MockServer(indir).start()
+    monkeypatch.setattr(CMR, 'url', server.cmr_url)
+    monkeypatch.setattr(CMR, 'cache_dir', None)
+    scratch = tmp_path / 'scratch'
+    subdir = tmp_path / 'subsets'
+    subdir.mkdir()
+    try:
+        with pytest.raises(SystemExit, match='1 granule'):
+            gedi_l4a_subsets.main(['--poly', poly, '--doi', '10.3334/ORNLDAAC/2056', '--date1', '2020-01-01',
+                                   '--date2', '2020-12-31', '--subdir', str(subdir), '--scratch', str(scratch),
+                                   '--cache-ttl', '0'])
+    finally:
+        server.stop()
+    assert os.listdir(scratch) == []
+    assert len(os.listdir(subdir)) == len(files) - 1
+
+
+def test_unknown_variables(tmp_path, granules):
+    """--variables names that the granules do not have are an error, before
+    any granule is subset."""
+    indir, files, poly = granules
+    subdir = tmp_path / 'subsets'
+    subdir.mkdir()
+    args = ['--poly', poly, '--indir', indir, '--subdir', str(subdir), '--variables']
+    with pytest.raises(SystemExit, match='agdb,land_cover_data/pft'):
+        gedi_l4a_subsets.main(args + ['agdb,land_cover_data/pft,agbd_se'])
+    assert os.listdir(subdir) == []
+
+    gedi_l4a_subsets.main(args + ['agbd,land_cover_data/pft_class'])
+    with h5py.File(subdir / subset_filename(files[0])) as hf:
+        beam = hf[[k for k in hf if k.startswith('BEAM')][0]]
+        assert 'agbd' in beam and 'land_cover_data/pft_class' in beam and 'agbd_se' not in beam